@@ -1,4 +1,4 @@
 from allotools.core import AlloUsage
-from allotools import data_io, allocation_ts, utils
+from allotools import data_io, allocation_ts, utils, stream_depletion
 
 __version__ = '0.2.10'
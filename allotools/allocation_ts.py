@@ -4,19 +4,51 @@ Created on Mon Oct  1 09:55:07 2018
 
 @author: michaelek
 """
+import copy
+import hashlib
 import numpy as np
 import pandas as pd
 
+from allotools.utils import get_calendar, day_ns
+# from utils import get_calendar, day_ns
+
 ###################################
 ### Parameters
 
 freq_codes = ['D', 'W', 'M', 'A-JUN']
+limit_days = {'max_daily_volume': 1, 'max_annual_volume': 365}
 
 
 ###################################
 ### Functions
 
 
+def season_mask(months, from_month, to_month):
+    """
+    Function to determine which months are within the seasons of permits. The seasons include both the from_month and the to_month and wrap around the new year when the from_month is after the to_month (e.g. 10 to 4 is October to April). A missing from_month or to_month is the start or end of the year.
+
+    Parameters
+    ----------
+    months : ndarray of int
+        The months to test.
+    from_month : int, float, or ndarray
+        The first month of the seasons (one per month or a single value).
+    to_month : int, float, or ndarray
+        The last month of the seasons (one per month or a single value).
+
+    Returns
+    -------
+    ndarray of bool
+    """
+    from_month = np.where(pd.isnull(from_month), 1, from_month)
+    to_month = np.where(pd.isnull(to_month), 12, to_month)
+
+    in_season = (months >= from_month) & (months <= to_month)
+    wrap_season = (months >= from_month) | (months <= to_month)
+
+    return np.where(from_month <= to_month, in_season, wrap_season)
+
+
 def allo_ts_apply(row, from_date, to_date, freq, limit_col, remove_months=False):
     """
     Pandas apply function that converts the allocation data to a monthly time series.
@@ -35,10 +67,7 @@ def allo_ts_apply(row, from_date, to_date, freq, limit_col, remove_months=False)
     end_date = (end - pd.DateOffset(hours=1) + pd.tseries.frequencies.to_offset(freq)).floor('D')
     dates1 = pd.date_range(start, end_date, freq=freq)
     if remove_months and ('A' not in freq):
-        mon1 = np.arange(row['from_month'], 13)
-        mon2 = np.arange(1, row['to_month'] + 1)
-        in_mons = np.concatenate((mon1, mon2))
-        dates1 = dates1[dates1.month.isin(in_mons)]
+        dates1 = dates1[season_mask(dates1.month.values, row.get('from_month'), row.get('to_month'))]
 
     if dates1.empty:
         return None
@@ -80,7 +109,92 @@ def allo_ts_apply(row, from_date, to_date, freq, limit_col, remove_months=False)
     return vols
 
 
-def allo_ts(permits, from_date, to_date, freq, limit_col, remove_months=False):
+def _allo_ts_vector(permits, from_date, to_date, freq, limit_col, remove_months=False):
+    """
+    Array version of allo_ts_apply for all of the permits at once. The [from_date, to_date] interval of every permit is expanded against a single shared grid of period end dates, and the pro-rata ratios of the first and last periods are calculated on the expanded arrays. The results are the same as stacking the allo_ts_apply results (including dropping the NaN values).
+    """
+    if permits.empty:
+        return pd.Series([], index=pd.MultiIndex.from_arrays([[], [], pd.DatetimeIndex([])], names=['permit_id', 'hydro_feature', 'date']), name='allo', dtype='float64')
+
+    start0 = pd.Timestamp(from_date)
+    end0 = pd.Timestamp(to_date)
+
+    crc_from_date = pd.to_datetime(permits['from_date']).values
+    crc_to_date = pd.to_datetime(permits['to_date']).values
+
+    start = pd.DatetimeIndex(np.where(crc_from_date > start0.to_datetime64(), crc_from_date, start0.to_datetime64()))
+    end = pd.DatetimeIndex(np.where(crc_to_date < end0.to_datetime64(), crc_to_date, end0.to_datetime64()))
+
+    ## Expand the permits against the shared period grid (up to the period that contains the end)
+    cal = get_calendar(freq, from_date, to_date)
+    grid = cal.dates
+
+    i_start = grid.searchsorted(start, side='left')
+    i_end = cal.locate(end) + 1
+    n_periods = np.clip(i_end - i_start, 0, None)
+
+    rows = np.repeat(np.arange(len(permits)), n_periods)
+    pos = np.arange(len(rows)) - np.repeat(np.cumsum(n_periods) - n_periods, n_periods) + np.repeat(i_start, n_periods)
+
+    if remove_months and ('A' not in freq) and ('from_month' in permits) and ('to_month' in permits):
+        keep = season_mask(cal.months[pos], permits['from_month'].values[rows], permits['to_month'].values[rows])
+        rows = rows[keep]
+        pos = pos[keep]
+
+    ## Days in each period
+    val1 = cal.n_days[pos]
+
+    limit = permits[limit_col].values.astype('float64')[rows]
+
+    if freq in ['A-JUN', 'D', 'W']:
+        vol1 = limit
+    elif 'M' in freq:
+        vol1 = val1/365 * limit
+    else:
+        raise ValueError("freq must be either 'A-JUN', 'M', 'W', or 'D'")
+
+    ## Pro-rata the first and last periods of each permit
+    alt_dates = val1.copy()
+
+    if len(rows) > 0:
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = rows[1:] != rows[:-1]
+        last = np.ones(len(rows), dtype=bool)
+        last[:-1] = rows[1:] != rows[:-1]
+        single = first & last
+
+        dates_i8 = grid.asi8[pos]
+        start_days = (dates_i8 - start.asi8[rows]) // day_ns
+        end_days = (dates_i8 - end.asi8[rows]) // day_ns
+
+        alt_dates[single] = val1[single] - end_days[single] - (val1[single] - start_days[single])
+
+        start_diff = start_days + 1
+        first_bool = first & ~single & (start_diff < val1)
+        alt_dates[first_bool] = start_diff[first_bool]
+
+        end_diff = val1 - end_days
+        last_bool = last & ~single & (end_diff < val1)
+        alt_dates[last_bool] = end_diff[last_bool]
+
+    ratio_days = alt_dates/val1
+
+    vols = ratio_days * vol1
+
+    ## Build the index from the codes of the permits and the grid
+    bool1 = ~np.isnan(vols)
+    rows = rows[bool1]
+
+    permit_codes, permit_ids = pd.factorize(permits['permit_id'])
+    feature_codes, features = pd.factorize(permits['hydro_feature'])
+
+    index = pd.MultiIndex(levels=[permit_ids, features, grid], codes=[permit_codes[rows], feature_codes[rows], pos[bool1]], names=['permit_id', 'hydro_feature', 'date'], verify_integrity=False)
+    permits4 = pd.Series(vols[bool1], index=index, name='allo')
+
+    return permits4
+
+
+def allo_ts(permits, from_date, to_date, freq, limit_col, remove_months=False, engine='vector'):
     """
     Combo function to completely create a time series from the allocation DataFrame. Source data must be from an instance of the Hydro db.
 
@@ -97,9 +211,11 @@ def allo_ts(permits, from_date, to_date, freq, limit_col, remove_months=False):
     restr_type : str
         The allocation rate/volume used as the values in the time series. Must be 'max rate', 'daily volume', or 'annual volume'.
     remove_months : bool
-        Should the months that are defined in the consent only be returned?
+        Should the months that are defined in the consent only be returned? The seasons are defined by the from_month and to_month columns of the permits (see season_mask). Permits without them are allocated in all months.
     in_allo : bool
         Should the consumptive consents be returned?
+    engine : str
+        Either 'vector' to expand all of the permits at once with arrays, or 'apply' to run allo_ts_apply on each permit. Both return the same results.
 
     Returns
     -------
@@ -108,6 +224,11 @@ def allo_ts(permits, from_date, to_date, freq, limit_col, remove_months=False):
     if freq not in freq_codes:
         raise ValueError('freq must be one of ' + str(freq_codes))
 
+    if engine == 'vector':
+        return _allo_ts_vector(permits, from_date, to_date, freq, limit_col, remove_months)
+    elif engine != 'apply':
+        raise ValueError("engine must be either 'vector' or 'apply'")
+
     permits2 = permits.set_index(['permit_id', 'hydro_feature']).copy()
 
     permits3 = permits2.apply(allo_ts_apply, axis=1, from_date=from_date, to_date=to_date, freq=freq, limit_col=limit_col, remove_months=remove_months)
@@ -119,6 +240,429 @@ def allo_ts(permits, from_date, to_date, freq, limit_col, remove_months=False):
     return permits4
 
 
+###################################
+### Classes
+
+
+def _mean_overlaps(intervals, by, value_cols):
+    """
+    Function to divide the rates of the intervals of each group by the number of intervals of the group that are active on the same days, so that their sum is the mean of the group. The intervals are split where that number changes.
+    """
+    new_list = []
+    for _, grp in intervals.groupby(by, observed=True, sort=False):
+        bounds = np.unique(np.concatenate([grp['start'].values, grp['end'].values + 1]))
+        seg_start = bounds[:-1]
+        seg_end = bounds[1:] - 1
+
+        active = (grp['start'].values[:, None] <= seg_start[None, :]) & (grp['end'].values[:, None] >= seg_end[None, :])
+        n_active = active.sum(axis=0)
+        row_pos, seg_pos = np.nonzero(active)
+
+        grp1 = grp.iloc[row_pos].copy()
+        grp1['start'] = seg_start[seg_pos]
+        grp1['end'] = seg_end[seg_pos]
+        for col in value_cols:
+            grp1[col] = grp1[col].values / n_active[seg_pos]
+
+        new_list.append(grp1)
+
+    return pd.concat(new_list, ignore_index=True)
+
+
+class AlloIntervals(object):
+    """
+    Sparse representation of the allocation as piecewise-constant daily rates. Each row of the intervals table is a permit (or permit/wap) with an inclusive start and end day and the daily rates of the value columns. Totals per group and period are calculated from prefix sums over the interval boundaries, so the memory and time only scale with the number of intervals and the number of output rows (not with the number of permits times the number of days).
+
+    Parameters
+    ----------
+    permits : DataFrame
+        The permits table with the columns permit_id, hydro_feature, from_date, to_date, and the limit_col.
+    from_date : str or Timestamp
+        The start date of the allocation.
+    to_date : str or Timestamp
+        The end date of the allocation.
+    limit_col : str
+        The limit column used for the rates. Must be either 'max_daily_volume' or 'max_annual_volume'. The annual volume is spread evenly over 365 days.
+    extra_cols : list of str or None
+        Other columns of the permits table that should be kept in the intervals table for grouping (e.g. use_type).
+    """
+    def __init__(self, permits, from_date, to_date, limit_col, extra_cols=None):
+        """
+
+        """
+        if limit_col not in limit_days:
+            raise ValueError('limit_col must be one of ' + str(list(limit_days.keys())))
+
+        cols = ['permit_id', 'hydro_feature']
+        if extra_cols is not None:
+            cols.extend([c for c in extra_cols if c not in cols])
+
+        start0 = pd.Timestamp(from_date).floor('D').value // day_ns
+        end0 = pd.Timestamp(to_date).floor('D').value // day_ns
+
+        crc_from_date = pd.to_datetime(permits['from_date']).values.astype('datetime64[D]').astype('int64')
+        crc_to_date = pd.to_datetime(permits['to_date']).values.astype('datetime64[D]').astype('int64')
+
+        nat_bool = pd.isnull(permits['from_date']).values
+        crc_from_date[nat_bool] = start0
+        nat_bool = pd.isnull(permits['to_date']).values
+        crc_to_date[nat_bool] = end0
+
+        intervals = permits[cols].copy()
+        intervals['start'] = np.maximum(crc_from_date, start0)
+        intervals['end'] = np.minimum(crc_to_date, end0)
+        intervals['total_allo'] = permits[limit_col].values.astype('float64') / limit_days[limit_col]
+
+        intervals = intervals[(intervals['end'] >= intervals['start']) & intervals['total_allo'].notnull()].reset_index(drop=True)
+
+        self.intervals = intervals
+        self.value_cols = ['total_allo']
+        self.from_date = pd.Timestamp(from_date)
+        self.to_date = pd.Timestamp(to_date)
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def split_waps(self, waps):
+        """
+        Function to split the permit allocation evenly between the waps of each permit and into the surface water and groundwater components (in the same way as AlloUsage._allo_wap_spit). When a permit has more than one row in the permits table (e.g. one per hydro_feature), the allocation of its waps on each day is the mean of its rows that are active on that day (as in the wap_allo_ts of AlloUsage); the rows are kept separately (e.g. for grouping by hydro_feature) with rates that sum to the mean.
+
+        Parameters
+        ----------
+        waps : DataFrame
+            The waps table with the columns permit_id, wap, and sd_ratio.
+
+        Returns
+        -------
+        AlloIntervals
+        """
+        waps1 = waps[['permit_id', 'wap', 'sd_ratio']].copy()
+        waps1['n_waps'] = waps1.groupby('permit_id', observed=True)['wap'].transform('count')
+
+        intervals = pd.merge(self.intervals, waps1, on='permit_id')
+        intervals['total_allo'] = intervals['total_allo'] / intervals['n_waps']
+
+        intervals.loc[intervals.sd_ratio.isnull() & (intervals.hydro_feature == 'groundwater'), 'sd_ratio'] = 0
+        intervals.loc[intervals.sd_ratio.isnull() & (intervals.hydro_feature == 'surface water'), 'sd_ratio'] = 1
+
+        intervals['sw_allo'] = intervals['total_allo'] * intervals['sd_ratio']
+        intervals['gw_allo'] = intervals['total_allo']
+        intervals.loc[intervals['hydro_feature'] == 'surface water', 'gw_allo'] = 0
+
+        value_cols = ['total_allo', 'sw_allo', 'gw_allo']
+        intervals = intervals.drop(['n_waps', 'sd_ratio'], axis=1)
+
+        ## The permit/waps with more than one row (e.g. a permit with both hydro_features) get the mean of their rows on each day
+        dup_bool = intervals.duplicated(['permit_id', 'wap'], keep=False)
+        if dup_bool.any():
+            intervals = pd.concat([intervals[~dup_bool], _mean_overlaps(intervals[dup_bool], ['permit_id', 'wap'], value_cols)], ignore_index=True)
+
+        new1 = copy.copy(self)
+        new1.intervals = intervals
+        new1.value_cols = value_cols
+
+        return new1
+
+    def aggregate(self, freq, groupby=None, from_date=None, to_date=None):
+        """
+        Function to calculate the total allocation per group and period. Only the periods that overlap at least one interval of a group are returned.
+
+        Parameters
+        ----------
+        freq : str
+            Pandas frequency str. Must be 'D', 'W', 'M', or 'A-JUN'. The partial first and last periods are pro-rated by day.
+        groupby : list of str or None
+            The columns of the intervals table to group by. None will sum all intervals into a single time series.
+        from_date : str, Timestamp, or None
+            The start of the output. None will use the from_date of the object.
+        to_date : str, Timestamp, or None
+            The end of the output. None will use the to_date of the object.
+
+        Returns
+        -------
+        DataFrame
+            indexed by the groupby and date with the value columns
+        """
+        if freq not in freq_codes:
+            raise ValueError('freq must be one of ' + str(freq_codes))
+
+        if from_date is None:
+            from_date = self.from_date
+        if to_date is None:
+            to_date = self.to_date
+
+        if groupby is None:
+            groupby = []
+
+        cal = get_calendar(freq, from_date, to_date)
+        dates = cal.dates
+        lo = pd.Timestamp(from_date).floor('D').value // day_ns
+        hi = pd.Timestamp(to_date).floor('D').value // day_ns
+        first_days = np.maximum(cal.first_days, lo)
+        last_days = np.minimum(cal.last_days, hi)
+
+        intervals = self.intervals
+
+        if intervals.empty or (len(dates) == 0):
+            empty1 = pd.DataFrame(columns=groupby + ['date'] + self.value_cols).astype({c: 'float64' for c in self.value_cols})
+            empty1['date'] = pd.to_datetime(empty1['date'])
+            return empty1.set_index(groupby + ['date'])
+
+        starts = intervals['start'].values
+        ends = intervals['end'].values
+
+        ## Group codes
+        if groupby:
+            grp_codes, grp_index = pd.MultiIndex.from_frame(intervals[groupby]).factorize()
+            n_grps = len(grp_index)
+        else:
+            grp_codes = np.zeros(len(intervals), dtype='int64')
+            n_grps = 1
+
+        ## The days are made relative to base and offset by group so that a single sorted key covers all groups
+        base = min(lo, starts.min()) - 1
+        span = max(hi, ends.max()) - base + 2
+
+        ## Sort the interval boundaries by group and day (the closing boundary is the day after the end)
+        ev_grp = np.concatenate([grp_codes, grp_codes])
+        ev_day = np.concatenate([starts, ends + 1]) - base
+        ev_key = ev_grp * span + ev_day
+        order = np.argsort(ev_key, kind='stable')
+        ev_key = ev_key[order]
+        ev_day = ev_day[order]
+        ev_grp = ev_grp[order]
+
+        grp_first = np.searchsorted(ev_key, np.arange(n_grps) * span, side='left')
+        grp_prev = np.maximum(grp_first - 1, 0)
+        gaps = np.diff(ev_day, append=ev_day[-1])
+
+        ## Queries for the first day and the day after the last day of the periods within the span of each group
+        grp_start = np.full(n_grps, np.iinfo('int64').max)
+        np.minimum.at(grp_start, grp_codes, starts)
+        grp_end = np.full(n_grps, np.iinfo('int64').min)
+        np.maximum.at(grp_end, grp_codes, ends)
+
+        p_start = np.searchsorted(last_days, grp_start, side='left')
+        p_end = np.searchsorted(first_days, grp_end, side='right')
+        n_queries = np.clip(p_end - p_start, 0, None)
+
+        q_grp = np.repeat(np.arange(n_grps), n_queries)
+        q_pos = np.arange(len(q_grp)) - np.repeat(np.cumsum(n_queries) - n_queries, n_queries) + np.repeat(p_start, n_queries)
+        q_first = first_days[q_pos] - base
+        q_next = last_days[q_pos] - base + 1
+
+        ## Number of active intervals in each group and period
+        start_keys = np.sort(grp_codes * span + (starts - base))
+        end_keys = np.sort(grp_codes * span + (ends - base))
+        n_active = np.searchsorted(start_keys, q_grp * span + q_next, side='left') - np.searchsorted(end_keys, q_grp * span + q_first, side='left')
+        active = (n_active > 0) & (q_next > q_first)
+
+        def cum_volume(rates):
+            """
+            The volumes of the groups and periods as the differences of the cumulative volumes (the volume of all of the days before a day) at the period boundaries.
+            """
+            ## Rates after each boundary and the volumes up to each boundary within each group
+            rate_after = np.cumsum(np.concatenate([rates, -rates])[order])
+            rate_after = rate_after - np.where(grp_first > 0, rate_after[grp_prev], 0)[ev_grp]
+
+            vol_after = np.cumsum(rate_after * gaps)
+            vol_at = vol_after - rate_after * gaps
+            vol_at = vol_at - np.where(grp_first > 0, vol_after[grp_prev], 0)[ev_grp]
+
+            def volume(q_day):
+                idx = np.searchsorted(ev_key, q_grp * span + q_day, side='right') - 1
+                idx1 = np.maximum(idx, 0)
+                vol = vol_at[idx1] + rate_after[idx1] * (q_day - ev_day[idx1])
+
+                return np.where(idx >= grp_first[q_grp], vol, 0)
+
+            return volume(q_next) - volume(q_first)
+
+        data = {col: cum_volume(intervals[col].values.astype('float64'))[active] for col in self.value_cols}
+
+        if groupby:
+            grp_index1 = grp_index.take(q_grp[active])
+            index = pd.MultiIndex.from_arrays([grp_index1.get_level_values(i) for i in range(len(groupby))] + [dates[q_pos[active]]], names=groupby + ['date'])
+        else:
+            index = pd.DatetimeIndex(dates[q_pos[active]], name='date')
+
+        return pd.DataFrame(data, index=index).sort_index()
+
+
+class AlloView(object):
+    """
+    Lazy view of the allocation time series of permits (in the structure of AlloUsage.total_allo_ts). The view only records the permits and the date window, and the allocation is created when it's consumed with to_frame, iteration, or aggregate. Materialised slices are cached and shared between a view and all of the views selected from it.
+
+    Parameters
+    ----------
+    permits : DataFrame
+        The permits table.
+    from_date : str or Timestamp
+        The start date of the allocation.
+    to_date : str or Timestamp
+        The end date of the allocation.
+    freq : str
+        Pandas frequency str. Must be 'D', 'W', 'M', or 'A-JUN'.
+    limit_col : str
+        The limit column of the permits used for the allocation.
+    remove_months : bool
+        Should the allocation only be in the seasons of the permits?
+    chunk_size : int
+        The number of permits per DataFrame when iterating over the view.
+    """
+    def __init__(self, permits, from_date, to_date, freq, limit_col, remove_months=False, chunk_size=1000):
+        """
+
+        """
+        if freq not in freq_codes:
+            raise ValueError('freq must be one of ' + str(freq_codes))
+
+        self.permits = permits
+        self.freq = freq
+        self.limit_col = limit_col
+        self.remove_months = remove_months
+        self.chunk_size = chunk_size
+        self.from_date = pd.Timestamp(from_date)
+        self.to_date = pd.Timestamp(to_date)
+
+        ## The dates of the full allocation (for the pro-rating of the partial periods)
+        self._base_dates = (self.from_date, self.to_date)
+        self._cache = {}
+        self._permits_hash = None
+
+    def __len__(self):
+        return len(self.permits)
+
+    def __repr__(self):
+        return '<AlloView: {n} permits, {freq} from {f} to {t}>'.format(n=len(self.permits), freq=self.freq, f=self.from_date.date(), t=self.to_date.date())
+
+    def select(self, permit_filter=None, from_date=None, to_date=None):
+        """
+        Function to create a view of a subset of the permits and/or a shorter date window. Nothing is calculated.
+
+        Parameters
+        ----------
+        permit_filter : dict or None
+            The keys should be the column names of the permits table and the values should be the list of values to keep on those columns.
+        from_date : str, Timestamp, or None
+            The start date of the view. None will keep the start date of this view.
+        to_date : str, Timestamp, or None
+            The end date of the view. None will keep the end date of this view.
+
+        Returns
+        -------
+        AlloView
+        """
+        permits1 = self.permits
+        if isinstance(permit_filter, dict):
+            for col, values in permit_filter.items():
+                permits1 = permits1[permits1[col].isin(values)]
+
+        new1 = copy.copy(self)
+        new1.permits = permits1
+        new1._permits_hash = None
+        if from_date is not None:
+            new1.from_date = max(pd.Timestamp(from_date), self._base_dates[0])
+        if to_date is not None:
+            new1.to_date = min(pd.Timestamp(to_date), self._base_dates[1])
+
+        return new1
+
+    def _key(self):
+        """
+        Function to get the key of the view in the cache from a hash of its rows of the permits table (the index, permit_id, and hydro_feature, created once per view) and its dates. A permit can have a row per hydro_feature, so the permit ids alone don't identify the rows.
+        """
+        if self._permits_hash is None:
+            cols = [c for c in ['permit_id', 'hydro_feature'] if c in self.permits]
+            hashes = pd.util.hash_pandas_object(self.permits[cols].astype(object), index=True).values
+            self._permits_hash = hashlib.blake2b(hashes.tobytes(), digest_size=16).hexdigest()
+
+        return (self._permits_hash, self.from_date, self.to_date)
+
+    def _materialise(self, permits):
+        """
+        Function to create the allocation of permits within the window of the view. The allocation is calculated with an extra period on both sides of the window so that the pro-rating of the periods at the ends of the view is the same as in the full allocation.
+        """
+        cal = get_calendar(self.freq, *self._base_dates)
+        pos = cal.locate([self.from_date, self.to_date])
+        i_from = max(pos[0] - 1, 0)
+        i_to = min(pos[1] + 1, len(cal) - 1)
+
+        ## allo_ts excludes the to_date itself
+        from_date = max(pd.Timestamp(cal.first_days[i_from] * day_ns), self._base_dates[0])
+        to_date = min(pd.Timestamp((cal.last_days[i_to] + 1) * day_ns), self._base_dates[1])
+
+        allo1 = allo_ts(permits, from_date, to_date, self.freq, self.limit_col, self.remove_months).round()
+        allo1.name = 'total_allo'
+        allo1 = allo1.reset_index()
+
+        dates = allo1['date']
+        allo1 = allo1[(dates >= cal.dates[pos[0]]) & (dates <= cal.dates[pos[1]])].reset_index(drop=True)
+
+        return allo1
+
+    def to_frame(self, cache=True):
+        """
+        Function to materialise the view. The result is cached, so it shouldn't be modified in place.
+
+        Parameters
+        ----------
+        cache : bool
+            Should the result be cached? False will also remove the result of the view from the cache if it's there (e.g. when the caller keeps its own copy).
+
+        Returns
+        -------
+        DataFrame
+            with the columns permit_id, hydro_feature, date, and total_allo
+        """
+        key = self._key()
+        if not cache:
+            allo1 = self._cache.pop(key, None)
+            if allo1 is None:
+                allo1 = self._materialise(self.permits)
+
+            return allo1
+
+        allo1 = self._cache.get(key)
+        if allo1 is None:
+            allo1 = self._materialise(self.permits)
+            self._cache[key] = allo1
+
+        return allo1
+
+    def __iter__(self):
+        """
+        Iterate over the materialised allocation in DataFrames of chunk_size permits. The chunks are not cached.
+        """
+        key = self._key()
+        if key in self._cache:
+            yield self._cache[key]
+        else:
+            for i in range(0, len(self.permits), self.chunk_size):
+                allo1 = self._materialise(self.permits.iloc[i:(i + self.chunk_size)])
+                if not allo1.empty:
+                    yield allo1
+
+    def aggregate(self, groupby=None):
+        """
+        Function to sum the allocation of the view by date and other columns of the permits table.
+
+        Parameters
+        ----------
+        groupby : list of str or None
+            The columns of the permits table to group by (e.g. use_type). None will sum all permits.
 
+        Returns
+        -------
+        Series
+            indexed by the groupby and date
+        """
+        if groupby is None:
+            groupby = []
 
+        allo1 = self.to_frame()
+        extra_cols = [c for c in groupby if c not in allo1.columns]
+        if extra_cols:
+            allo1 = pd.merge(allo1, self.permits[['permit_id'] + extra_cols].drop_duplicates('permit_id'), on='permit_id')
 
+        return allo1.groupby(groupby + ['date'], observed=True)['total_allo'].sum()
@@ -4,7 +4,9 @@ Created on Sat Feb 16 09:50:42 2019
 
 @author: michaelek
 """
-import os
+import copy
+import threading
+from multiprocessing import get_context
 import numpy as np
 import pandas as pd
 # import yaml
@@ -19,14 +21,17 @@ from gistools import vector
 # from scipy.special import erfc
 # import tethysts
 
-from allotools.data_io import get_usage_data, allo_filter
+from allotools.data_io import iter_wap_usage, iter_usage_data, allo_filter, read_usage_state, write_usage_state, path_fingerprint, cache_key, in_cache, read_cache, write_cache
 # from data_io import get_usage_data, allo_filter
 
-from allotools.allocation_ts import allo_ts
-# from allocation_ts import allo_ts
+from allotools.allocation_ts import AlloIntervals, AlloView
+# from allocation_ts import AlloIntervals, AlloView
 
-from allotools.utils import grp_ts_agg
-# from utils import grp_ts_agg
+from allotools.utils import grp_ts_agg, grp_sum, get_calendar, run_graph, graph_nodes, find_neighbours, interp_daily, connected_shards
+# from utils import grp_ts_agg, grp_sum, get_calendar, run_graph, graph_nodes, find_neighbours, interp_daily, connected_shards
+
+from allotools.stream_depletion import calc_sd_lags, calc_sd_ratios
+# from stream_depletion import calc_sd_lags, calc_sd_ratios
 
 
 # from matplotlib.pyplot import show
@@ -41,6 +46,33 @@ from allotools.utils import grp_ts_agg
 
 pk = ['permit_id', 'wap', 'date']
 dataset_types = ['allo', 'metered_allo',  'usage', 'usage_est', 'sd_rates']
+compact_freqs = ['D', 'W']
+usage_prefetch = 64
+sd_chunk_size = 20
+sd_engines = ['convolve', 'sd']
+shard_copies = 4
+shard_datasets = ['allo', 'metered_allo', 'usage']
+stage_outputs = {'_est_allo_ts': ['total_allo_ts'],
+                 '_allo_wap_spit': ['wap_allo_ts'],
+                 '_get_usage': ['usage_ts_daily', 'usage_ts_daily_qa'],
+                 '_agg_usage': ['usage_ts', 'usage_ts_daily_qa'],
+                 '_split_usage_ts': ['split_usage_ts', 'split_usage_ts_qa'],
+                 '_get_metered_allo_ts': ['proportion_allo', 'metered_allo_ts'],
+                 '_usage_estimation': ['usage_est'],
+                 '_calc_sd_rates': ['sd_rates_daily'],
+                 '_agg_sd_rates': ['sd_rates']}
+stage_inputs = {'_est_allo_ts': [],
+                '_allo_wap_spit': ['_est_allo_ts'],
+                '_get_usage': [],
+                '_agg_usage': ['_get_usage'],
+                '_split_usage_ts': ['_agg_usage', '_allo_wap_spit'],
+                '_get_metered_allo_ts': ['_allo_wap_spit', '_split_usage_ts'],
+                '_usage_estimation': ['_split_usage_ts'],
+                '_calc_sd_rates': [],
+                '_agg_sd_rates': ['_calc_sd_rates']}
+cache_stages = ['_allo_wap_spit', '_get_usage', '_split_usage_ts', '_usage_estimation', '_calc_sd_rates']
+shard_stage_cols = {'_est_allo_ts': 2, '_allo_wap_spit': 3, '_get_usage': 2, '_agg_usage': 1, '_split_usage_ts': 4, '_get_metered_allo_ts': 3}
+dataset_stages = {'allo': '_allo_wap_spit', 'metered_allo': '_get_metered_allo_ts', 'usage': '_split_usage_ts', 'usage_est': '_usage_estimation', 'sd_rates': '_agg_sd_rates'}
 allo_type_dict = {'D': 'max_daily_volume', 'W': 'max_daily_volume', 'M': 'max_annual_volume', 'A-JUN': 'max_annual_volume', 'A': 'max_annual_volume'}
 # allo_mult_dict = {'D': 0.001*24*60*60, 'W': 0.001*24*60*60*7, 'M': 0.001*24*60*60*30, 'A-JUN': 0.001*24*60*60*365, 'A': 0.001*24*60*60*365}
 
@@ -105,6 +137,35 @@ allo_type_dict = {'D': 'max_daily_volume', 'W': 'max_daily_volume', 'M': 'max_an
 
 #     return wu1
 
+########################################
+### Functions
+
+
+def _calc_sd_lags(tasks):
+    """
+    Function to calculate the stream depletion rates of a chunk of GW waps from their usage (in a separate process when processes > 1). The tasks are tuples of (permit_id, wap, aquifer parameters, method, usage Series).
+    """
+    sd = SD()
+
+    sd_list = []
+    for permit_id, wap, params, method, use1 in tasks:
+        avail = sd.load_aquifer_data(**params)
+
+        if method in avail:
+            sd_rates1 = sd.calc_sd_extraction(use1, method)
+        else:
+            sd_rates1 = sd.calc_sd_extraction(use1)
+
+        sd_rates1.name = 'sd_rate'
+
+        sd_rates1 = sd_rates1.reset_index()
+        sd_rates1['permit_id'] = permit_id
+        sd_rates1['wap'] = wap
+
+        sd_list.append(sd_rates1)
+
+    return sd_list
+
 ########################################
 ### Core class
 
@@ -118,7 +179,7 @@ class AlloUsage(object):
     permits_path : str or pathlib.Path
         Path to booklet file structured according to the nzpermits package.
     usage_path : str or pathlib.Path
-        Path to booklet file structured with the keys as wap/station id as pandas dataframes with the columns 'time' and {station_id}.
+        Path to booklet file structured with the keys as wap/station id as pandas dataframes with the columns 'time' and {station_id}, or a path to a usage cube created by data_io.build_usage_cube.
     from_date : str or None
         The start date of the consent and the final time series. In the form of '2000-01-01'. None will return all consents and subsequently all dates.
     to_date : str or None
@@ -135,6 +196,26 @@ class AlloUsage(object):
         Dict mapping of the detailed use types to more generic use types. This is used during the usage estimation process and can be mapped to most anything. The the fewer the use types the better.
     default_sd_ratio : float
         The default stream depletion ratio if no GW aquifer data is supplied AT ALL.
+    threads : int
+        The number of threads used to read the usage data from the usage booklet.
+    stage_threads : int
+        The number of threads used to run the independent stages of get_ts (e.g. the allocation and the usage) concurrently.
+    usage_batch_size : int or None
+        The number of waps per batch when reading and aggregating the usage data. If an int is passed, the usage data is streamed in batches and aggregated incrementally so that the full daily usage is never held in memory (usage_ts_daily is then not kept and usage_ts_daily_qa only contains the flagged values). None will read all of the usage data at once.
+    permits_index_path : str, pathlib.Path, or None
+        Path to a permits sidecar file created by data_io.build_permit_index. None will look for it next to the permits booklet. The permits booklet will be parsed if a valid sidecar can't be found.
+    usage_state_path : str, pathlib.Path, or None
+        Path to a usage state booklet used for incremental usage processing. If a path is passed, the aggregated usage and the last processed date (watermark) of each wap are stored per usage booklet and time frequency, and subsequent runs only read, QA-check, and aggregate the daily usage after the watermarks before merging it into the stored aggregates. Usage changed on or before a watermark will not be picked up; delete the state file to reprocess everything. usage_ts_daily is not kept and usage_ts_daily_qa only contains the flagged values. None will process all of the usage data on every run.
+    compact : bool
+        Should the compact data types be used? If True, the permit_id and wap columns of all of the tables on the object are converted to categoricals that share the same categories, the daily and weekly volumes are stored as float32, and the quality codes as int8. This substantially reduces the memory of the large time series at the cost of float32 precision (about 7 significant digits) in the daily and weekly results. Default False.
+    cache_path : str, pathlib.Path, or None
+        Path to a cache folder for the results of the slow processing stages (the wap allocation, the daily usage, the split usage, the usage estimate, and the daily SD rates). The entries are keyed by the fingerprints (paths, sizes, and modification times) of the permits and usage files, the filter arguments, and the parameters of the stage, so later runs (in other python processes) with the same inputs load the stages instead of recalculating them. None will not cache to disk.
+    cache_size : int
+        The max total size of the cache folder in bytes. The least recently used entries are removed when it gets larger.
+    sd_engine : str
+        The engine used to calculate the stream depletion of the GW takes when est_gw_sd_lags is True. Either 'convolve' to convolve the usage of the waps in batches with unit responses that are shared by the waps with the same aquifer parameters (see stream_depletion.calc_sd_lags), or 'sd' to run SD.calc_sd_extraction of nz_stream_depletion on each wap. The results are the same within floating point precision.
+    processes : int
+        The number of processes used to calculate the stream depletion of the GW takes with the 'sd' sd_engine. The waps are sent to the processes in chunks of sd_chunk_size and the progress is printed as the chunks finish. The processes are started with spawn instead of fork when the stage runs outside of the main thread (e.g. with stage_threads > 1).
 
     Returns
     -------
@@ -150,14 +231,14 @@ class AlloUsage(object):
     # _permit_remote = param['remote']['permit']
 
     ### Initial import and assignment function
-    def __init__(self, permits_path, usage_path, from_date=None, to_date=None, permit_filter=None, wap_filter=None, only_consumptive=True, include_hydroelectric=False, use_type_mapping={}, default_sd_ratio=0.35):
+    def __init__(self, permits_path, usage_path, from_date=None, to_date=None, permit_filter=None, wap_filter=None, only_consumptive=True, include_hydroelectric=False, use_type_mapping={}, default_sd_ratio=0.35, threads=1, stage_threads=1, usage_batch_size=None, permits_index_path=None, usage_state_path=None, compact=False, cache_path=None, cache_size=2**30, sd_engine='convolve', processes=1):
         """
         Parameters
         ----------
         permits_path : str or pathlib.Path
             Path to booklet file structured according to the nzpermits package/model.
         usage_path : str or pathlib.Path
-            Path to booklet file structured with the keys as wap/station id as pandas dataframes with the columns 'time' and {station_id}.
+            Path to booklet file structured with the keys as wap/station id as pandas dataframes with the columns 'time' and {station_id}, or a path to a usage cube created by data_io.build_usage_cube.
         from_date : str or None
             The start date of the consent and the final time series. In the form of '2000-01-01'. None will return all consents and subsequently all dates.
         to_date : str or None
@@ -174,6 +255,26 @@ class AlloUsage(object):
             Dict mapping of the detailed use types to more generic use types. This is used during the usage estimation process and can be mapped to most anything. The the fewer the use types the better.
         default_sd_ratio : float
             The default stream depletion ratio if no GW aquifer data is supplied AT ALL.
+        threads : int
+            The number of threads used to read the usage data from the usage booklet.
+        stage_threads : int
+            The number of threads used to run the independent stages of get_ts (e.g. the allocation and the usage) concurrently.
+        usage_batch_size : int or None
+            The number of waps per batch when reading and aggregating the usage data. If an int is passed, the usage data is streamed in batches and aggregated incrementally so that the full daily usage is never held in memory (usage_ts_daily is then not kept and usage_ts_daily_qa only contains the flagged values). None will read all of the usage data at once.
+        permits_index_path : str, pathlib.Path, or None
+            Path to a permits sidecar file created by data_io.build_permit_index. None will look for it next to the permits booklet. The permits booklet will be parsed if a valid sidecar can't be found.
+        usage_state_path : str, pathlib.Path, or None
+            Path to a usage state booklet used for incremental usage processing. If a path is passed, the aggregated usage and the last processed date (watermark) of each wap are stored per usage booklet and time frequency, and subsequent runs only read, QA-check, and aggregate the daily usage after the watermarks before merging it into the stored aggregates. Usage changed on or before a watermark will not be picked up; delete the state file to reprocess everything. usage_ts_daily is not kept and usage_ts_daily_qa only contains the flagged values. None will process all of the usage data on every run.
+        compact : bool
+            Should the compact data types be used? If True, the permit_id and wap columns of all of the tables on the object are converted to categoricals that share the same categories, the daily and weekly volumes are stored as float32, and the quality codes as int8. This substantially reduces the memory of the large time series at the cost of float32 precision (about 7 significant digits) in the daily and weekly results. Default False.
+        cache_path : str, pathlib.Path, or None
+            Path to a cache folder for the results of the slow processing stages (the wap allocation, the daily usage, the split usage, the usage estimate, and the daily SD rates). The entries are keyed by the fingerprints (paths, sizes, and modification times) of the permits and usage files, the filter arguments, and the parameters of the stage, so later runs (in other python processes) with the same inputs load the stages instead of recalculating them. None will not cache to disk.
+        cache_size : int
+            The max total size of the cache folder in bytes. The least recently used entries are removed when it gets larger.
+        sd_engine : str
+            The engine used to calculate the stream depletion of the GW takes when est_gw_sd_lags is True. Either 'convolve' to convolve the usage of the waps in batches with unit responses that are shared by the waps with the same aquifer parameters (see stream_depletion.calc_sd_lags), or 'sd' to run SD.calc_sd_extraction of nz_stream_depletion on each wap. The results are the same within floating point precision.
+        processes : int
+            The number of processes used to calculate the stream depletion of the GW takes with the 'sd' sd_engine. The waps are sent to the processes in chunks of sd_chunk_size and the progress is printed as the chunks finish. The processes are started with spawn instead of fork when the stage runs outside of the main thread (e.g. with stage_threads > 1).
 
         Returns
         -------
@@ -183,14 +284,27 @@ class AlloUsage(object):
         """
         self.usage_path = usage_path
         self.default_sd_ratio = default_sd_ratio
-
-        self.process_permits(permits_path, from_date, to_date, permit_filter, wap_filter, only_consumptive, include_hydroelectric, use_type_mapping)
+        self.threads = threads
+        self.stage_threads = stage_threads
+        self.usage_batch_size = usage_batch_size
+        self.usage_state_path = usage_state_path
+        self.compact = compact
+        self.cache_path = cache_path
+        self.cache_size = cache_size
+        if sd_engine not in sd_engines:
+            raise ValueError('sd_engine must be one of ' + str(sd_engines))
+
+        self.sd_engine = sd_engine
+        self.processes = processes
+        self._qa_dtype = 'int8' if compact else 'int16'
+
+        self.process_permits(permits_path, from_date, to_date, permit_filter, wap_filter, only_consumptive, include_hydroelectric, use_type_mapping, permits_index_path)
 
         ## Recalculate the ratios
         # self._calc_sd_ratios()
 
 
-    def process_permits(self, permits_path, from_date=None, to_date=None, permit_filter=None, wap_filter=None, only_consumptive=True, include_hydroelectric=False, use_type_mapping={}):
+    def process_permits(self, permits_path, from_date=None, to_date=None, permit_filter=None, wap_filter=None, only_consumptive=True, include_hydroelectric=False, use_type_mapping={}, permits_index_path=None):
         """
         Parameters
         ----------
@@ -206,6 +320,10 @@ class AlloUsage(object):
             Should only the consumptive takes be returned? Default True
         include_hydroelectric : bool
             Should hydro-electric takes be included? Default False
+        use_type_mapping : dict
+            Dict mapping of the detailed use types to more generic use types.
+        permits_index_path : str, pathlib.Path, or None
+            Path to a permits sidecar file created by data_io.build_permit_index. None will look for it next to the permits booklet.
 
         Returns
         -------
@@ -215,7 +333,7 @@ class AlloUsage(object):
         """
         # permits0 = get_permit_data(self._permit_remote)
 
-        waps, permits = allo_filter(permits_path, from_date, to_date, permit_filter=permit_filter, wap_filter=wap_filter, only_consumptive=only_consumptive, include_hydroelectric=include_hydroelectric, use_type_mapping=use_type_mapping)
+        waps, permits = allo_filter(permits_path, from_date, to_date, permit_filter=permit_filter, wap_filter=wap_filter, only_consumptive=only_consumptive, include_hydroelectric=include_hydroelectric, use_type_mapping=use_type_mapping, index_path=permits_index_path)
 
         if from_date is None:
             from_date1 = pd.Timestamp('1900-07-01')
@@ -230,80 +348,231 @@ class AlloUsage(object):
         setattr(self, 'permits', permits)
         setattr(self, 'from_date', from_date1)
         setattr(self, 'to_date', to_date1)
+        setattr(self, '_allo_views', {})
+        setattr(self, '_results', {})
+        setattr(self, '_stage_locks', {})
+        setattr(self, '_stage_locks_lock', threading.Lock())
+        setattr(self, '_local', threading.local())
+        setattr(self, '_wap_xy', None)
+
+        ## Fingerprint of the inputs for the disk cache
+        if self.cache_path is not None:
+            cache_base = (path_fingerprint(permits_path), path_fingerprint(self.usage_path), from_date1, to_date1, permit_filter, wap_filter, only_consumptive, include_hydroelectric, use_type_mapping, self.default_sd_ratio, self.compact, self.sd_engine)
+            setattr(self, '_cache_base', cache_base)
 
         ## Recalculate the ratios
         self._calc_sd_ratios()
 
+        ## Shared categoricals of the ids
+        if self.compact:
+            id_dtypes = {'permit_id': pd.CategoricalDtype(np.sort(self.permits['permit_id'].unique())), 'wap': pd.CategoricalDtype(np.sort(self.waps['wap'].unique())), 'hydro_feature': pd.CategoricalDtype(np.sort(self.permits['hydro_feature'].dropna().unique()))}
+            setattr(self, '_id_dtypes', id_dtypes)
+            setattr(self, 'waps', self._compact(self.waps))
+            setattr(self, 'permits', self._compact(self.permits))
+
 
-    def _est_allo_ts(self, freq):
+    def _compact(self, data, freq=None):
+        """
+        Function to convert the id columns (permit_id, wap, and hydro_feature) of a DataFrame to the shared categoricals and the float64 columns to float32 (only for the daily and weekly time series) if compact is True.
         """
+        if not self.compact:
+            return data
 
+        for col, dtype in self._id_dtypes.items():
+            if col in data.columns:
+                data[col] = data[col].astype(dtype)
+
+        if freq in compact_freqs:
+            float_cols = data.select_dtypes('float64').columns
+            if len(float_cols) > 0:
+                data[float_cols] = data[float_cols].astype('float32')
+
+        return data
+
+
+    def _stage_key(self, name, key):
         """
-        ### Run the allocation time series creation
-        limit_col = allo_type_dict[freq]
-        allo4 = allo_ts(self.permits, self.from_date, self.to_date, freq, limit_col).round()
-        allo4.name = 'total_allo'
+        Function to create the key of the results of a stage in the results cache.
+        """
+        return (name, key)
 
-        setattr(self, 'total_allo_ts', allo4.reset_index())
 
+    def _is_cached(self, name, key):
+        """
+        Function to determine whether the results of a stage are in the results cache or the disk cache.
+        """
+        if self._stage_key(name, key) in self._results:
+            return True
+        if (self.cache_path is not None) and (name in cache_stages):
+            disk_key = cache_key(self._cache_base, self._stage_key(name, key))
+            return in_cache(self.cache_path, disk_key)
+
+        return False
 
-    # @staticmethod
-    # def _prep_aquifer_data(series, all_params):
-    #     """
 
-    #     """
-    #     v1 = series.dropna().to_dict()
-    #     v2 = permit.AquiferProp(**{k: v for k, v in v1.items() if k in all_params}).dict(exclude_none=True)
+    def _set_output(self, attr, value):
+        """
+        Function to set an output of a processing stage on the object. The output is also recorded for the stage that is running in the current thread, so the results cache gets the outputs of that stage even when other stages set the same attributes concurrently.
+        """
+        setattr(self, attr, value)
 
-    #     return v2
+        outputs = getattr(self._local, 'outputs', None)
+        if outputs is not None:
+            outputs[attr] = value
 
 
-    def _calc_sd_ratios(self):
+    def _stage_lock(self, key):
         """
+        Function to get the lock of a stage key in the results cache.
+        """
+        with self._stage_locks_lock:
+            lock = self._stage_locks.get(key)
+            if lock is None:
+                lock = threading.RLock()
+                self._stage_locks[key] = lock
+
+        return lock
+
 
+    def _stage(self, fun, *args, key=None):
+        """
+        Function to run a processing stage (one of the methods that create the datasets) only once per set of parameters. The outputs of the stage (see stage_outputs) are stored in the results cache of the object under the name of the stage and the parameters (by default the args, which include the freq and remove_months). When the stage has already been run with the same parameters, the stored outputs are set back on the object instead of running it again. The stages in cache_stages are also stored in and loaded from the disk cache if cache_path was passed. A stage key is only run by one thread at a time (the others wait for its results).
+        """
+        name = fun.__name__
+        if key is None:
+            key = args
+        key1 = self._stage_key(name, key)
+
+        outputs = self._results.get(key1)
+        if outputs is None:
+            with self._stage_lock(key1):
+                outputs = self._results.get(key1)
+                if outputs is None:
+                    disk = (self.cache_path is not None) and (name in cache_stages)
+                    if disk:
+                        disk_key = cache_key(self._cache_base, key1)
+                        outputs = read_cache(self.cache_path, disk_key)
+
+                    if outputs is None:
+                        ## Record the outputs that the stage sets in this thread
+                        outputs0 = getattr(self._local, 'outputs', None)
+                        self._local.outputs = {}
+                        try:
+                            result = fun(*args)
+                            outputs = {attr: value for attr, value in self._local.outputs.items() if attr in stage_outputs[name]}
+                        finally:
+                            self._local.outputs = outputs0
+
+                        outputs[None] = result
+                        if disk:
+                            write_cache(self.cache_path, disk_key, outputs, self.cache_size)
+                        self._results[key1] = outputs
+                        return result
+
+                    self._results[key1] = outputs
+
+        for attr, value in outputs.items():
+            if attr is not None:
+                setattr(self, attr, value)
+
+        return outputs[None]
+
+
+    def clear_results(self):
+        """
+        Function to clear the cached results of the processing stages (and the allocation views). Should be run if the usage data has changed since the results were created. The results are also cleared by process_permits.
         """
-        if 'sep_distance' in self.waps.columns:
-            waps1 = self.waps.dropna(subset=['sep_distance', 'pump_aq_trans', 'pump_aq_s', 'stream_depletion_ratio'], how='all').set_index(['permit_id', 'wap']).copy()
+        self._results.clear()
+        self._allo_views.clear()
+        with self._stage_locks_lock:
+            self._stage_locks.clear()
 
-            sd = SD()
 
-            all_params = set()
+    def _get_wap_xy(self):
+        """
+        Function to get the NZTM (EPSG 2193) coordinates of the waps. The waps are only projected once per set of permits. Waps without a location are not included.
+        """
+        if self._wap_xy is None:
+            waps1 = self.waps.drop_duplicates('wap').dropna(subset=['lon', 'lat'])
+            waps2 = vector.xy_to_gpd('wap', 'lon', 'lat', waps1, 4326).to_crs(2193)
+            wap_xy = pd.DataFrame({'x': waps2.geometry.x.values, 'y': waps2.geometry.y.values}, index=pd.Index(np.asarray(waps2['wap'], dtype=object), name='wap'))
+            setattr(self, '_wap_xy', wap_xy)
 
-            _ = [all_params.update(p) for p in sd.all_methods.values()]
+        return self._wap_xy
 
-            sd_list = []
 
-            for i, v in waps1.iterrows():
+    def _est_allo_ts(self, freq, remove_months=False):
+        """
 
-                if np.isnan(v['sep_distance']) or np.isnan(v['pump_aq_trans']) or np.isnan(v['pump_aq_s']):
-                    if 'stream_depletion_ratio' in v:
-                        d1 = list(i)
-                        d1.extend([round(v['stream_depletion_ratio'], 3)])
-                        sd_ratio2 = pd.DataFrame([d1], columns=['permit_id', 'wap', 'sd_ratio'])
-                        sd_list.append(sd_ratio2)
-                else:
-                    # v2 = self._prep_aquifer_data(v, all_params)
-                    v1 = v.dropna().to_dict()
-                    v2 = {k: v for k, v in v1.items() if k in all_params}
-                    n_days = int(v['n_days'])
-                    method = v['method']
+        """
+        ### Run the allocation time series creation (total_allo_ts keeps the only copy of the full allocation)
+        allo4 = self._compact(self.get_allo_view(freq, remove_months=remove_months).to_frame(cache=False), freq)
 
-                    avail = sd.load_aquifer_data(**v2)
+        self._set_output('total_allo_ts', allo4)
 
-                    if method in avail:
-                        sd_ratio1 = sd.calc_sd_ratio(n_days, method)
-                    else:
-                        sd_ratio1 = sd.calc_sd_ratio(n_days)
+        return allo4
+
+
+    def get_allo_view(self, freq, permit_filter=None, from_date=None, to_date=None, remove_months=False):
+        """
+        Function to get a lazy view of the allocation time series of the permits. The allocation is only calculated for the permits and dates of the view when it's consumed (to_frame, iteration, or aggregate) and the materialised slices are cached on the object for reuse.
+
+        Parameters
+        ----------
+        freq : str
+            Pandas frequency str. Must be 'D', 'W', 'M', or 'A-JUN'.
+        permit_filter : dict or None
+            The keys should be the column names of the permits table and the values should be the list of values to keep on those columns (e.g. {'use_type': ['irrigation']}).
+        from_date : str, Timestamp, or None
+            The start date of the view. None will use the from_date of the object.
+        to_date : str, Timestamp, or None
+            The end date of the view. None will use the to_date of the object.
+        remove_months : bool
+            Should the allocation only be in the seasons of the permits (see get_ts)?
+
+        Returns
+        -------
+        allocation_ts.AlloView
+        """
+        key = (freq, remove_months)
+        view = self._allo_views.get(key)
+        if view is None:
+            view = AlloView(self.permits, self.from_date, self.to_date, freq, allo_type_dict[freq], remove_months)
+            self._allo_views[key] = view
 
-                    d1 = list(i)
-                    d1.extend([round(sd_ratio1, 3)])
+        if (permit_filter is None) and (from_date is None) and (to_date is None):
+            return view
+
+        return view.select(permit_filter, from_date, to_date)
+
+
+    @staticmethod
+    def _prep_aquifer_data(series, all_params):
+        """
+        Function to get the aquifer parameters of a wap that SD.load_aquifer_data accepts.
+        """
+        v1 = series.dropna().to_dict()
+        v2 = {k: v for k, v in v1.items() if k in all_params}
+        # v2 = permit.AquiferProp(**{k: v for k, v in v1.items() if k in all_params}).dict(exclude_none=True)
+
+        return v2
+
+
+    def _calc_sd_ratios(self):
+        """
+
+        """
+        if self.waps['sep_distance'].notnull().any():
+            waps0 = self.waps.rename(columns={'sd_ratio': 'station_sd_ratio'})
+            waps1 = waps0.dropna(subset=['sep_distance', 'pump_aq_trans', 'pump_aq_s', 'stream_depletion_ratio'], how='all').set_index(['permit_id', 'wap']).copy()
 
-                    sd_ratio2 = pd.DataFrame([d1], columns=['permit_id', 'wap', 'sd_ratio'])
-                    sd_list.append(sd_ratio2)
+            sd_ratios = calc_sd_ratios(waps1).reset_index()
 
-            sd_ratios = pd.concat(sd_list)
+            waps2 = pd.merge(waps0, sd_ratios, on=['permit_id', 'wap'], how='left')
 
-            waps2 = pd.merge(self.waps, sd_ratios, on=['permit_id', 'wap'], how='left')
+            ## The sd_ratio of the stations takes precedence over the calculated one
+            if 'station_sd_ratio' in waps2:
+                waps2['sd_ratio'] = waps2.pop('station_sd_ratio').fillna(waps2['sd_ratio'])
         else:
             waps2 = self.waps.copy()
             if 'sd_ratio' not in self.waps.columns:
@@ -318,14 +587,15 @@ class AlloUsage(object):
         setattr(self, 'waps', waps2)
 
 
-    def _allo_wap_spit(self):
+    def _allo_wap_spit(self, freq=None, remove_months=False):
         """
 
         """
-        allo6 = pd.merge(self.total_allo_ts, self.waps[['permit_id', 'wap', 'sd_ratio']], on=['permit_id'])
+        allo5 = self._stage(self._est_allo_ts, freq, remove_months)
+        allo6 = pd.merge(allo5, self.waps[['permit_id', 'wap', 'sd_ratio']], on=['permit_id'])
         # allo6 = pd.merge(allo5, self.sd, on=['permit_id', 'wap'], how='left')
 
-        allo6['combo_wap_allo'] = allo6.groupby(['permit_id', 'hydro_feature', 'date'])['total_allo'].transform('sum')
+        allo6['combo_wap_allo'] = allo6.groupby(['permit_id', 'hydro_feature', 'date'], observed=True)['total_allo'].transform('sum')
         allo6['combo_wap_ratio'] = allo6['total_allo']/allo6['combo_wap_allo']
 
         allo6['wap_allo'] = allo6['total_allo'] * allo6['combo_wap_ratio']
@@ -340,40 +610,34 @@ class AlloUsage(object):
         allo7['gw_allo'] = allo7['total_allo']
         allo7.loc[allo7['hydro_feature'] == 'surface water', 'gw_allo'] = 0
 
-        allo8 = allo7.drop(['hydro_feature', 'sd_ratio'], axis=1).groupby(pk).mean()
+        allo8 = self._compact(allo7.drop(['hydro_feature', 'sd_ratio'], axis=1), freq).groupby(pk, observed=True).mean()
 
-        setattr(self, 'wap_allo_ts', allo8)
+        self._set_output('wap_allo_ts', allo8)
 
+        return allo8
 
-    def _get_allo_ts(self, freq):
+
+    def _get_allo_ts(self, freq, remove_months=False):
         """
         Function to create an allocation time series.
 
         """
-        self._est_allo_ts(freq)
-
         ### Convert to GW and SW allocation
-        self._allo_wap_spit()
+        return self._stage(self._allo_wap_spit, freq, remove_months)
 
 
-    def _get_usage(self, freq):
+    def _prep_usage(self, tsdata):
         """
-
+        Function to rename the raw usage data and run the QA on it. Returns the usage and the quality codes.
         """
-        self._get_allo_ts(freq)
-        allo1 = self.wap_allo_ts.copy().reset_index()
-
-        waps = allo1.wap.unique().tolist()
-
-        tsdata1 = get_usage_data(self.usage_path, waps, self.from_date, self.to_date)
-        tsdata1.rename(columns={'water_use': 'total_usage', 'time': 'date'}, inplace=True)
+        tsdata1 = tsdata.rename(columns={'water_use': 'total_usage', 'time': 'date'})
 
-        tsdata1 = tsdata1[['wap', 'date', 'total_usage']].sort_values(['wap', 'date']).copy()
+        tsdata1 = self._compact(tsdata1[['wap', 'date', 'total_usage']].sort_values(['wap', 'date']), 'D')
 
         ## Create the data quality series
         qa = tsdata1.rename(columns={'total_usage': 'quality_code'}).copy()
         qa['quality_code'] = 0
-        qa['quality_code'] = qa['quality_code'].astype('int16')
+        qa['quality_code'] = qa['quality_code'].astype(self._qa_dtype)
         qa = qa.set_index(['wap', 'date'])['quality_code'].copy()
 
         ## filter - remove negative values (spikes are too hard with only usage data)
@@ -381,43 +645,177 @@ class AlloUsage(object):
         qa.loc[neg_bool.values] = 1
         tsdata1.loc[neg_bool, 'total_usage'] = 0
 
-        setattr(self, 'usage_ts_daily', tsdata1)
-        setattr(self, 'usage_ts_daily_qa', qa)
+        return tsdata1, qa
+
+
+    def get_allo_intervals(self, limit_col='max_daily_volume', extra_cols=None):
+        """
+        Function to create the sparse interval representation of the allocation split by wap and into the SW and GW components. The aggregate method of the returned object calculates the allocation per group and period without creating the full allocation time series (e.g. the daily allocation of all permits over decades).
+
+        Parameters
+        ----------
+        limit_col : str
+            The limit column used for the daily rates. Either 'max_daily_volume' or 'max_annual_volume' (spread evenly over 365 days).
+        extra_cols : list of str or None
+            Other columns of the permits table that should be kept for grouping (e.g. use_type).
+
+        Returns
+        -------
+        allocation_ts.AlloIntervals
+        """
+        allo1 = AlloIntervals(self.permits, self.from_date, self.to_date, limit_col, extra_cols).split_waps(self.waps)
+
+        setattr(self, 'allo_intervals', allo1)
+
+        return allo1
+
+
+    def _usage_waps(self, freq):
+        """
+        Function to get the waps of the permits with allocation for the freq. Only uses the permits and waps tables, so the usage can be read without the allocation time series.
+        """
+        limit_col = allo_type_dict[freq]
+        permit_ids = self.permits.loc[self.permits[limit_col].notnull(), 'permit_id']
+
+        return self.waps.loc[self.waps['permit_id'].isin(permit_ids), 'wap'].unique().tolist()
+
+
+    def _get_usage(self, freq):
+        """
+        Function to read the daily usage and run the QA on it. The waps are read and decoded on a background thread while the waps already read are renamed, clamped, and flagged, so the reading overlaps with the QA. The waps are read in sorted order, so the result doesn't need a global sort.
+        """
+        waps = sorted(self._usage_waps(freq))
+
+        waps1 = []
+        len_list = []
+        time_list = []
+        use_list = []
+        qa_list = []
+        for wap, times, values in iter_wap_usage(self.usage_path, waps, self.from_date, self.to_date, self.threads, prefetch=usage_prefetch):
+            if (times[1:] < times[:-1]).any():
+                order = np.argsort(times, kind='stable')
+                times = times[order]
+                values = values[order]
+
+            ## filter - remove negative values (spikes are too hard with only usage data)
+            neg_bool = values < 0
+
+            waps1.append(wap)
+            len_list.append(len(times))
+            time_list.append(times)
+            use_list.append(np.where(neg_bool, 0, values))
+            qa_list.append(neg_bool.astype(self._qa_dtype))
+
+        if waps1:
+            tsdata1 = pd.DataFrame({'wap': np.repeat(np.array(waps1, dtype=object), len_list), 'date': np.concatenate(time_list), 'total_usage': np.concatenate(use_list)})
+            qa_values = np.concatenate(qa_list)
+        else:
+            tsdata1 = pd.DataFrame(columns=['wap', 'date', 'total_usage']).astype({'date': 'datetime64[ns]', 'total_usage': 'float64'})
+            qa_values = np.empty(0, dtype=self._qa_dtype)
+
+        tsdata1 = self._compact(tsdata1, 'D')
+
+        ## Create the data quality series
+        qa = pd.Series(qa_values, index=pd.MultiIndex.from_arrays([tsdata1['wap'], tsdata1['date']]), name='quality_code')
+
+        self._set_output('usage_ts_daily', tsdata1)
+        self._set_output('usage_ts_daily_qa', qa)
+
+        return tsdata1
 
 
     def _agg_usage(self, freq):
         """
 
         """
-        if not hasattr(self, 'usage_ts_daily'):
-            self._get_usage(freq)
-        tsdata1 = self.usage_ts_daily
+        if (self.usage_batch_size is not None) or (self.usage_state_path is not None):
+            ## Stream the daily usage in batches of whole waps and aggregate each batch
+            waps = self._usage_waps(freq)
+            calendar = get_calendar(freq, self.from_date, self.to_date)
+
+            if self.usage_state_path is not None:
+                states = read_usage_state(self.usage_state_path, self.usage_path, freq, waps, self.from_date, self.to_date)
+            else:
+                states = {}
+
+            ## Only read the days after the watermark of each wap
+            starts = {}
+            for wap in waps:
+                if wap in states:
+                    start = states[wap]['watermark'] + pd.Timedelta(days=1)
+                else:
+                    start = self.from_date
+                starts.setdefault(start, []).append(wap)
+
+            agg_list = []
+            qa_list = []
+            wm_list = []
+            for start, waps1 in starts.items():
+                for tsdata0 in iter_usage_data(self.usage_path, waps1, start, self.to_date, batch_size=self.usage_batch_size, threads=self.threads):
+                    tsdata1, qa = self._prep_usage(tsdata0)
+                    del tsdata0
+
+                    agg_list.append(grp_ts_agg(tsdata1, 'wap', 'date', freq, 'sum', calendar=calendar))
+                    qa_list.append(qa[qa > 0])
+                    wm_list.append(tsdata1.groupby('wap', observed=True)['date'].max())
+
+            if agg_list:
+                tsdata2 = pd.concat(agg_list).sort_index()
+                qa1 = pd.concat(qa_list).sort_index()
+            else:
+                empty1 = pd.DataFrame(columns=['wap', 'date', 'total_usage']).astype({'date': 'datetime64[ns]', 'total_usage': 'float64'})
+                tsdata2 = grp_ts_agg(empty1, 'wap', 'date', freq, 'sum')
+                qa1 = pd.Series(dtype=self._qa_dtype, name='quality_code')
+
+            if self.usage_state_path is not None:
+                ## Merge the new days into the stored aggregates (the partial periods are summed)
+                if states:
+                    old1 = pd.concat({wap: state['total_usage'] for wap, state in states.items()}, names=['wap', 'date']).to_frame('total_usage')
+                    tsdata2 = pd.concat([old1, tsdata2]).groupby(level=['wap', 'date'], observed=True).sum()
+                    old_qa = {wap: state['quality_code'] for wap, state in states.items() if not state['quality_code'].empty}
+                    if old_qa:
+                        qa1 = pd.concat([pd.concat(old_qa, names=['wap', 'date']), qa1]).sort_index()
+
+                ## Update the states of the waps with new days
+                if wm_list:
+                    wm1 = pd.concat(wm_list)
+                    wap_qa = {wap: q.droplevel('wap') for wap, q in qa1.groupby(level='wap', observed=True)}
+                    new_states = {}
+                    for wap, watermark in wm1.items():
+                        new_states[wap] = {'watermark': watermark,
+                                           'total_usage': tsdata2.loc[wap, 'total_usage'],
+                                           'quality_code': wap_qa.get(wap, pd.Series(dtype=self._qa_dtype, name='quality_code'))}
+                    write_usage_state(self.usage_state_path, self.usage_path, freq, new_states, self.from_date)
+
+            self._set_output('usage_ts_daily_qa', qa1)
+
+        else:
+            ## The daily usage is the same for all freqs
+            tsdata1 = self._stage(self._get_usage, freq, key=())
 
-        ### Aggregate
-        tsdata2 = grp_ts_agg(tsdata1, 'wap', 'date', freq, 'sum')
+            ### Aggregate
+            tsdata2 = grp_ts_agg(tsdata1, 'wap', 'date', freq, 'sum', calendar=get_calendar(freq, self.from_date, self.to_date))
 
-        setattr(self, 'usage_ts', tsdata2)
+        self._set_output('usage_ts', tsdata2)
+
+        return tsdata2
 
 
-    def _usage_estimation(self, freq, buffer_dis=80000, min_months=36, est_method='ratio'):
+    def _usage_estimation(self, freq, buffer_dis=80000, min_months=36, est_method='ratio', n_donors=None, idw_power=None, daily_method='pchip', remove_months=False):
         """
 
         """
         ### Get the necessary data
         if freq in ('D', 'W', 'M'):
-            allo_use1 = self.get_ts(['allo', 'metered_allo', 'usage'], 'M', ['permit_id', 'wap'])
+            allo_use1 = self.get_ts(['allo', 'metered_allo', 'usage'], 'M', ['permit_id', 'wap'], remove_months=remove_months)
         else:
-            allo_use0 = self.get_ts(['allo', 'metered_allo', 'usage'], freq, ['permit_id', 'wap'])
-            allo_use1 = allo_use0.reset_index().groupby(['permit_id', 'wap', pd.Grouper(key='date', freq='M')]).sum()
+            allo_use0 = self.get_ts(['allo', 'metered_allo', 'usage'], freq, ['permit_id', 'wap'], remove_months=remove_months)
+            allo_use1 = grp_ts_agg(allo_use0.reset_index(), ['permit_id', 'wap'], 'date', 'M', 'sum', calendar=get_calendar('M', self.from_date, self.to_date))
 
             del allo_use0
 
         permits = self.permits.copy()
 
-        ### Create Wap locations
-        waps1 = vector.xy_to_gpd('wap', 'lon', 'lat', self.waps.drop('permit_id', axis=1).drop_duplicates('wap'), 4326)
-        waps2 = waps1.to_crs(2193)
-
         ### Get base data
         bool1 = allo_use1['total_metered_allo'] <  (allo_use1['total_allo']*0.5)
         allo_use_mis1 = allo_use1[bool1].copy().reset_index()
@@ -429,7 +827,7 @@ class AlloUsage(object):
         allo_use_with2['month'] = allo_use_with2['date'].dt.month
         allo_use_with2['usage_allo'] = allo_use_with2['total_usage']/allo_use_with2['total_allo']
 
-        allo_use_ratio1 = allo_use_with2.groupby(['permit_id', 'wap', 'use_type', 'month'])['usage_allo'].mean().reset_index()
+        allo_use_ratio1 = allo_use_with2.groupby(['permit_id', 'wap', 'use_type', 'month'], observed=True)['usage_allo'].mean().reset_index()
 
         ### Assign ratios to consents/waps that already have data
         allo_use_mis1['month'] = allo_use_mis1['date'].dt.month
@@ -441,28 +839,55 @@ class AlloUsage(object):
         allo_use_mis0['gw_allo_usage_est'] = (allo_use_mis0['usage_allo'] * allo_use_mis0['gw_allo']).round()
 
         ### Determine which Waps need to be estimated
-        mis_waps1 = allo_use_mis1.groupby(['permit_id', 'wap'])['total_allo'].count().copy()
-        with_waps1 = allo_use_with1.groupby(['permit_id', 'wap'])['total_allo'].count()
+        mis_waps1 = allo_use_mis1.groupby(['permit_id', 'wap'], observed=True)['total_allo'].count().copy()
+        with_waps1 = allo_use_with1.groupby(['permit_id', 'wap'], observed=True)['total_allo'].count()
         with_waps2 = with_waps1[with_waps1 >= min_months]
 
         with_waps3 = pd.merge(with_waps2.reset_index()[['permit_id', 'wap']], permits[['permit_id', 'use_type']], on='permit_id')
 
-        with_waps4 = pd.merge(waps2, with_waps3['wap'], on='wap')
+        ## The donor waps are weighted by their number of permits with data
+        wap_xy = self._get_wap_xy()
 
-        mis_waps2 = pd.merge(mis_waps1.reset_index(), permits[['permit_id', 'use_type']], on='permit_id')
-        mis_waps3 = pd.merge(waps2, mis_waps2['wap'], on='wap')
-        mis_waps3['geometry'] = mis_waps3['geometry'].buffer(buffer_dis)
+        with_waps4 = pd.Series(np.asarray(with_waps3['wap'], dtype=object)).value_counts()
+        with_waps4 = with_waps4[with_waps4.index.isin(wap_xy.index)]
 
-        mis_waps4, poly1 = vector.pts_poly_join(with_waps4.rename(columns={'wap': 'good_wap'}), mis_waps3, 'wap')
+        mis_waps2 = pd.merge(mis_waps1.reset_index()[['permit_id', 'wap']], permits[['permit_id', 'use_type']], on='permit_id')
+
+        ## Find the donor waps within the buffer_dis of the waps that need to be estimated. The donors are only matched on the same use type, so there's a tree per use type (and the n_donors are all donors of the use type).
+        mis_list = []
+        for use_type, ratio1 in allo_use_ratio1.groupby('use_type', observed=True):
+            good_waps = pd.Index(np.asarray(ratio1['wap'], dtype=object)).unique()
+            good_waps = good_waps[good_waps.isin(with_waps4.index)]
+
+            mis_waps3 = pd.Index(np.asarray(mis_waps2.loc[mis_waps2['use_type'] == use_type, 'wap'], dtype=object)).unique()
+            mis_waps3 = mis_waps3[mis_waps3.isin(wap_xy.index)]
+
+            mis_pos, with_pos, dis = find_neighbours(wap_xy.loc[good_waps].values, wap_xy.loc[mis_waps3].values, buffer_dis, n_donors)
+
+            mis_waps4 = pd.DataFrame({'good_wap': good_waps[with_pos], 'wap': mis_waps3[mis_pos], 'use_type': use_type, 'weight': with_waps4.loc[good_waps].values[with_pos].astype('float64')})
+            if idw_power is not None:
+                mis_waps4['weight'] = mis_waps4['weight'] / (np.maximum(dis, 1) ** idw_power)
+            mis_list.append(mis_waps4)
+
+        if mis_list:
+            mis_waps5 = pd.concat(mis_list, ignore_index=True)
+        else:
+            mis_waps5 = pd.DataFrame({'good_wap': pd.Series(dtype=object), 'wap': pd.Series(dtype=object), 'use_type': pd.Series(dtype=object), 'weight': pd.Series(dtype='float64')})
 
-        allo_use_ratio2 = pd.merge(allo_use_ratio1.rename(columns={'wap': 'good_wap'}), mis_waps4[['good_wap', 'wap']], on='good_wap')
+        allo_use_ratio2 = pd.merge(allo_use_ratio1.astype({'wap': object, 'use_type': object}).rename(columns={'wap': 'good_wap'}), mis_waps5, on=['good_wap', 'use_type'])
 
         ## Combine with the missing ones
         allo_use_mis2 = pd.merge(allo_use_mis1[['permit_id', 'wap', 'date']], permits[['permit_id', 'use_type']], on='permit_id')
         allo_use_mis2['month'] = allo_use_mis2['date'].dt.month
 
-        allo_use_mis3 = pd.merge(allo_use_mis2, allo_use_ratio2[['use_type', 'month', 'usage_allo', 'wap']], on=['use_type', 'wap', 'month'])
-        allo_use_mis4 = allo_use_mis3.groupby(['permit_id', 'wap', 'date'])['usage_allo'].mean().reset_index()
+        allo_use_mis3 = pd.merge(allo_use_mis2.astype({'wap': object}), allo_use_ratio2[['use_type', 'month', 'usage_allo', 'weight', 'wap']], on=['use_type', 'wap', 'month'])
+
+        ## Weighted mean of the donor ratios
+        allo_use_mis3['weight'] = allo_use_mis3['weight'].where(allo_use_mis3['usage_allo'].notnull())
+        allo_use_mis3['usage_allo'] = allo_use_mis3['usage_allo'] * allo_use_mis3['weight']
+        allo_use_mis4 = allo_use_mis3.groupby(['permit_id', 'wap', 'date'], observed=True)[['usage_allo', 'weight']].sum()
+        allo_use_mis4['usage_allo'] = allo_use_mis4['usage_allo'] / allo_use_mis4['weight']
+        allo_use_mis4 = self._compact(allo_use_mis4.drop('weight', axis=1).reset_index())
 
         allo_use_mis5 = pd.merge(allo_use_mis4, allo_use_mis1[['permit_id', 'wap', 'date', 'total_allo', 'sw_allo', 'gw_allo']], on=['permit_id', 'wap', 'date'])
         if est_method == 'zero':
@@ -488,55 +913,72 @@ class AlloUsage(object):
             allo_use_mis6['sw_allo_usage_est'] = allo_use_mis6['sw_allo_usage_est'] / days1
             allo_use_mis6['gw_allo_usage_est'] = allo_use_mis6['gw_allo_usage_est'] / days1
 
-            usage_rate0 = allo_use_mis6.copy()
+            if daily_method == 'step':
+                ## The monthly rates from the first days of the months to the end of the last month
+                usage_rate0 = allo_use_mis6.copy()
+                usage_rate0['date'] = usage_rate0['date'] - pd.to_timedelta(days1 - 1, unit='D')
+
+                last1 = allo_use_mis6.sort_values('date').groupby(['permit_id', 'wap'], observed=True).tail(1)
+
+                usage_rate1 = pd.concat([usage_rate0, last1])
+            else:
+                ## The monthly rates in the middle of the months with the first and last days
+                usage_rate0 = allo_use_mis6.copy()
 
-            usage_rate0['date'] = usage_rate0['date'] - days2
+                usage_rate0['date'] = usage_rate0['date'] - days2
 
-            grp1 = allo_use_mis6.groupby(['permit_id', 'wap'])
-            first1 = grp1.first()
-            last1 = grp1.last()
+                grp1 = allo_use_mis6.groupby(['permit_id', 'wap'], observed=True)
+                first1 = grp1.first()
+                last1 = grp1.last()
 
-            first1['date'] = pd.to_datetime(first1.loc[:, 'date'].dt.strftime('%Y-%m') + '-01')
+                first1['date'] = pd.to_datetime(first1.loc[:, 'date'].dt.strftime('%Y-%m') + '-01')
 
-            usage_rate1 = pd.concat([first1, usage_rate0.set_index(['permit_id', 'wap']), last1], sort=True).reset_index().sort_values(['permit_id', 'wap', 'date'])
+                usage_rate1 = pd.concat([first1, usage_rate0.set_index(['permit_id', 'wap']), last1], sort=True).reset_index()
 
-            usage_rate1.set_index('date', inplace=True)
+            ## Interpolate the knots of all of the permit/waps at once
+            est_cols = ['total_usage_est', 'sw_allo_usage_est', 'gw_allo_usage_est']
+            grp_codes, grp_index = pd.MultiIndex.from_frame(usage_rate1[['permit_id', 'wap']]).factorize()
+            knot_days = usage_rate1['date'].values.astype('datetime64[D]').astype('int64')
 
-            usage_daily_rate1 = usage_rate1.groupby(['permit_id', 'wap']).apply(lambda x: x.resample('D').interpolate(method='pchip')[['total_usage_est', 'sw_allo_usage_est', 'gw_allo_usage_est']]).round(2)
+            daily_grps, daily_days, daily_rates = interp_daily(grp_codes, knot_days, usage_rate1[est_cols].values, daily_method)
+
+            daily_index = pd.MultiIndex.from_arrays([grp_index.get_level_values(0)[daily_grps], grp_index.get_level_values(1)[daily_grps], pd.to_datetime(daily_days, unit='D')], names=['permit_id', 'wap', 'date'])
+            usage_daily_rate1 = pd.DataFrame(daily_rates, index=daily_index, columns=est_cols).round(2)
         else:
             usage_daily_rate1 = allo_use_mis6.set_index(['permit_id', 'wap', 'date'])
 
         ## Put the actual usage back into the estimate
-        act_use1 = self.get_ts(['usage'], freq, ['permit_id', 'wap'])
+        act_use1 = self.get_ts(['usage'], freq, ['permit_id', 'wap'], remove_months=remove_months)
 
         combo1 = pd.concat([usage_daily_rate1, act_use1], axis=1).sort_index()
         combo1.loc[combo1['total_usage'].notnull(), 'total_usage_est'] = combo1.loc[combo1['total_usage'].notnull(), 'total_usage']
         combo1.loc[combo1['sw_allo_usage'].notnull(), 'sw_allo_usage_est'] = combo1.loc[combo1['sw_allo_usage'].notnull(), 'sw_allo_usage']
         combo1.loc[combo1['gw_allo_usage'].notnull(), 'gw_allo_usage_est'] = combo1.loc[combo1['gw_allo_usage'].notnull(), 'gw_allo_usage']
         combo1.drop(['total_usage', 'sw_allo_usage', 'gw_allo_usage'], axis=1, inplace=True)
+        combo1 = self._compact(combo1, freq)
 
-        setattr(self, 'usage_est', combo1)
+        self._set_output('usage_est', combo1)
 
         return combo1
 
 
-    def _calc_sd_rates(self, usage_allo_ratio=2, buffer_dis=80000, min_months=36, est_method='ratio', est_gw_sd_lags=False):
+    def _calc_sd_rates(self, usage_allo_ratio=2, buffer_dis=80000, min_months=36, est_method='ratio', est_gw_sd_lags=False, n_donors=None, idw_power=None, daily_method='pchip', remove_months=False):
         """
     
         """
-        usage_est = self.get_ts(['usage_est'], 'D', ['permit_id', 'wap'], usage_allo_ratio=usage_allo_ratio, buffer_dis=buffer_dis, min_months=min_months, usage_est_method=est_method)['total_usage_est']
+        usage_est = self.get_ts(['usage_est'], 'D', ['permit_id', 'wap'], usage_allo_ratio=usage_allo_ratio, buffer_dis=buffer_dis, min_months=min_months, usage_est_method=est_method, remove_months=remove_months, n_donors=n_donors, idw_power=idw_power, daily_method=daily_method)['total_usage_est']
         usage_est.name = 'sd_rate'
     
         ## SD groundwater takes
         if est_gw_sd_lags:
             sd_list = []
-            if not 'sep_distance' in self.waps.columns:
+            if not self.waps['sep_distance'].notnull().any():
                 raise ValueError('est_gw_sd_lags == True, but there are no aquifer parameters in the waps table.')
     
             usage_index = usage_est.index.droplevel(2).unique()
     
             waps1 = self.waps.dropna(subset=['sep_distance', 'pump_aq_trans', 'pump_aq_s']).set_index(['permit_id', 'wap']).copy()
-            aq_waps = waps1.permit_id.unique()
+            aq_waps = waps1.index.get_level_values('permit_id').unique()
     
             gw_permits = self.permits[self.permits.hydro_feature == 'groundwater'].permit_id.unique()
     
@@ -549,7 +991,8 @@ class AlloUsage(object):
             all_params = set()
     
             _ = [all_params.update(p) for p in sd.all_methods.values()]
-    
+
+            tasks = []
             for i, v in waps1.iterrows():
                 if i in usage_index:
                     use1 = usage_est.loc[i]
@@ -557,21 +1000,29 @@ class AlloUsage(object):
                     v2 = self._prep_aquifer_data(v, all_params)
                     # n_days = int(v['n_days'])
                     method = v['method']
-    
-                    avail = sd.load_aquifer_data(**v2)
-    
-                    if method in avail:
-                        sd_rates1 = sd.calc_sd_extraction(use1, method)
+
+                    tasks.append((i[0], i[1], v2, method, use1))
+
+            if self.sd_engine == 'convolve':
+                sd_list.extend(calc_sd_lags(tasks))
+
+            elif self.sd_engine == 'sd':
+                ## Calculate the SD of the waps in chunks (in order)
+                chunks = [tasks[c:(c + sd_chunk_size)] for c in range(0, len(tasks), sd_chunk_size)]
+
+                if (self.processes > 1) and (len(chunks) > 1):
+                    ## Forking isn't safe outside of the main thread (e.g. when the stages run in the threads of get_ts)
+                    if threading.current_thread() is threading.main_thread():
+                        context = get_context()
                     else:
-                        sd_rates1 = sd.calc_sd_extraction(use1)
-    
-                    sd_rates1.name = 'sd_rate'
-    
-                    sd_rates1 = sd_rates1.reset_index()
-                    sd_rates1['permit_id'] = i[0]
-                    sd_rates1['wap'] = i[1]
-    
-                    sd_list.append(sd_rates1)
+                        context = get_context('spawn')
+
+                    with context.Pool(min(self.processes, len(chunks))) as pool:
+                        for sd_list1 in pool.imap(_calc_sd_lags, chunks):
+                            sd_list.extend(sd_list1)
+                else:
+                    for chunk in chunks:
+                        sd_list.extend(_calc_sd_lags(chunk))
     
             ## SW takes
             sw_permits = self.permits[self.permits.hydro_feature == 'surface water'].permit_id.unique()
@@ -589,38 +1040,36 @@ class AlloUsage(object):
             sd_rates1a['sd_rate'] = sd_rates1a['sd_rate'] * sd_rates1a['sd_ratio']
             sd_rates2 = sd_rates1a.drop('sd_ratio', axis=1)
 
-        sd_rates3 = sd_rates2.groupby(pk).mean()
+        sd_rates3 = self._compact(sd_rates2, 'D').groupby(pk, observed=True).mean()
     
-        setattr(self, 'sd_rates_daily', sd_rates3)
+        self._set_output('sd_rates_daily', sd_rates3)
+
+        return sd_rates3
 
 
-    def _agg_sd_rates(self, freq, usage_allo_ratio=2, buffer_dis=40000, min_months=36, est_method='ratio', est_gw_sd_lags=False):
+    def _agg_sd_rates(self, freq, usage_allo_ratio=2, buffer_dis=40000, min_months=36, est_method='ratio', est_gw_sd_lags=False, n_donors=None, idw_power=None, daily_method='pchip', remove_months=False):
         """
 
         """
-        if not hasattr(self, 'sd_rates_daily'):
-            self._calc_sd_rates(usage_allo_ratio, buffer_dis, min_months, est_method=est_method, est_gw_sd_lags=est_gw_sd_lags)
-        tsdata1 = self.sd_rates_daily.reset_index()
+        tsdata1 = self._stage(self._calc_sd_rates, usage_allo_ratio, buffer_dis, min_months, est_method, est_gw_sd_lags, n_donors, idw_power, daily_method, remove_months).reset_index()
 
-        tsdata2 = grp_ts_agg(tsdata1, ['permit_id', 'wap'], 'date', freq, 'sum')
+        tsdata2 = grp_ts_agg(tsdata1, ['permit_id', 'wap'], 'date', freq, 'sum', calendar=get_calendar(freq, self.from_date, self.to_date))
 
-        setattr(self, 'sd_rates', tsdata2)
+        self._set_output('sd_rates', tsdata2)
 
         return tsdata2
 
 
-    def _split_usage_ts(self, freq, usage_allo_ratio=2):
+    def _split_usage_ts(self, freq, usage_allo_ratio=2, remove_months=False):
         """
 
         """
         ### Get the usage data if it exists
-        self._agg_usage(freq)
-        tsdata2 = self.usage_ts.copy().reset_index()
+        tsdata2 = self._stage(self._agg_usage, freq).reset_index()
 
-        self._get_allo_ts(freq)
-        allo1 = self.wap_allo_ts.copy().reset_index()
+        allo1 = self._stage(self._allo_wap_spit, freq, remove_months).reset_index()
 
-        allo1['combo_allo'] = allo1.groupby(['wap', 'date'])['total_allo'].transform('sum')
+        allo1['combo_allo'] = allo1.groupby(['wap', 'date'], observed=True)['total_allo'].transform('sum')
         allo1['combo_ratio'] = allo1['total_allo']/allo1['combo_allo']
 
         ### combine with consents info
@@ -634,7 +1083,7 @@ class AlloUsage(object):
         qa_cols.append('total_usage')
         qa = usage1[qa_cols].set_index(pk)['total_usage'].copy()
         qa.loc[:] = 0
-        qa = qa.astype('int16')
+        qa = qa.astype(self._qa_dtype)
         qa.loc[excess_usage_bool.values] = 1
 
         ### Split the GW and SW components
@@ -647,27 +1096,27 @@ class AlloUsage(object):
         ### Remove other columns
         usage1.drop(['sw_allo', 'gw_allo', 'total_allo', 'combo_allo', 'combo_ratio', 'sw_ratio', 'gw_ratio'], axis=1, inplace=True)
 
-        usage2 = usage1.dropna().groupby(pk).mean()
+        usage2 = self._compact(usage1.dropna(), freq).groupby(pk, observed=True).mean()
 
-        setattr(self, 'split_usage_ts', usage2)
-        setattr(self, 'split_usage_ts_qa', qa)
+        self._set_output('split_usage_ts', usage2)
+        self._set_output('split_usage_ts_qa', qa)
 
+        return usage2
 
-    def _get_metered_allo_ts(self, freq, proportion_allo=True):
+
+    def _get_metered_allo_ts(self, freq, proportion_allo=True, usage_allo_ratio=2, remove_months=False):
         """
 
         """
-        setattr(self, 'proportion_allo', proportion_allo)
+        self._set_output('proportion_allo', proportion_allo)
 
         ### Get the allocation ts either total or metered
-        self._get_allo_ts(freq)
-        allo1 = self.wap_allo_ts.copy().reset_index()
+        allo1 = self._stage(self._allo_wap_spit, freq, remove_months).reset_index()
         rename_dict = {'sw_allo': 'sw_metered_allo', 'gw_allo': 'gw_metered_allo', 'total_allo': 'total_metered_allo'}
 
         ### Combine the usage data to the allo data
-        if not hasattr(self, 'split_usage_ts'):
-            self._split_usage_ts(freq)
-        allo2 = pd.merge(self.split_usage_ts.reset_index()[pk], allo1, on=pk, how='right', indicator=True)
+        usage1 = self._stage(self._split_usage_ts, freq, usage_allo_ratio, remove_months)
+        allo2 = pd.merge(usage1.reset_index()[pk], allo1, on=pk, how='right', indicator=True)
 
         ## Re-categorise
         allo2['_merge'] = allo2._merge.cat.rename_categories({'left_only': 2, 'right_only': 0, 'both': 1}).astype(int)
@@ -676,21 +1125,23 @@ class AlloUsage(object):
             allo2.loc[allo2._merge != 1, list(rename_dict.keys())] = 0
             allo3 = allo2.drop('_merge', axis=1).copy()
         else:
-            allo2['usage_waps'] = allo2.groupby(['permit_id', 'date'])['_merge'].transform('sum')
+            allo2['usage_waps'] = allo2.groupby(['permit_id', 'date'], observed=True)['_merge'].transform('sum')
 
             allo2.loc[allo2.usage_waps == 0, list(rename_dict.keys())] = 0
             allo3 = allo2.drop(['_merge', 'usage_waps'], axis=1).copy()
 
         allo3.rename(columns=rename_dict, inplace=True)
-        allo4 = allo3.groupby(pk).mean()
+        allo4 = self._compact(allo3, freq).groupby(pk, observed=True).mean()
 
         if 'total_metered_allo' in allo3:
-            setattr(self, 'metered_allo_ts', allo4)
+            self._set_output('metered_allo_ts', allo4)
         else:
             setattr(self, 'metered_restr_allo_ts', allo4)
 
+        return allo4
+
 
-    def get_ts(self, datasets, freq, groupby, usage_allo_ratio=2, buffer_dis=40000, min_months=36, usage_est_method='ratio', est_gw_sd_lags=False):
+    def get_ts(self, datasets, freq, groupby, usage_allo_ratio=2, buffer_dis=40000, min_months=36, usage_est_method='ratio', est_gw_sd_lags=False, remove_months=False, n_donors=None, idw_power=None, daily_method='pchip', nan_policy='any', max_memory=None):
         """
         Function to create a time series of allocation and usage.
 
@@ -706,6 +1157,18 @@ class AlloUsage(object):
             The cut off ratio of usage/allocation. Any usage above this ratio will be removed from the results (subsequently reducing the metered allocation).
         usage_est_method: str
             The usage estimation method. Options are ratio (default), zero, and allo.
+        remove_months : bool
+            Should the allocation only be in the seasons of the permits? The seasons are defined by the from_month and to_month columns of the permits table and can wrap around the new year (e.g. 10 to 4). Permits without them are allocated in all months. Has no effect on annual frequencies.
+        n_donors : int or None
+            The maximum number of the nearest donor waps (waps with at least min_months of metered data and with permits of the same use type) within the buffer_dis used to estimate the usage of a wap. None will use all of the donor waps within the buffer_dis.
+        idw_power : int, float, or None
+            The power of the inverse distance weighting of the donor usage/allocation ratios. Distances under 1 m are treated as 1 m. None will weight all of the donor waps equally (by their number of permits).
+        daily_method : str
+            The method used to disaggregate the monthly usage estimates to daily (for the D freq and the sd_rates). Options are pchip (monotone cubic between the middles of the months, default), linear (linear between the middles of the months), and step (the monthly rate on every day of the month).
+        nan_policy : str or dict
+            How the missing values are summed by the groupby. 'any' (default) will return NaN for a group if any of its values are NaN and 'all' will only return NaN if all of its values are NaN. A dict of the result column names and policies will apply them to individual columns (the other columns use 'any').
+        max_memory : int or None
+            The approximate memory budget of the processing in bytes. If an int is passed, the permits are split into shards of connected permits/waps (the permits that share a wap are always in the same shard) that are small enough for the budget (see _shard_row_bytes), the datasets are created and grouped for one shard at a time, and the grouped results are combined (iter_ts_shards returns the grouped results of the shards one at a time instead). The intermediate datasets (e.g. wap_allo_ts and usage_ts) are not kept on the object. Only the allo, metered_allo, and usage datasets can be sharded as the usage estimate and the sd_rates need the donor waps of all of the permits. None will process all of the permits at once.
 
         Results
         -------
@@ -717,37 +1180,163 @@ class AlloUsage(object):
             groupby.append('date')
 
         ### Check the dataset types
-        if not np.in1d(datasets, self.dataset_types).all():
+        if not np.isin(datasets, self.dataset_types).all():
             raise ValueError('datasets must be a list that includes one or more of ' + str(self.dataset_types))
 
-        ### Get the results and combine
-        all1 = []
-
-        if 'allo' in datasets:
-            self._get_allo_ts(freq)
-            all1.append(self.wap_allo_ts)
-        if 'metered_allo' in datasets:
-            self._get_metered_allo_ts(freq)
-            all1.append(self.metered_allo_ts)
-        if 'usage' in datasets:
-            self._split_usage_ts(freq, usage_allo_ratio)
-            all1.append(self.split_usage_ts)
-        if 'usage_est' in datasets:
-            usage_est = self._usage_estimation(freq, buffer_dis, min_months, est_method=usage_est_method)
-            all1.append(usage_est)
-        if 'sd_rates' in datasets:
-            sd_rates = self._agg_sd_rates(freq, usage_allo_ratio, buffer_dis, min_months, est_method=usage_est_method, est_gw_sd_lags=est_gw_sd_lags)
-            all1.append(sd_rates)
+        ### Process the shards of the permits separately
+        if max_memory is not None:
+            return self._get_ts_shards(datasets, freq, groupby, max_memory, usage_allo_ratio=usage_allo_ratio, remove_months=remove_months, nan_policy=nan_policy)
+
+        ### Get the results and combine (the usage doesn't depend on remove_months)
+        stage_args = {'_est_allo_ts': (freq, remove_months),
+                      '_allo_wap_spit': (freq, remove_months),
+                      '_get_usage': (freq, ),
+                      '_agg_usage': (freq, ),
+                      '_split_usage_ts': (freq, usage_allo_ratio, remove_months),
+                      '_get_metered_allo_ts': (freq, True, usage_allo_ratio, remove_months),
+                      '_usage_estimation': (freq, buffer_dis, min_months, usage_est_method, n_donors, idw_power, daily_method, remove_months),
+                      '_calc_sd_rates': (usage_allo_ratio, buffer_dis, min_months, usage_est_method, est_gw_sd_lags, n_donors, idw_power, daily_method, remove_months),
+                      '_agg_sd_rates': (freq, usage_allo_ratio, buffer_dis, min_months, usage_est_method, est_gw_sd_lags, n_donors, idw_power, daily_method, remove_months)}
+
+        ## The daily usage is the same for all freqs
+        stage_keys = dict(stage_args, _get_usage=())
+
+        def run_stage(stage):
+            return self._stage(getattr(self, stage), *stage_args[stage], key=stage_keys[stage])
+
+        ## The inputs of the cached stages are not needed
+        graph = {stage: ([] if self._is_cached(stage, stage_keys[stage]) else inputs) for stage, inputs in stage_inputs.items()}
+
+        targets = [dataset_stages[ds] for ds in self.dataset_types if ds in datasets]
+        results = run_graph(graph, targets, run_stage, self.stage_threads)
+
+        ## Set the outputs of this call back on the object (the concurrent stages of other freqs may have set the same attributes)
+        for stage in graph_nodes(graph, targets):
+            for attr, value in self._results.get(self._stage_key(stage, stage_keys[stage]), {}).items():
+                if attr is not None:
+                    setattr(self, attr, value)
+
+        all1 = [results[stage] for stage in targets]
 
         all2 = pd.concat(all1, axis=1)
 
         if 'total_allo' in all2:
             all2 = all2[all2['total_allo'].notnull()].copy()
 
-        if not np.in1d(groupby, pk).all():
+        if not np.isin(groupby, pk).all():
             all2 = self._merge_extra(all2, groupby)
 
-        all3 = all2.replace(np.nan, np.inf).groupby(groupby).sum().replace(np.inf, np.nan)
+        all3 = grp_sum(all2, groupby, nan_policy)
+        all3.name = 'results'
+
+        return all3
+
+
+    def _shard_row_bytes(self, datasets, freq):
+        """
+        Function to estimate the memory of the datasets of a permit/wap and day in bytes. The outputs of all of the stages of the datasets are kept while a shard is processed, so it's the pk columns and the value columns (shard_stage_cols) of each of the stages times the size of their values, times shard_copies for the intermediate copies within the stages (a heuristic). The rows of all of the stages are counted per day, which overestimates the stages of the longer freqs.
+        """
+        itemsize = 4 if (self.compact and (freq in compact_freqs)) else 8
+        stages = graph_nodes(stage_inputs, [dataset_stages[ds] for ds in datasets])
+        row_bytes = sum(len(pk) * 8 + shard_stage_cols[stage] * itemsize for stage in stages)
+
+        return row_bytes * shard_copies
+
+
+    def iter_ts_shards(self, datasets, freq, groupby, max_memory, **kwargs):
+        """
+        Function to create the time series of allocation and usage for shards of connected permits/waps (the permits that share a wap are always in the same shard) that fit within the max_memory, one shard at a time. Each shard is processed on a copy of the object, so the permits, waps, and results of the object aren't changed.
+
+        Parameters
+        ----------
+        datasets : list of str
+            The dataset types to be returned. Must be one or more of 'allo', 'metered_allo', and 'usage'.
+        freq : str
+            Pandas time frequency code for the time interval. Must be one of 'D', 'W', 'M', 'A', or 'A-JUN'.
+        groupby : list of str
+            The fields that should grouped by when returned (see get_ts).
+        max_memory : int
+            The approximate memory budget of the processing of a shard in bytes.
+        **kwargs
+            The other parameters of get_ts (except max_memory).
+
+        Yields
+        ------
+        DataFrame
+            The get_ts results of the permits of a shard. The groups of the shards are only separate when the groupby has the permit_id or wap.
+        """
+        if not np.isin(datasets, shard_datasets).all():
+            raise ValueError('max_memory can only be used with the datasets ' + str(shard_datasets))
+
+        groupby = list(groupby)
+        if not 'date' in groupby:
+            groupby.append('date')
+
+        waps0 = self.waps
+        permits0 = self.permits
+        cache_base0 = getattr(self, '_cache_base', None)
+
+        ## The estimated memory of the permit/waps from the days of the permits within the dates of the object
+        permit_dates = permits0.drop_duplicates('permit_id').set_index('permit_id')[['from_date', 'to_date']]
+        from_dates = permit_dates['from_date'].clip(lower=self.from_date).fillna(self.from_date)
+        to_dates = permit_dates['to_date'].clip(upper=self.to_date).fillna(self.to_date)
+        n_days = ((to_dates - from_dates).dt.days + 1).clip(lower=1)
+
+        pair_bytes = n_days.reindex(np.asarray(waps0['permit_id'], dtype=object)).fillna(1).values * self._shard_row_bytes(datasets, freq)
+
+        shards = connected_shards(waps0['permit_id'], waps0['wap'], max_memory, pair_bytes)
+        if len(shards) == 0:
+            yield self.get_ts(datasets, freq, groupby, **kwargs)
+            return
+
+        for shard in np.unique(shards):
+            waps1 = waps0[shards == shard]
+            permit_ids = np.sort(np.asarray(waps1['permit_id'].unique(), dtype=object))
+
+            ## A copy of the object with only the permits of the shard and without the results of the object
+            a1 = copy.copy(self)
+            for attrs in stage_outputs.values():
+                for attr in attrs:
+                    a1.__dict__.pop(attr, None)
+
+            setattr(a1, 'waps', waps1)
+            setattr(a1, 'permits', permits0[permits0['permit_id'].isin(permit_ids)])
+            setattr(a1, '_wap_xy', None)
+            setattr(a1, '_allo_views', {})
+            setattr(a1, '_results', {})
+            setattr(a1, '_stage_locks', {})
+            setattr(a1, '_stage_locks_lock', threading.Lock())
+            setattr(a1, '_local', threading.local())
+            if cache_base0 is not None:
+                setattr(a1, '_cache_base', cache_base0 + (cache_key(tuple(permit_ids)), ))
+
+            shard1 = a1.get_ts(datasets, freq, groupby[:], **kwargs)
+            del a1
+
+            yield shard1
+
+
+    def _get_ts_shards(self, datasets, freq, groupby, max_memory, nan_policy='any', **kwargs):
+        """
+        Function to combine the grouped results of the shards of iter_ts_shards. The results of each shard are summed into the combined results as they're created (or concatenated at the end when the groupby has the permit_id or wap, as the groups of the shards are then separate) so only one shard is processed at a time.
+        """
+        ## The shards have separate permits and waps, so their groups only need to be combined when the groupby has neither
+        disjoint = ('permit_id' in groupby) or ('wap' in groupby)
+
+        shards = self.iter_ts_shards(datasets, freq, groupby, max_memory, nan_policy=nan_policy, **kwargs)
+
+        if disjoint:
+            all3 = pd.concat(list(shards)).sort_index()
+        else:
+            all3 = None
+            for shard1 in shards:
+                if all3 is None:
+                    all3 = shard1
+                else:
+                    all3 = grp_sum(pd.concat([all3, shard1]), list(all3.index.names), nan_policy)
+
+                del shard1
+
         all3.name = 'results'
 
         return all3
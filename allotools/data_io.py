@@ -4,15 +4,20 @@ Created on Wed Oct  3 16:40:35 2018
 
 @author: michaelek
 """
-import io
 import os
+import json
+import pickle
+import hashlib
+from datetime import datetime
 # import yaml
 import pandas as pd
 # from tethysts import Tethys
 # from tethysts import utils
-import copy
+import numpy as np
+import queue
+import threading
 import booklet
-# from multiprocessing.pool import ThreadPool
+from multiprocessing.pool import ThreadPool
 
 # import params
 
@@ -23,6 +28,23 @@ pd.options.display.max_columns = 10
 
 base_path = os.path.realpath(os.path.dirname(__file__))
 
+cube_values_file = 'values.bin'
+cube_index_file = 'index.npy'
+cube_meta_file = 'meta.json'
+
+epoch = pd.Timestamp('1970-01-01')
+
+permit_index_ext = '.index.pkl'
+permit_index_version = 3
+
+usage_state_version = 1
+
+cache_ext = '.cache.pkl'
+cache_version = 2
+
+## The known station properties and their dtypes. Any other properties are kept in the properties column of the waps table.
+wap_properties = {'sep_distance': 'float64', 'pump_aq_trans': 'float64', 'pump_aq_s': 'float64', 'upper_aq_trans': 'float64', 'upper_aq_s': 'float64', 'lower_aq_trans': 'float64', 'lower_aq_s': 'float64', 'aqt_k': 'float64', 'aqt_thick': 'float64', 'aqt_s': 'float64', 'stream_k': 'float64', 'stream_thick': 'float64', 'stream_width': 'float64', 'stream_depletion_ratio': 'float64', 'n_days': 'float64', 'method': 'category', 'sd_ratio': 'float64'}
+
 # with open(os.path.join(base_path, 'parameters.yml')) as param:
 #     param = yaml.safe_load(param)
 
@@ -44,93 +66,1032 @@ base_path = os.path.realpath(os.path.dirname(__file__))
 #     return permits
 
 
-def get_usage_data(usage_path, waps=None, from_date=None, to_date=None):
+def _date_slice(data, from_date=None, to_date=None, time_col='time'):
+    """
+    Function to restrict a single station's usage DataFrame to a date window. The row offsets of the window are located with a binary search on the (sorted) time column so that only the requested rows are sliced out and kept.
+    """
+    if (from_date is None) and (to_date is None):
+        return data
+
+    times = data[time_col].values
+    if not data[time_col].is_monotonic_increasing:
+        bool1 = np.ones(len(times), dtype=bool)
+        if from_date is not None:
+            bool1 = bool1 & (times >= from_date.to_datetime64())
+        if to_date is not None:
+            bool1 = bool1 & (times <= to_date.to_datetime64())
+
+        return data[bool1]
+
+    start = 0
+    end = len(times)
+    if from_date is not None:
+        start = times.searchsorted(from_date.to_datetime64(), side='left')
+    if to_date is not None:
+        end = times.searchsorted(to_date.to_datetime64(), side='right')
+
+    return data.iloc[start:end]
+
+
+def _get_wap_usage(f, wap, from_date=None, to_date=None):
+    """
+    Function to read and window the usage data of a single wap from an open usage booklet.
+    """
+    data = f.get(wap)
+    if data is not None:
+        data0 = _date_slice(data, from_date, to_date)
+        if not data0.empty:
+            data1 = data0.rename(columns={wap: 'water_use'})
+            data1['wap'] = wap
+
+            return data1
+
+
+def _get_wap_arrays(f, wap, from_date=None, to_date=None):
+    """
+    Function to read and window the usage data of a single wap from an open usage booklet as a tuple of the time and usage arrays.
+    """
+    data = f.get(wap)
+    if data is not None:
+        data0 = _date_slice(data, from_date, to_date)
+        if not data0.empty:
+            return data0['time'].values, data0[wap].values
+
+
+class UsageCube(object):
+    """
+    Memory-mapped reader for a usage cube created by build_usage_cube. The cube holds the daily usage of every wap as one contiguous block of values in a single file with an index of the wap offsets and date ranges. Reads for a wap and date window are slices of the mapped file, so nothing is deserialised and multiple processes can share the same file through the OS page cache.
+
+    Parameters
+    ----------
+    cube_path : str or pathlib.Path
+        Path to the usage cube folder.
+    """
+    def __init__(self, cube_path):
+        """
+
+        """
+        with open(os.path.join(cube_path, cube_meta_file)) as f:
+            meta = json.load(f)
+
+        index = np.load(os.path.join(cube_path, cube_index_file))
+
+        self.cube_path = cube_path
+        self.dtype = np.dtype(meta['dtype'])
+        self.index = {str(wap): (int(offset), int(start), int(length)) for wap, offset, start, length in index}
+
+        if meta['n_values'] > 0:
+            self.values = np.memmap(os.path.join(cube_path, cube_values_file), dtype=self.dtype, mode='r', shape=(meta['n_values'],))
+        else:
+            self.values = np.empty(0, dtype=self.dtype)
+
+    def __contains__(self, wap):
+        return wap in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def keys(self):
+        return self.index.keys()
+
+    def _slice(self, wap, from_date=None, to_date=None):
+        """
+        Get the start and end positions in the values array and the start day of a wap for a date window.
+        """
+        offset, start, length = self.index[wap]
+
+        i_start = 0
+        i_end = length
+        if from_date is not None:
+            i_start = min(max((pd.Timestamp(from_date).floor('D') - epoch).days - start, 0), length)
+        if to_date is not None:
+            i_end = max(min((pd.Timestamp(to_date).floor('D') - epoch).days - start + 1, length), i_start)
+
+        return offset + i_start, offset + i_end, start + i_start
+
+    def n_days(self, wap, from_date=None, to_date=None):
+        """
+        The number of days stored for a wap within a date window (including days without data).
+        """
+        if wap not in self.index:
+            return 0
+
+        pos_start, pos_end, day_start = self._slice(wap, from_date, to_date)
+
+        return pos_end - pos_start
+
+    def get(self, wap, from_date=None, to_date=None):
+        """
+        Get the daily dates and values of a wap for a date window. The values are a read-only view on the mapped file. Days without data are NaN.
+
+        Returns
+        -------
+        tuple of DatetimeIndex and ndarray, or None if the wap is not in the cube
+        """
+        if wap not in self.index:
+            return None
+
+        pos_start, pos_end, day_start = self._slice(wap, from_date, to_date)
+
+        values = self.values[pos_start:pos_end]
+        dates = pd.date_range(epoch + pd.Timedelta(days=day_start), periods=len(values), freq='D')
+
+        return dates, values
+
+    def get_usage(self, waps, from_date=None, to_date=None):
+        """
+        Get the usage of many waps for a date window in the same structure as get_usage_data (in the order of the waps). The slices of all the waps are gathered in one pass and days without data are removed.
+
+        Returns
+        -------
+        DataFrame
+            with the columns 'time', 'water_use', and 'wap'
+        """
+        waps = [w for w in waps if w in self.index]
+        slices = [self._slice(w, from_date, to_date) for w in waps]
+        lengths = np.array([e - s for s, e, d in slices], dtype='int64')
+
+        if lengths.sum() == 0:
+            return pd.DataFrame(columns=['time', 'water_use', 'wap'])
+
+        values = np.concatenate([self.values[s:e] for s, e, d in slices])
+        days = np.repeat(np.array([d for s, e, d in slices], dtype='int64') - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths) + np.arange(lengths.sum())
+        wap_pos = np.repeat(np.arange(len(waps)), lengths)
+
+        bool1 = ~np.isnan(values)
+
+        data1 = pd.DataFrame({'time': days[bool1].astype('datetime64[D]').astype('datetime64[ns]'), 'water_use': values[bool1], 'wap': np.array(waps, dtype=object)[wap_pos[bool1]]})
+
+        return data1
+
+    def close(self):
+        """
+        Release the values of the cube. The file is unmapped once the views returned by get are also released (so they stay readable after the cube is closed).
+        """
+        self.values = None
+
+
+
+def is_usage_cube(usage_path):
+    """
+    Function to determine whether the usage_path is a usage cube (rather than a usage booklet).
+    """
+    return os.path.isdir(usage_path) and os.path.isfile(os.path.join(usage_path, cube_meta_file))
+
+
+def build_usage_cube(usage_path, cube_path, dtype='float64'):
+    """
+    Function to compile the usage booklet into a usage cube. A usage cube is a folder with all of the daily usage values stored contiguously in a single binary file (one block per wap covering the full date range of the wap) and an index of the wap offsets and start dates. The cube can be passed as the usage_path to get_usage_data and AlloUsage in place of the usage booklet.
+
+    Parameters
+    ----------
+    usage_path : str or pathlib.Path
+        Path to booklet file structured with the keys as wap/station id as pandas dataframes with the columns 'time' and {station_id}. The data must be daily.
+    cube_path : str or pathlib.Path
+        Path to the output folder. It will be created if it doesn't exist.
+    dtype : str
+        The numpy dtype of the stored values.
+
+    Returns
+    -------
+    str
+        The cube_path
+    """
+    os.makedirs(cube_path, exist_ok=True)
+
+    dtype = np.dtype(dtype)
+    index = []
+    offset = 0
+
+    with booklet.open(usage_path) as f, open(os.path.join(cube_path, cube_values_file), 'wb') as v:
+        for wap, data in f.items():
+            if (data is None) or data.empty:
+                continue
+
+            data = data.sort_values('time')
+            times = pd.DatetimeIndex(data['time'])
+            if not (times == times.floor('D')).all() or times.has_duplicates:
+                raise ValueError('The usage data for ' + str(wap) + ' is not daily.')
+
+            days = (times - epoch).days.values
+            start = days[0]
+            length = days[-1] - start + 1
+
+            block = np.full(length, np.nan, dtype=dtype)
+            block[days - start] = data[wap].values
+
+            v.write(block.tobytes())
+            index.append((wap, offset, start, length))
+            offset += length
+
+    max_len = max([len(i[0]) for i in index] + [1])
+    index1 = np.array(index, dtype=[('wap', 'U' + str(max_len)), ('offset', 'int64'), ('start', 'int64'), ('length', 'int64')])
+    np.save(os.path.join(cube_path, cube_index_file), index1)
+
+    with open(os.path.join(cube_path, cube_meta_file), 'w') as f:
+        json.dump({'dtype': dtype.name, 'n_values': int(offset), 'n_waps': len(index1)}, f)
+
+    return cube_path
+
+
+def _read_usage(usage_path, waps, from_date=None, to_date=None, threads=1, get_fun=_get_wap_usage):
     """
+    Generator that reads the waps from the usage booklet one at a time (in the order of the waps) with get_fun, optionally using a pool of threads. When threads are used, the waps are read in blocks so that only one block of decoded data is ever held by the pool.
+    """
+    if threads > 1:
+        local = threading.local()
+        handles = []
+
+        def get_wap(wap):
+            f = getattr(local, 'f', None)
+            if f is None:
+                f = booklet.open(usage_path)
+                local.f = f
+                handles.append(f)
+
+            return get_fun(f, wap, from_date, to_date)
+
+        block_size = threads * 16
+
+        try:
+            with ThreadPool(threads) as pool:
+                for i in range(0, len(waps), block_size):
+                    for data in pool.map(get_wap, waps[i:(i + block_size)], chunksize=16):
+                        yield data
+        finally:
+            for f in handles:
+                f.close()
+    else:
+        with booklet.open(usage_path) as f:
+            for wap in waps:
+                yield get_fun(f, wap, from_date, to_date)
+
+
+def iter_usage_data(usage_path, waps=None, from_date=None, to_date=None, batch_size=1000, max_rows=None, threads=1):
+    """
+    Generator version of get_usage_data that yields the usage data in batches of whole waps. A wap is never split between batches.
+
+    Parameters
+    ----------
+    usage_path : str or pathlib.Path
+        Path to booklet file structured with the keys as wap/station id as pandas dataframes with the columns 'time' and {station_id}, or a path to a usage cube created by build_usage_cube.
+    waps : list of str or None
+        The waps to extract. None will extract all waps.
+    from_date : str, Timestamp, or None
+        The start date of the returned data. None will return all data from the start of the record.
+    to_date : str, Timestamp, or None
+        The end date of the returned data. None will return all data to the end of the record.
+    batch_size : int or None
+        The max number of waps per batch. None will put all of the waps into a single batch.
+    max_rows : int or None
+        The max number of rows per batch. A batch is yielded as soon as it reaches this number of rows, so a single wap with more rows than max_rows will be yielded on its own. For usage cubes the rows are counted as days (including the days without data) from the cube index before reading.
+    threads : int
+        The number of worker threads used to read and decode the waps. Not used for usage cubes.
 
+    Returns
+    -------
+    Generator of DataFrames
+        with the columns 'time', 'water_use', and 'wap'
     """
-    data_list = []
-    with booklet.open(usage_path) as f:
+    if from_date is not None:
+        from_date = pd.Timestamp(from_date)
+    if to_date is not None:
+        to_date = pd.Timestamp(to_date)
+
+    if is_usage_cube(usage_path):
+        cube = UsageCube(usage_path)
+        try:
+            if waps is None:
+                waps = list(cube.keys())
+
+            batch = []
+            n_rows = 0
+            for wap in waps:
+                n_days = cube.n_days(wap, from_date, to_date)
+                if n_days == 0:
+                    continue
+
+                batch.append(wap)
+                n_rows += n_days
+
+                if ((batch_size is not None) and (len(batch) >= batch_size)) or ((max_rows is not None) and (n_rows >= max_rows)):
+                    data = cube.get_usage(batch, from_date, to_date)
+                    batch = []
+                    n_rows = 0
+                    if not data.empty:
+                        yield data
+
+            if batch:
+                data = cube.get_usage(batch, from_date, to_date)
+                if not data.empty:
+                    yield data
+        finally:
+            cube.close()
+
+    else:
         if waps is None:
-            waps = f.keys()
+            with booklet.open(usage_path) as f:
+                waps = list(f.keys())
 
-        for wap in waps:
-        # for stn_id, data in f.items():
-            data = f.get(wap)
-            if data is not None:
-                data1 = data.rename(columns={wap: 'water_use'})
-                data1['wap'] = wap
-                data_list.append(data1)
+        batch = []
+        n_rows = 0
+        for data in _read_usage(usage_path, list(waps), from_date, to_date, threads):
+            if data is None:
+                continue
+
+            batch.append(data)
+            n_rows += len(data)
+
+            if ((batch_size is not None) and (len(batch) >= batch_size)) or ((max_rows is not None) and (n_rows >= max_rows)):
+                yield pd.concat(batch)
+                batch = []
+                n_rows = 0
+
+        if batch:
+            yield pd.concat(batch)
+
+
+def _prefetch(iterable, size):
+    """
+    Generator that runs an iterable on a background thread and yields its items through a queue of up to size items, so that the production of the items overlaps with their consumption. Exceptions of the iterable are raised in the consumer. The thread is only started on the first next() and it's stopped when the generator is closed (or garbage collected) before the end.
+    """
+    q = queue.Queue(size)
+    stop = threading.Event()
+
+    def put(item):
+        ## Never block on a full queue after the consumer has stopped
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((False, item)):
+                    break
+            put((True, None))
+        except Exception as err:
+            put((True, err))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            is_end, item = q.get()
+            if is_end:
+                if item is not None:
+                    raise item
+                break
+
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def iter_wap_usage(usage_path, waps=None, from_date=None, to_date=None, threads=1, prefetch=0):
+    """
+    Generator that yields the usage data one wap at a time as numpy arrays (in the order of the waps). Waps without data in the date window are skipped. This avoids building a DataFrame per wap for consumers that process the waps individually.
+
+    Parameters
+    ----------
+    usage_path : str or pathlib.Path
+        Path to booklet file structured with the keys as wap/station id as pandas dataframes with the columns 'time' and {station_id}, or a path to a usage cube created by build_usage_cube.
+    waps : list of str or None
+        The waps to extract. None will extract all waps.
+    from_date : str, Timestamp, or None
+        The start date of the returned data. None will return all data from the start of the record.
+    to_date : str, Timestamp, or None
+        The end date of the returned data. None will return all data to the end of the record.
+    threads : int
+        The number of worker threads used to read and decode the waps from a usage booklet.
+    prefetch : int
+        The number of waps that are read and decoded ahead of the consumer on a background thread. 0 will read the waps on the calling thread.
 
-    data2 = pd.concat(data_list)
+    Returns
+    -------
+    Generator of tuples
+        of (wap, times as datetime64[ns] ndarray, usage ndarray)
+    """
+    if from_date is not None:
+        from_date = pd.Timestamp(from_date)
+    if to_date is not None:
+        to_date = pd.Timestamp(to_date)
+
+    def read():
+        if is_usage_cube(usage_path):
+            cube = UsageCube(usage_path)
+            try:
+                waps1 = list(cube.keys()) if waps is None else waps
+                for wap in waps1:
+                    data = cube.get(wap, from_date, to_date)
+                    if data is None:
+                        continue
+                    dates, values = data
+                    bool1 = ~np.isnan(values)
+                    if bool1.any():
+                        yield wap, dates.values[bool1], values[bool1]
+            finally:
+                cube.close()
+
+        else:
+            if waps is None:
+                with booklet.open(usage_path) as f:
+                    waps1 = list(f.keys())
+            else:
+                waps1 = list(waps)
+
+            for wap, data in zip(waps1, _read_usage(usage_path, waps1, from_date, to_date, threads, _get_wap_arrays)):
+                if data is not None:
+                    yield wap, data[0], data[1]
+
+    if prefetch > 0:
+        return _prefetch(read(), prefetch)
+    else:
+        return read()
+
+
+def get_usage_data(usage_path, waps=None, from_date=None, to_date=None, threads=1):
+    """
+    Function to get the usage data from the usage booklet for a list of waps.
+
+    Parameters
+    ----------
+    usage_path : str or pathlib.Path
+        Path to booklet file structured with the keys as wap/station id as pandas dataframes with the columns 'time' and {station_id}, or a path to a usage cube created by build_usage_cube.
+    waps : list of str or None
+        The waps to extract. None will extract all waps.
+    from_date : str, Timestamp, or None
+        The start date of the returned data. None will return all data from the start of the record.
+    to_date : str, Timestamp, or None
+        The end date of the returned data. None will return all data to the end of the record.
+    threads : int
+        The number of worker threads used to read and decode the waps. Each thread uses its own booklet file handle. The output order is always the order of the waps regardless of the number of threads.
+
+    Returns
+    -------
+    DataFrame
+        with the columns 'time', 'water_use', and 'wap'
+    """
+    data2 = next(iter_usage_data(usage_path, waps, from_date, to_date, batch_size=None, threads=threads), None)
+
+    if data2 is None:
+        data2 = pd.DataFrame(columns=['time', 'water_use', 'wap'])
 
     return data2
 
 
-def allo_filter(permits_path, from_date=None, to_date=None, permit_filter=None, wap_filter=None, only_consumptive=True, include_hydroelectric=False, use_type_mapping={}, ignore_constraints=True):
+def _usage_state_key(usage_path, freq, wap):
     """
-    Function to filter consents and WAPs in various ways.
+    Function to create the usage state store key of a wap and time frequency from a usage booklet.
+    """
+    return os.path.abspath(str(usage_path)) + '|' + freq + '|' + wap
+
+
+def read_usage_state(state_path, usage_path, freq, waps, from_date, to_date):
+    """
+    Function to read the stored usage aggregates and watermarks of a list of waps from a usage state store. Only the states that were created from the same usage booklet with the same from_date and have a watermark before the to_date are returned; the others need to be reprocessed from the from_date.
 
     Parameters
     ----------
-    server : str
-        The server of the Hydro db.
-    from_date : str
+    state_path : str or pathlib.Path
+        Path to the usage state booklet.
+    usage_path : str or pathlib.Path
+        Path to the usage booklet that the states were created from.
+    freq : str
+        Pandas time frequency code of the stored aggregates.
+    waps : list of str
+        The waps to read.
+    from_date : Timestamp
+        The start date of the usage data of the stored aggregates.
+    to_date : Timestamp
+        The end date of the requested usage data.
+
+    Returns
+    -------
+    dict
+        of wap: dict with the keys 'watermark' (the last processed date), 'total_usage' (Series of the aggregated usage indexed by date), and 'quality_code' (Series of the flagged daily quality codes indexed by date)
+    """
+    states = {}
+    if not os.path.exists(state_path):
+        return states
+
+    with booklet.open(state_path) as f:
+        for wap in waps:
+            state = f.get(_usage_state_key(usage_path, freq, wap))
+            if state is None:
+                continue
+            if (state['version'] != usage_state_version) or (state['from_date'] != from_date) or (state['watermark'] > to_date):
+                continue
+
+            states[wap] = state
+
+    return states
+
+
+def write_usage_state(state_path, usage_path, freq, states, from_date):
+    """
+    Function to write the usage aggregates and watermarks of waps to a usage state store. Existing states of the same usage booklet, waps, and time frequency are overwritten, except for the states with the same from_date and a later watermark (e.g. when the usage was processed to an earlier to_date) so that the stored period is never shortened.
+
+    Parameters
+    ----------
+    state_path : str or pathlib.Path
+        Path to the usage state booklet. It will be created if it doesn't exist.
+    usage_path : str or pathlib.Path
+        Path to the usage booklet that the states were created from.
+    freq : str
+        Pandas time frequency code of the aggregates.
+    states : dict
+        of wap: dict with the keys 'watermark', 'total_usage', and 'quality_code' as returned by read_usage_state.
+    from_date : Timestamp
+        The start date of the usage data of the aggregates.
+
+    Returns
+    -------
+    None
+    """
+    if os.path.exists(state_path):
+        f = booklet.open(state_path, 'w')
+    else:
+        f = booklet.open(state_path, 'n', key_serializer='str', value_serializer='pickle')
+
+    with f:
+        for wap, state in states.items():
+            key = _usage_state_key(usage_path, freq, wap)
+            old_state = f.get(key)
+            if (old_state is not None) and (old_state['version'] == usage_state_version) and (old_state['from_date'] == from_date) and (old_state['watermark'] > state['watermark']):
+                continue
+
+            state1 = dict(state, version=usage_state_version, from_date=from_date)
+            f[key] = state1
+
+
+def _permit_predicate(from_date=None, to_date=None, permit_filter=None, include_hydroelectric=True, use_type_mapping={}):
+    """
+    Function to create the permit level predicate used during the scan of the permits booklet. It only rejects permits that would be removed by the filters in allo_filter.
+    """
+    filter_cols = ['permit_id', 'hydro_feature', 'permit_status', 'use_type']
+    if isinstance(permit_filter, dict):
+        permit_filter1 = {k: set(v) for k, v in permit_filter.items() if k in filter_cols}
+    else:
+        permit_filter1 = {}
+
+    start_time = pd.Timestamp(from_date).to_pydatetime() if isinstance(from_date, str) else None
+    end_time = pd.Timestamp(to_date).to_pydatetime() if isinstance(to_date, str) else None
+
+    def predicate(p1):
+        if (p1['max_rate'] is None) or not (p1['max_rate'] > 0):
+            return False
+
+        use_type = use_type_mapping.get(p1['use_type'], p1['use_type'])
+        if (not include_hydroelectric) and (use_type == 'hydro_electric'):
+            return False
+
+        for k, v in permit_filter1.items():
+            val = use_type if k == 'use_type' else p1[k]
+            if val not in v:
+                return False
+
+        if (start_time is not None) or (end_time is not None):
+            try:
+                p_from = datetime.fromisoformat(str(p1['from_date']))
+                p_to = datetime.fromisoformat(str(p1['to_date']))
+
+                if (start_time is not None) and ((p_to - start_time).days <= 31):
+                    return False
+                if (end_time is not None) and ((end_time - p_from).days <= 31):
+                    return False
+            except (ValueError, TypeError):
+                pass
+
+        return True
+
+    return predicate
+
+
+def _wap_predicate(wap_filter=None):
+    """
+    Function to create the wap level predicate used during the scan of the permits booklet. It only rejects waps that would be removed by the filters in allo_filter.
+    """
+    if isinstance(wap_filter, list):
+        waps = set(wap_filter)
+
+        def predicate(w1, props):
+            return w1['wap'] in waps
+
+    elif isinstance(wap_filter, dict):
+        wap_filter1 = {k: set(v) for k, v in wap_filter.items()}
+
+        def predicate(w1, props):
+            for k, v in wap_filter1.items():
+                val = w1[k] if k in w1 else props.get(k)
+                if val not in v:
+                    return False
+
+            return True
+
+    else:
+        predicate = None
+
+    return predicate
+
+
+def _to_numeric(values, name):
+    """
+    Function to convert the values of a column to numeric. The values that can't be converted are set to NaN and their number is printed.
+    """
+    values1 = pd.Series(values, dtype=object)
+    values2 = pd.to_numeric(values1, errors='coerce')
+
+    n_bad = int((values2.isnull() & values1.notnull()).sum())
+    if n_bad:
+        print(f'{n_bad} {name} values are not numeric and have been set to NaN.')
+
+    return values2
+
+
+def flatten_permits(permits_path, from_date=None, to_date=None, permit_filter=None, wap_filter=None, include_hydroelectric=True, use_type_mapping={}):
+    """
+    Function to flatten the exercised consumptive takes in the permits booklet into a permits table and a waps table. The filters are evaluated during the scan so that permits and waps that would be filtered out by allo_filter are rejected as early as possible. A permit_id can have more than one record (e.g. one per hydro_feature), so the permit level filters only reject the permit row of a record and the wap level filters only reject wap rows; the permits without waps and the waps without permits of the same permit_id (over all of its records) are removed by allo_filter. When permit_filter is a list of permit ids, the permits are looked up directly by key rather than scanning the whole booklet. The filtering is not complete (allo_filter applies the full filters afterwards); no filters will return all of the exercised consumptive takes.
+
+    The waps table always has the columns permit_id, wap, lat, lon, the station properties declared in wap_properties (with their declared dtypes), and a properties column that holds a dict of any other station properties (or None).
+
+    The permits table has the from_month and to_month of the season of the abstraction condition (the from_month and to_month keys of the condition, e.g. 10 and 4 for October to April). They are NaN when the condition has no season.
+
+    Parameters
+    ----------
+    permits_path : str or pathlib.Path
+        Path to booklet file structured according to the nzpermits package.
+    from_date : str or None
         The start date for the time series.
-    to_date: str
+    to_date: str or None
         The end date for the time series.
-    permit_filter : dict
-        If permit_id_filter is a list, then it should represent the columns from the permit table that should be returned. If it's a dict, then the keys should be the column names and the values should be the filter on those columns.
-    wap_filter : dict
-        If wap_filter is a list, then it should represent the columns from the wap table that should be returned. If it's a dict, then the keys should be the column names and the values should be the filter on those columns.
-    only_consumptive : bool
-        Should only the consumptive takes be returned? Default True
+    permit_filter : list, dict, or None
+        The permit_filter as passed to allo_filter.
+    wap_filter : list, dict, or None
+        The wap_filter as passed to allo_filter.
     include_hydroelectric : bool
-        Should hydro-electric takes be included? Default False
+        Should hydro-electric takes be included?
+    use_type_mapping : dict
+        Dict mapping of the detailed use types to more generic use types.
 
     Returns
     -------
-    Three DataFrames
-        Representing the filters on the ExternalSites, CrcAllo, and CrcWapAllo
+    Two DataFrames
+        The waps and the permits
     """
-    ### Process the premits dict into the three dataframes
-    waps0 = []
-    permits0 = []
+    permit_pred = _permit_predicate(from_date, to_date, permit_filter, include_hydroelectric, use_type_mapping)
+    wap_pred = _wap_predicate(wap_filter)
+
+    permit_cols = ['permit_id', 'hydro_feature', 'permit_status', 'use_type', 'max_rate', 'from_date', 'to_date', 'from_month', 'to_month']
+    wap_cols = ['permit_id', 'wap', 'lat', 'lon']
+    wap_cols.extend(wap_properties)
+
+    permits0 = {c: [] for c in permit_cols}
+    waps0 = {c: [] for c in wap_cols}
+    extra0 = []
+
     with booklet.open(permits_path) as f:
-        for p in f.values():
+        if isinstance(permit_filter, list):
+            permit_ids = pd.unique(pd.Series(permit_filter, dtype=object))
+            values = [f.get(permit_id) for permit_id in permit_ids]
+            if any([p is None for p in values]):
+                ## Keys are not the permit ids
+                permit_ids = set(permit_ids)
+                values = (p for p in f.values() if p['permit_id'] in permit_ids)
+        else:
+            values = f.values()
+
+        for p in values:
             if p['exercised']:
                 if p['activity']['activity_type'] == 'consumptive take water':
                     conditions = p['activity']['conditions']
-                    if not ignore_constraints:
-                        raise NotImplementedError('contraints have not been implemented')
 
                     condition = conditions[0]
 
+                    limit_value = None
                     if condition['condition_type'] == 'abstraction':
                         limit =  condition['limit']
                         if limit['period'] == 'D':
                             limit_value = limit['value'] / 60 / 60 / 24 * 1000
 
-                    p1 = {'permit_id': p['permit_id'], 'hydro_feature': p['activity']['feature'], 'permit_status': p['status'], 'use_type': p['activity']['primary_purpose'], 'max_rate': limit_value, 'from_date': p['commencement_date']}
+                    p1 = {'permit_id': p['permit_id'], 'hydro_feature': p['activity']['feature'], 'permit_status': p['status'], 'use_type': p['activity']['primary_purpose'], 'max_rate': limit_value, 'from_date': p['commencement_date'], 'from_month': condition.get('from_month'), 'to_month': condition.get('to_month')}
 
                     if 'effective_end_date' in p:
                         p1.update({'to_date': p['effective_end_date']})
                     else:
                         p1.update({'to_date': p['expiry_date']})
 
-                    permits0.extend([p1])
+                    ## The permit level filters only reject the permit row of the record and the wap level filters only reject the wap rows. The permits and waps of a permit_id are matched across all of its records by allo_filter.
+                    if permit_pred(p1):
+                        for c in permit_cols:
+                            permits0[c].append(p1[c])
 
                     for s in p['activity']['stations']:
                         w1 = {'permit_id': p['permit_id'], 'wap': s['station_id'], 'lat': s['geometry']['coordinates'][1], 'lon': s['geometry']['coordinates'][0]}
-                        if 'properties' in s:
-                            if s['properties']:
-                                w1.update(**s['properties'])
-                        waps0.extend([w1])
-
-    waps = pd.DataFrame(waps0)
-    permits = pd.DataFrame(permits0)
+                        props = s.get('properties') or {}
+                        if (wap_pred is not None) and not wap_pred(w1, props):
+                            continue
+
+                        for c in wap_cols[:4]:
+                            waps0[c].append(w1[c])
+                        for c in wap_cols[4:]:
+                            waps0[c].append(props.get(c))
+
+                        extra = {k: v for k, v in props.items() if k not in wap_properties}
+                        extra0.append(extra if extra else None)
+
+    ### Convert the columns to arrays
+    waps = pd.DataFrame({'permit_id': pd.Series(waps0['permit_id'], dtype=object), 'wap': pd.Series(waps0['wap'], dtype=object), 'lat': pd.Series(waps0['lat'], dtype='float64'), 'lon': pd.Series(waps0['lon'], dtype='float64')})
+    for c, dtype in wap_properties.items():
+        if dtype == 'category':
+            waps[c] = pd.Series(waps0[c], dtype=object).astype(dtype)
+        else:
+            waps[c] = _to_numeric(waps0[c], c).astype(dtype)
+    waps['properties'] = pd.Series(extra0, dtype=object)
+
+    permits = pd.DataFrame({c: pd.Series(v, dtype=object) for c, v in permits0.items()})
+    permits['max_rate'] = pd.to_numeric(permits['max_rate'], errors='coerce').astype('float64')
+    permits['from_month'] = _to_numeric(permits['from_month'], 'from_month').astype('float64')
+    permits['to_month'] = _to_numeric(permits['to_month'], 'to_month').astype('float64')
     permits['from_date'] = pd.to_datetime(permits['from_date'])
     permits['to_date'] = pd.to_datetime(permits['to_date'])
 
+    return waps, permits
+
+
+def file_checksum(file_path):
+    """
+    Function to calculate the blake2b checksum of a file.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            h.update(chunk)
+
+    return h.hexdigest()
+
+
+def path_fingerprint(path):
+    """
+    Function to create a fingerprint of a file or of all of the files in a folder (e.g. a usage cube) from their absolute paths, sizes, and modification times. It doesn't read the files, so it's cheap for large booklets, but a file that is rewritten with the same size and modification time isn't detected.
+    """
+    if os.path.isdir(path):
+        file_paths = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+    else:
+        file_paths = [path]
+
+    h = hashlib.blake2b(digest_size=16)
+    for file_path in file_paths:
+        if os.path.isfile(file_path):
+            stat = os.stat(file_path)
+            h.update(repr((os.path.abspath(file_path), stat.st_size, stat.st_mtime_ns)).encode())
+
+    return h.hexdigest()
+
+
+def _canonical(obj):
+    """
+    Function to convert the parts of a cache key into a canonical JSON-compatible form. Dicts and sets are sorted, arrays (and pandas objects) are hashed from their bytes, and Timestamps are converted to ISO strings.
+    """
+    if isinstance(obj, dict):
+        items = [(_canonical(k), _canonical(v)) for k, v in obj.items()]
+        return ['dict', sorted(items, key=lambda i: json.dumps(i[0], sort_keys=True, default=str))]
+    elif isinstance(obj, (set, frozenset)):
+        return ['set', sorted([_canonical(i) for i in obj], key=lambda i: json.dumps(i, sort_keys=True, default=str))]
+    elif isinstance(obj, (list, tuple)):
+        return [type(obj).__name__, [_canonical(i) for i in obj]]
+    elif isinstance(obj, (pd.Series, pd.Index)):
+        return _canonical(obj.to_numpy())
+    elif isinstance(obj, np.ndarray):
+        if obj.dtype.hasobject:
+            return ['ndarray', [_canonical(i) for i in obj.tolist()]]
+        data = np.ascontiguousarray(obj)
+        return ['ndarray', data.dtype.str, list(data.shape), hashlib.blake2b(data.tobytes(), digest_size=16).hexdigest()]
+    elif isinstance(obj, (pd.Timestamp, datetime)):
+        return ['datetime', obj.isoformat()]
+    elif isinstance(obj, np.generic):
+        return _canonical(obj.item())
+    elif (obj is None) or isinstance(obj, (bool, int, float, str)):
+        return obj
+    else:
+        return ['repr', repr(obj)]
+
+
+def cache_key(*parts):
+    """
+    Function to create the key of a cache entry from the fingerprints of the source files and the parameters that the entry depends on. The parts are converted to a canonical form first, so the keys don't depend on the order of dicts and sets and all of the values of large arrays and lists are included.
+    """
+    canonical = json.dumps(_canonical((cache_version,) + parts), sort_keys=True, default=str)
+    h = hashlib.blake2b(canonical.encode(), digest_size=16)
+
+    return h.hexdigest()
+
+
+def in_cache(cache_path, key):
+    """
+    Function to determine whether an entry exists in a cache folder.
+    """
+    return os.path.isfile(os.path.join(cache_path, key + cache_ext))
+
+
+def read_cache(cache_path, key):
+    """
+    Function to read an entry from a cache folder. Returns None if the entry doesn't exist. Reading an entry marks it as recently used for the eviction in write_cache.
+
+    Parameters
+    ----------
+    cache_path : str or pathlib.Path
+        Path to the cache folder.
+    key : str
+        The key of the entry from cache_key.
+
+    Returns
+    -------
+    object or None
+    """
+    file_path = os.path.join(cache_path, key + cache_ext)
+
+    try:
+        with open(file_path, 'rb') as f:
+            data = pickle.load(f)
+        os.utime(file_path)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+
+    return data
+
+
+def write_cache(cache_path, key, data, max_size=None):
+    """
+    Function to write an entry to a cache folder. The pandas objects are pickled with the highest protocol, which stores the column blocks as contiguous buffers. The least recently used entries are removed when the total size of the entries is larger than max_size.
+
+    Parameters
+    ----------
+    cache_path : str or pathlib.Path
+        Path to the cache folder. It will be created if it doesn't exist.
+    key : str
+        The key of the entry from cache_key.
+    data : object
+        Any picklable object.
+    max_size : int or None
+        The max total size of the entries in bytes. None will not remove any entries.
+
+    Returns
+    -------
+    None
+    """
+    os.makedirs(cache_path, exist_ok=True)
+    file_path = os.path.join(cache_path, key + cache_ext)
+    tmp_path = file_path + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, file_path)
+
+    if max_size is None:
+        return
+
+    ## Remove the least recently used entries
+    entries = []
+    for name in os.listdir(cache_path):
+        if name.endswith(cache_ext):
+            try:
+                stat = os.stat(os.path.join(cache_path, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, name))
+
+    total_size = sum(e[1] for e in entries)
+    for mtime, size, name in sorted(entries):
+        if total_size <= max_size:
+            break
+        if name == key + cache_ext:
+            continue
+        try:
+            os.remove(os.path.join(cache_path, name))
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+
+def _permit_index_path(permits_path, index_path=None):
+    """
+
+    """
+    if index_path is None:
+        index_path = str(permits_path) + permit_index_ext
+
+    return index_path
+
+
+def build_permit_index(permits_path, index_path=None):
+    """
+    Function to flatten the permits booklet once into a sidecar file that allo_filter (and subsequently AlloUsage) will load instead of parsing the permits booklet. The sidecar holds the permits and waps tables and the checksum of the permits booklet it was built from. It is ignored if the permits booklet changes.
+
+    Parameters
+    ----------
+    permits_path : str or pathlib.Path
+        Path to booklet file structured according to the nzpermits package.
+    index_path : str, pathlib.Path, or None
+        Path to the output sidecar file. None will save it next to the permits booklet with the extension '.index.pkl'.
+
+    Returns
+    -------
+    str
+        The index_path
+    """
+    index_path = _permit_index_path(permits_path, index_path)
+
+    checksum = file_checksum(permits_path)
+    waps, permits = flatten_permits(permits_path)
+
+    for col in ['hydro_feature', 'permit_status', 'use_type']:
+        permits[col] = permits[col].astype('category')
+
+    index = {'version': permit_index_version, 'checksum': checksum, 'waps': waps, 'permits': permits}
+
+    with open(index_path, 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return index_path
+
+
+def load_permit_index(permits_path, index_path=None):
+    """
+    Function to load the permits and waps tables from the sidecar file created by build_permit_index. Returns (None, None) if the sidecar doesn't exist or if it was built from a different version of the permits booklet.
+
+    Parameters
+    ----------
+    permits_path : str or pathlib.Path
+        Path to booklet file structured according to the nzpermits package.
+    index_path : str, pathlib.Path, or None
+        Path to the sidecar file. None will look for it next to the permits booklet.
+
+    Returns
+    -------
+    Two DataFrames
+        The waps and the permits
+    """
+    index_path = _permit_index_path(permits_path, index_path)
+
+    if not os.path.isfile(index_path):
+        return None, None
+
+    with open(index_path, 'rb') as f:
+        index = pickle.load(f)
+
+    if (index.get('version') != permit_index_version) or (index['checksum'] != file_checksum(permits_path)):
+        return None, None
+
+    return index['waps'], index['permits']
+
+
+def allo_filter(permits_path, from_date=None, to_date=None, permit_filter=None, wap_filter=None, only_consumptive=True, include_hydroelectric=False, use_type_mapping={}, ignore_constraints=True, index_path=None):
+    """
+    Function to filter consents and WAPs in various ways.
+
+    Parameters
+    ----------
+    server : str
+        The server of the Hydro db.
+    from_date : str
+        The start date for the time series.
+    to_date: str
+        The end date for the time series.
+    permit_filter : dict
+        If permit_id_filter is a list, then it should represent the columns from the permit table that should be returned. If it's a dict, then the keys should be the column names and the values should be the filter on those columns.
+    wap_filter : dict
+        If wap_filter is a list, then it should represent the columns from the wap table that should be returned. If it's a dict, then the keys should be the column names and the values should be the filter on those columns.
+    only_consumptive : bool
+        Should only the consumptive takes be returned? Default True
+    include_hydroelectric : bool
+        Should hydro-electric takes be included? Default False
+    index_path : str, pathlib.Path, or None
+        Path to a permits sidecar file created by build_permit_index. None will look for it next to the permits booklet. The permits booklet will be parsed if a valid sidecar can't be found.
+
+    Returns
+    -------
+    Three DataFrames
+        Representing the filters on the ExternalSites, CrcAllo, and CrcWapAllo
+    """
+    if not ignore_constraints:
+        raise NotImplementedError('contraints have not been implemented')
+
+    ### Process the premits dict into the three dataframes
+    waps, permits = load_permit_index(permits_path, index_path)
+    if waps is None:
+        waps, permits = flatten_permits(permits_path, from_date, to_date, permit_filter, wap_filter, include_hydroelectric, use_type_mapping)
+
     permits = permits[permits['max_rate'] > 0].copy()
     permits['max_daily_volume'] = permits['max_rate'] *60*60*24*0.001
     permits['max_annual_volume'] = permits['max_rate'] *60*60*24*365*0.001
@@ -140,7 +1101,7 @@ def allo_filter(permits_path, from_date=None, to_date=None, permit_filter=None,
     # waps1 = waps[waps_cols].copy()
 
     if isinstance(wap_filter, dict):
-        waps_bool1 = [waps[k].isin(v) for k, v in wap_filter.items()]
+        waps_bool1 = [waps[k].isin(v) if k in waps else waps['properties'].map(lambda x: x.get(k) if x else None).isin(v) for k, v in wap_filter.items()]
         waps_bool2 = pd.concat(waps_bool1, axis=1).prod(axis=1).astype(bool)
         waps = waps[waps_bool2].copy()
 
@@ -151,11 +1112,15 @@ def allo_filter(permits_path, from_date=None, to_date=None, permit_filter=None,
         waps = waps[waps['permit_id'].isin(permit_filter)].copy()
 
     ### permits
-    permit_cols = ['permit_id', 'hydro_feature', 'permit_status', 'from_date', 'to_date', 'use_type', 'max_rate', 'max_daily_volume', 'max_annual_volume']
+    permit_cols = ['permit_id', 'hydro_feature', 'permit_status', 'from_date', 'to_date', 'from_month', 'to_month', 'use_type', 'max_rate', 'max_daily_volume', 'max_annual_volume']
 
     permits1 = permits[permit_cols].copy()
 
-    permits1['use_type'] = permits1.use_type.replace(use_type_mapping)
+    if isinstance(permits1['use_type'].dtype, pd.CategoricalDtype):
+        ## The mapping can merge categories
+        permits1['use_type'] = permits1['use_type'].astype(object).replace(use_type_mapping).astype('category')
+    else:
+        permits1['use_type'] = permits1.use_type.replace(use_type_mapping)
 
     if isinstance(permit_filter, dict):
         permit_bool1 = [permits1[k].isin(v) for k, v in permit_filter.items()]
@@ -204,7 +1169,7 @@ def allo_filter(permits_path, from_date=None, to_date=None, permit_filter=None,
     ## Index by permit_id and hydro_group - keep the largest limits
     limit_cols = ['max_rate', 'max_daily_volume', 'max_annual_volume']
     other_cols = list(permits3.columns[~(permits3.columns.isin(limit_cols) | permits3.columns.isin(['permit_id', 'hydro_feature']))])
-    grp1 = permits3.groupby(['permit_id', 'hydro_feature'])
+    grp1 = permits3.groupby(['permit_id', 'hydro_feature'], observed=True)
     other_df = grp1[other_cols].first()
     limits_df = grp1[limit_cols].max()
 
@@ -221,6 +1186,12 @@ def allo_filter(permits_path, from_date=None, to_date=None, permit_filter=None,
     permits5 = permits4[permits4.permit_id.isin(waps.permit_id.unique())].copy()
     waps2 = waps[waps.permit_id.isin(permits5.permit_id.unique())].copy()
 
+    ## Only keep the categories of the remaining permits and waps (e.g. from the permit index)
+    for df in [permits5, waps2]:
+        for col in df.columns:
+            if isinstance(df[col].dtype, pd.CategoricalDtype):
+                df[col] = df[col].cat.remove_unused_categories()
+
     ### Index the DataFrames
     # permit_id_allo2.set_index(['permit_id', 'hydro_group'], inplace=True)
     # permit_id_wap2.set_index(['permit_id', 'hydro_group', 'wap'], inplace=True)
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stream depletion ratios and lags of groundwater takes calculated for many waps at once.
+
+The closed-form stream depletion solutions are evaluated over arrays of the aquifer parameters of all of the waps. The stream depletion of a take with lags is a linear filter of its daily extraction. The unit response of a wap (the stream depletion caused by one unit of extraction on a single day) only depends on its aquifer parameters and method, so it's calculated once and convolved with the extraction of all of the waps that share it.
+"""
+import numpy as np
+import pandas as pd
+from scipy.signal import oaconvolve
+from scipy.special import erfc
+from nz_stream_depletion import SD
+
+############################################
+### Parameters
+
+sd_batch_size = 256
+
+aquifer_cols = ['sep_distance', 'pump_aq_trans', 'pump_aq_s']
+
+
+############################################
+### Functions
+
+
+def theis_1941(n_days, pump_aq_trans, pump_aq_s, sep_distance):
+    """
+    Array version of the Theis (1941) stream depletion ratio (the complementary error function solution of Glover and Balmer (1954)) of nz_stream_depletion.
+
+    Parameters
+    ----------
+    n_days : ndarray of int
+        The number of pumping days.
+    pump_aq_trans : ndarray
+        The pumped aquifer transmissivity (m2/day).
+    pump_aq_s : ndarray
+        The storage coefficient of the pumped aquifer.
+    sep_distance : ndarray
+        The separation distance from the pumped well to the stream.
+
+    Returns
+    -------
+    ndarray
+        Stream depletion ratios
+    """
+    sdf = (sep_distance ** 2) * pump_aq_s / pump_aq_trans
+    per = erfc(np.sqrt(sdf / (4 * n_days)))
+
+    return per
+
+
+vector_methods = {'theis_1941': theis_1941}
+
+
+def select_sd_methods(waps):
+    """
+    Function to select the stream depletion method of each wap in the same way as nz_stream_depletion. The method column is used if the method is available for the aquifer parameters of the wap, otherwise it's the highest ranking available method.
+
+    Parameters
+    ----------
+    waps : DataFrame
+        The waps with the aquifer parameter columns and optionally a method column.
+
+    Returns
+    -------
+    Series
+        of the method names (None if no method is available)
+    """
+    all_methods = SD().all_methods
+
+    avail = pd.DataFrame({m: waps.reindex(columns=p).notnull().all(axis=1).values for m, p in all_methods.items()})
+
+    ## The highest ranking available method
+    methods = np.full(len(waps), None, dtype=object)
+    for m in all_methods:
+        methods[avail[m].values] = m
+
+    if 'method' in waps:
+        method1 = waps['method'].astype(object).values
+        col = avail.columns.get_indexer(pd.Index(method1).where(pd.Index(method1).isin(avail.columns)))
+        use_bool = col >= 0
+        use_bool[use_bool] = avail.values[np.arange(len(waps))[use_bool], col[use_bool]]
+        methods[use_bool] = method1[use_bool]
+
+    return pd.Series(methods, index=waps.index)
+
+
+def calc_sd_ratios(waps):
+    """
+    Function to calculate the stream depletion ratios of waps for their n_days of pumping (rounded to 3 decimals). The waps without the minimum aquifer parameters get their stream_depletion_ratio. The methods with closed-form solutions (vector_methods) are calculated for all of their waps at once and the other methods run nz_stream_depletion on each wap.
+
+    Parameters
+    ----------
+    waps : DataFrame
+        The waps with the aquifer parameter, n_days, method, and stream_depletion_ratio columns.
+
+    Returns
+    -------
+    Series
+        of the sd_ratio with the index of the waps
+    """
+    sd_ratio = pd.Series(np.nan, index=waps.index, name='sd_ratio')
+
+    aq_bool = waps.reindex(columns=aquifer_cols).notnull().all(axis=1).values
+
+    ## The waps without aquifer parameters
+    if 'stream_depletion_ratio' in waps:
+        sd_ratio[~aq_bool] = waps.loc[~aq_bool, 'stream_depletion_ratio'].round(3).values
+
+    waps1 = waps[aq_bool]
+    methods = select_sd_methods(waps1).values
+    n_days_bool = waps1['n_days'].notnull().values
+
+    pos = np.flatnonzero(aq_bool)
+    other_bool = np.ones(len(waps1), dtype=bool)
+
+    for m, fun in vector_methods.items():
+        m_bool = (methods == m) & n_days_bool
+        if not m_bool.any():
+            continue
+        waps2 = waps1[m_bool]
+        params = {p: waps2[p].values.astype('float64') for p in SD().all_methods[m]}
+        ratios = fun(waps2['n_days'].values.astype('int64'), **params)
+        sd_ratio.iloc[pos[m_bool]] = np.round(ratios, 3)
+        other_bool[m_bool] = False
+
+    ## The other methods
+    if other_bool.any():
+        sd = SD()
+        all_params = set()
+        _ = [all_params.update(p) for p in sd.all_methods.values()]
+
+        for n, (i, v) in zip(pos[other_bool], waps1[other_bool].iterrows()):
+            v1 = v.dropna().to_dict()
+            v2 = {k: v for k, v in v1.items() if k in all_params}
+            n_days = int(v['n_days'])
+            method = v['method'] if 'method' in v else None
+
+            avail = sd.load_aquifer_data(**v2)
+
+            if method in avail:
+                sd_ratio1 = sd.calc_sd_ratio(n_days, method)
+            else:
+                sd_ratio1 = sd.calc_sd_ratio(n_days)
+
+            sd_ratio.iloc[n] = round(sd_ratio1, 3)
+
+    return sd_ratio
+
+
+def sd_kernel(params, method=None, n_days=1, sd=None):
+    """
+    Function to calculate the unit response of a wap from its aquifer parameters. It's the difference of the stream depletion ratios from nz_stream_depletion for each day after the start of pumping, so convolving it with the daily extraction gives the same result as SD.calc_sd_extraction.
+
+    Parameters
+    ----------
+    params : dict
+        The aquifer parameters accepted by SD.load_aquifer_data.
+    method : str or None
+        The stream depletion method. None or a method that isn't available for the parameters will use the highest ranking available method.
+    n_days : int
+        The length of the unit response in days.
+    sd : SD or None
+        An SD object to reuse.
+
+    Returns
+    -------
+    ndarray
+    """
+    if sd is None:
+        sd = SD()
+
+    avail = sd.load_aquifer_data(**params)
+    if method not in avail:
+        method = None
+
+    ratios = np.asarray(sd.calc_sd_ratios(n_days, method), dtype='float64')
+
+    return np.diff(ratios, prepend=0)
+
+
+def calc_sd_lags(tasks, batch_size=sd_batch_size):
+    """
+    Function to calculate the stream depletion rates of GW waps from their daily usage. The waps are grouped by their aquifer parameters and method so that each unit response is only calculated once, and the usage of each group is convolved with the unit response in batches of waps with overlap-add FFT convolution (the memory is bounded by the batch_size and the length of the records). The results match the per wap SD.calc_sd_extraction within floating point precision.
+
+    Parameters
+    ----------
+    tasks : list of tuple
+        The tuples of (permit_id, wap, aquifer parameters dict, method, usage Series with a DatetimeIndex).
+    batch_size : int
+        The number of waps convolved at once.
+
+    Returns
+    -------
+    list of DataFrame
+        With the columns date, sd_rate, permit_id, and wap in the order of the tasks.
+    """
+    ## Regular daily extraction (as in SD.calc_sd_extraction)
+    extracts = []
+    groups = {}
+    for n, (permit_id, wap, params, method, use1) in enumerate(tasks):
+        if not isinstance(use1.index, pd.DatetimeIndex):
+            raise TypeError('The usage Series must have a DatetimeIndex.')
+        extract1 = use1.resample('D').mean().fillna(0)
+        extracts.append(extract1)
+
+        if not isinstance(method, str):
+            method = None
+        key = (method, tuple(sorted(params.items())))
+        groups.setdefault(key, []).append(n)
+
+    sd = SD()
+    sd_values = [None] * len(tasks)
+
+    for (method, params), index in groups.items():
+        n_days = max(len(extracts[n]) for n in index)
+        if n_days == 0:
+            for n in index:
+                sd_values[n] = np.empty(0)
+            continue
+
+        kernel = sd_kernel(dict(params), method, n_days, sd)
+
+        ## Convolve the batches of waps aligned at their first days
+        for b in range(0, len(index), batch_size):
+            batch = index[b:(b + batch_size)]
+            n_days1 = max(len(extracts[n]) for n in batch)
+            arr = np.zeros((len(batch), n_days1))
+            for row, n in enumerate(batch):
+                arr[row, :len(extracts[n])] = extracts[n].values
+
+            if n_days1 > 0:
+                sd_arr = oaconvolve(arr, kernel[np.newaxis, :n_days1], axes=1)
+            else:
+                sd_arr = arr
+
+            for row, n in enumerate(batch):
+                sd_values[n] = sd_arr[row, :len(extracts[n])]
+
+    sd_list = []
+    for n, (permit_id, wap, params, method, use1) in enumerate(tasks):
+        sd_rates1 = pd.Series(sd_values[n], index=extracts[n].index, name='sd_rate').reset_index()
+        sd_rates1['permit_id'] = permit_id
+        sd_rates1['wap'] = wap
+
+        sd_list.append(sd_rates1)
+
+    return sd_list
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+Small synthetic permits and usage booklets for the tests.
+"""
+import copy
+import numpy as np
+import pandas as pd
+import booklet
+import pytest
+
+#################################
+### Parameters
+
+n_permits = 40
+seed = 42
+
+
+#################################
+### Functions
+
+
+def make_permits(n_permits=n_permits, seed=seed):
+    """
+    Function to create synthetic permits structured according to the nzpermits package.
+    """
+    rng = np.random.default_rng(seed)
+    wap_ids = ['W{:05d}'.format(i) for i in range(int(n_permits * 1.3))]
+    wap_loc = {w: (172 + rng.random()*2, -44 + rng.random()*2) for w in wap_ids}
+
+    permits = {}
+    for i in range(n_permits):
+        permit_id = 'P{:05d}'.format(i)
+        feature = 'groundwater' if rng.random() < 0.5 else 'surface water'
+        start = pd.Timestamp('1998-01-01') + pd.Timedelta(days=int(rng.integers(0, 3000)))
+        end = start + pd.Timedelta(days=int(rng.integers(400, 4000)))
+
+        stations = []
+        for w in rng.choice(wap_ids, int(rng.integers(1, 3)), replace=False):
+            station = {'station_id': str(w), 'geometry': {'type': 'Point', 'coordinates': list(wap_loc[w])}}
+            if (feature == 'groundwater') and (rng.random() < 0.5):
+                station['properties'] = {'sep_distance': float(rng.integers(50, 2000)), 'pump_aq_trans': float(rng.integers(100, 5000)), 'pump_aq_s': float(rng.random()*0.1 + 0.001), 'n_days': 150, 'method': 'theis_1941'}
+            stations.append(station)
+
+        limits = [{'condition_type': 'abstraction', 'limit': {'period': 'D', 'value': float(rng.integers(100, 5000)), 'units': 'm3'}}]
+        if rng.random() < 0.5:
+            limits.append({'condition_type': 'abstraction', 'limit': {'period': 'Y', 'value': float(rng.integers(10000, 500000)), 'units': 'm3'}})
+
+        permits[permit_id] = {'permit_id': permit_id, 'exercised': True, 'status': 'Issued - Active', 'commencement_date': str(start.date()), 'expiry_date': str(end.date()),
+                              'activity': {'activity_type': 'consumptive take water', 'feature': feature, 'primary_purpose': str(rng.choice(['irrigation', 'stockwater', 'water_supply'])),
+                                           'conditions': limits, 'stations': stations}}
+
+    return permits
+
+
+def write_permits(path, permits):
+    """
+
+    """
+    with booklet.open(path, 'n', key_serializer='str', value_serializer='pickle') as f:
+        for k, v in permits.items():
+            f[k] = v
+
+    return path
+
+
+def write_usage(path, waps, seed=seed):
+    """
+
+    """
+    rng = np.random.default_rng(seed)
+    with booklet.open(path, 'n', key_serializer='str', value_serializer='pickle') as f:
+        for w in sorted(waps):
+            start = pd.Timestamp('1999-01-01') + pd.Timedelta(days=int(rng.integers(0, 2000)))
+            times = pd.date_range(start, start + pd.Timedelta(days=int(rng.integers(400, 3000))), freq='D')
+            values = np.round(rng.gamma(1.0, 300, len(times)) * (rng.random(len(times)) < 0.7), 1)
+            f[w] = pd.DataFrame({'time': times, w: values})
+
+    return path
+
+
+#################################
+### Fixtures
+
+
+@pytest.fixture(scope='session')
+def permits_dict():
+    return make_permits()
+
+
+@pytest.fixture(scope='session')
+def data_paths(tmp_path_factory, permits_dict):
+    """
+    The paths of the synthetic permits and usage booklets.
+    """
+    base = tmp_path_factory.mktemp('data')
+    permits_path = write_permits(str(base / 'permits.blt'), permits_dict)
+
+    waps = {s['station_id'] for p in permits_dict.values() for s in p['activity']['stations']}
+    usage_path = write_usage(str(base / 'usage.blt'), waps)
+
+    return permits_path, usage_path
+
+
+@pytest.fixture(scope='session')
+def seasonal_data_paths(tmp_path_factory, permits_dict):
+    """
+    The paths of the synthetic permits and usage booklets where every other permit has an October to April season.
+    """
+    base = tmp_path_factory.mktemp('seasonal')
+    permits = copy.deepcopy(permits_dict)
+    for permit in list(permits.values())[::2]:
+        permit['activity']['conditions'][0].update({'from_month': 10, 'to_month': 4})
+    permits_path = write_permits(str(base / 'permits.blt'), permits)
+
+    waps = {s['station_id'] for p in permits.values() for s in p['activity']['stations']}
+    usage_path = write_usage(str(base / 'usage.blt'), waps)
+
+    return permits_path, usage_path
+
+
+@pytest.fixture(scope='session')
+def two_feature_data_paths(tmp_path_factory, permits_dict):
+    """
+    The paths of the synthetic permits and usage booklets where every third permit also has an entry for the other hydro_feature (with the same waps and later dates).
+    """
+    base = tmp_path_factory.mktemp('two_feature')
+    permits = copy.deepcopy(permits_dict)
+    for permit_id, permit in list(permits.items())[::3]:
+        permit1 = copy.deepcopy(permit)
+        feature = permit['activity']['feature']
+        permit1['activity']['feature'] = 'surface water' if feature == 'groundwater' else 'groundwater'
+        permit1['commencement_date'] = str((pd.Timestamp(permit['commencement_date']) + pd.Timedelta(days=200)).date())
+        permit1['expiry_date'] = str((pd.Timestamp(permit['expiry_date']) + pd.Timedelta(days=200)).date())
+        permits[permit_id + '-2'] = permit1
+    permits_path = write_permits(str(base / 'permits.blt'), permits)
+
+    waps = {s['station_id'] for p in permits.values() for s in p['activity']['stations']}
+    usage_path = write_usage(str(base / 'usage.blt'), waps)
+
+    return permits_path, usage_path
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the allocation_ts module with the synthetic booklets of conftest.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from allotools import AlloUsage
+from allotools.data_io import allo_filter
+from allotools.allocation_ts import allo_ts, limit_days
+
+####################################
+### Parameters
+
+windows = [('1999-07-01', '2009-06-30'), ('2003-02-14', '2004-03-03')]
+
+####################################
+### Run tests
+
+
+@pytest.mark.parametrize('freq', ['D', 'M', 'A-JUN'])
+@pytest.mark.parametrize('limit_col', list(limit_days))
+@pytest.mark.parametrize('remove_months', [False, True])
+def test_allo_ts_engines(seasonal_data_paths, freq, limit_col, remove_months):
+    """
+    The vector engine is the same as the apply engine.
+    """
+    permits_path, usage_path = seasonal_data_paths
+    waps, permits = allo_filter(permits_path)
+
+    for from_date, to_date in windows:
+        allo0 = allo_ts(permits, from_date, to_date, freq, limit_col, remove_months, engine='apply')
+        allo1 = allo_ts(permits, from_date, to_date, freq, limit_col, remove_months, engine='vector')
+
+        assert len(allo1) > 0
+        pd.testing.assert_series_equal(allo1, allo0)
+
+
+@pytest.mark.parametrize('paths', ['data_paths', 'two_feature_data_paths'])
+def test_allo_intervals_waps(paths, request):
+    """
+    The daily allocation of the intervals split by wap is the same as the wap_allo_ts, including the permits with more than one hydro_feature.
+    """
+    permits_path, usage_path = request.getfixturevalue(paths)
+    a = AlloUsage(permits_path, usage_path, from_date='2000-01-01', to_date='2008-12-31')
+
+    a.get_ts(['allo'], 'D', ['permit_id', 'wap'])
+    allo0 = a.wap_allo_ts[['total_allo', 'sw_allo', 'gw_allo']]
+    allo1 = a.get_allo_intervals('max_daily_volume').aggregate('D', ['permit_id', 'wap'])
+
+    allo2 = allo0.join(allo1, rsuffix='_intervals', how='outer').fillna(0)
+    for col in allo0.columns:
+        assert np.allclose(allo2[col], allo2[col + '_intervals'], rtol=0, atol=1e-6), col
+
+
+@pytest.mark.parametrize('freq', ['W', 'M', 'A-JUN'])
+def test_allo_intervals_freqs(data_paths, freq):
+    """
+    The totals of the periods are the sums of the daily totals.
+    """
+    permits_path, usage_path = data_paths
+    a = AlloUsage(permits_path, usage_path, from_date='2000-01-01', to_date='2008-12-31')
+    intervals = a.get_allo_intervals('max_annual_volume', ['use_type'])
+
+    allo0 = intervals.aggregate('D', ['use_type']).reset_index()
+    allo0['date'] = allo0['date'].dt.to_period(freq).dt.end_time.dt.floor('D')
+    allo0 = allo0.groupby(['use_type', 'date'])[intervals.value_cols].sum()
+    allo1 = intervals.aggregate(freq, ['use_type'])
+
+    pd.testing.assert_frame_equal(allo1, allo0.loc[allo1.index], check_exact=False, check_names=False)
+    assert np.isclose(allo1['total_allo'].sum(), allo0['total_allo'].sum())
+
+
+def test_allo_view_hydro_features(two_feature_data_paths):
+    """
+    The views of the two hydro_features of the same permit are cached separately.
+    """
+    permits_path, usage_path = two_feature_data_paths
+    a = AlloUsage(permits_path, usage_path, from_date='2000-01-01', to_date='2008-12-31')
+    permits = a.permits
+    permit_id = permits.loc[permits['permit_id'].duplicated(), 'permit_id'].iloc[0]
+
+    view = a.get_allo_view('M')
+    for hydro_feature in ['groundwater', 'surface water']:
+        allo1 = view.select({'hydro_feature': [hydro_feature], 'permit_id': [permit_id]}).to_frame()
+
+        assert len(allo1) > 0
+        assert (allo1['hydro_feature'] == hydro_feature).all()
+
+    assert len(view._cache) == 2
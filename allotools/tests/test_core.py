@@ -0,0 +1,359 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of AlloUsage with the synthetic booklets of conftest.
+"""
+import copy
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import pytest
+from allotools import AlloUsage
+from allotools import core
+from allotools.tests.conftest import write_permits
+
+####################################
+### Parameters
+
+datasets = ['allo', 'metered_allo', 'usage']
+freq_days = {'D': 1, 'M': 28}
+
+####################################
+### Run tests
+
+
+def test_stage_outputs_concurrent(data_paths):
+    """
+    Stages of different freqs set the same attributes. The results cache must hold the outputs of each stage's own freq.
+    """
+    permits_path, usage_path = data_paths
+    a = AlloUsage(permits_path, usage_path, stage_threads=4)
+
+    ## Hold the daily allocation stage open until the monthly one has set the same attribute after it
+    est_allo_ts = a._est_allo_ts
+    daily_done = threading.Event()
+    monthly_done = threading.Event()
+
+    @functools.wraps(est_allo_ts)
+    def slow_est_allo_ts(freq, remove_months=False):
+        if freq == 'D':
+            result = est_allo_ts(freq, remove_months)
+            daily_done.set()
+            monthly_done.wait(10)
+        else:
+            daily_done.wait(10)
+            result = est_allo_ts(freq, remove_months)
+            monthly_done.set()
+        return result
+
+    a._est_allo_ts = slow_est_allo_ts
+
+    with ThreadPoolExecutor(2) as executor:
+        futures = {freq: executor.submit(a.get_ts, datasets, freq, ['permit_id', 'wap']) for freq in ['D', 'M']}
+        results = {freq: f.result() for freq, f in futures.items()}
+
+    for (name, key), outputs in a._results.items():
+        for attr, value in outputs.items():
+            freq = 'D' if ((not key) or ('daily' in str(attr))) else key[0]
+            if isinstance(value, (pd.DataFrame, pd.Series)):
+                value = value.reset_index()
+            if isinstance(value, pd.DataFrame) and ('date' in value.columns) and (value['date'].nunique() > 1):
+                days = pd.Series(value['date'].unique()).sort_values().diff().dt.days.min()
+                assert days >= freq_days[freq], (name, key, attr)
+                if freq == 'D':
+                    assert days == 1, (name, key, attr)
+
+    b = AlloUsage(permits_path, usage_path)
+    for freq, r in results.items():
+        pd.testing.assert_frame_equal(r, b.get_ts(datasets, freq, ['permit_id', 'wap']))
+
+
+def test_remove_months(seasonal_data_paths):
+    """
+    The seasonal permits lose their off-season months with remove_months and the others are unchanged.
+    """
+    permits_path, usage_path = seasonal_data_paths
+    a = AlloUsage(permits_path, usage_path)
+
+    seasonal = a.permits.loc[a.permits['from_month'].notnull(), 'permit_id'].unique()
+    assert len(seasonal) > 0
+
+    allo0 = a.get_ts(['allo'], 'M', ['permit_id'])['total_allo'].reset_index()
+    allo1 = a.get_ts(['allo'], 'M', ['permit_id'], remove_months=True)['total_allo'].reset_index()
+
+    off_season = allo1['date'].dt.month.isin([5, 6, 7, 8, 9])
+    is_seasonal = allo1['permit_id'].isin(seasonal)
+    assert allo1.loc[is_seasonal & off_season, 'total_allo'].fillna(0).sum() == 0
+    assert (allo1.loc[is_seasonal & ~off_season, 'total_allo'] > 0).any()
+
+    is_seasonal0 = allo0['permit_id'].isin(seasonal)
+    assert allo0.loc[is_seasonal0 & allo0['date'].dt.month.isin([5, 6, 7, 8, 9]), 'total_allo'].sum() > 0
+    pd.testing.assert_frame_equal(allo0[~is_seasonal0].reset_index(drop=True), allo1[~is_seasonal].reset_index(drop=True))
+
+
+def test_remove_months_threads(seasonal_data_paths):
+    """
+    Concurrent get_ts calls with and without remove_months on the same object return the same as separate objects.
+    """
+    permits_path, usage_path = seasonal_data_paths
+    datasets = ['allo', 'metered_allo', 'usage']
+    a = AlloUsage(permits_path, usage_path)
+
+    with ThreadPoolExecutor(2) as executor:
+        futures = {rm: executor.submit(a.get_ts, datasets, 'M', ['permit_id', 'wap'], remove_months=rm) for rm in [False, True]}
+        results = {rm: f.result() for rm, f in futures.items()}
+
+    for rm, result in results.items():
+        expected = AlloUsage(permits_path, usage_path).get_ts(datasets, 'M', ['permit_id', 'wap'], remove_months=rm)
+        pd.testing.assert_frame_equal(result, expected)
+
+    assert not results[False]['total_allo'].equals(results[True]['total_allo'])
+    assert not hasattr(a, 'remove_months')
+
+
+@pytest.mark.parametrize('aquifer', [True, False])
+def test_station_sd_ratio(permits_dict, data_paths, tmp_path, aquifer):
+    """
+    The sd_ratio of the stations is used instead of the calculated or default sd_ratio.
+    """
+    permits = copy.deepcopy(permits_dict)
+    gw_stations = [(p['permit_id'], s) for p in permits.values() if p['activity']['feature'] == 'groundwater' for s in p['activity']['stations']]
+    if not aquifer:
+        for permit_id, s in gw_stations:
+            s.pop('properties', None)
+
+    stations = [(permit_id, s) for permit_id, s in gw_stations if ('properties' in s) == aquifer][:2]
+    assert len(stations) == 2
+    for permit_id, s in stations:
+        s.setdefault('properties', {})['sd_ratio'] = 0.123
+
+    permits_path = write_permits(str(tmp_path / 'permits.blt'), permits)
+    a = AlloUsage(permits_path, data_paths[1])
+
+    station_bool = pd.MultiIndex.from_frame(a.waps[['permit_id', 'wap']]).isin([(permit_id, s['station_id']) for permit_id, s in stations])
+    assert station_bool.sum() == 2
+    assert (a.waps.loc[station_bool, 'sd_ratio'] == 0.123).all()
+    assert (a.waps.loc[~station_bool & a.waps['sd_ratio'].notnull(), 'sd_ratio'] != 0.123).all()
+
+
+@pytest.mark.parametrize('freq', ['D', 'M'])
+def test_threads(data_paths, freq):
+    """
+    The get_ts of an AlloUsage that reads the usage with threads is the same as the default.
+    """
+    permits_path, usage_path = data_paths
+    ts0 = AlloUsage(permits_path, usage_path).get_ts(datasets, freq, ['permit_id', 'wap'])
+    ts1 = AlloUsage(permits_path, usage_path, threads=4).get_ts(datasets, freq, ['permit_id', 'wap'])
+
+    pd.testing.assert_frame_equal(ts1, ts0)
+
+
+@pytest.mark.parametrize('freq', ['D', 'M'])
+def test_usage_batch_size(data_paths, freq):
+    """
+    The get_ts of an AlloUsage that aggregates the usage in batches of waps is the same as the default.
+    """
+    permits_path, usage_path = data_paths
+    ts0 = AlloUsage(permits_path, usage_path).get_ts(datasets, freq, ['permit_id', 'wap'])
+    ts1 = AlloUsage(permits_path, usage_path, usage_batch_size=5).get_ts(datasets, freq, ['permit_id', 'wap'])
+
+    pd.testing.assert_frame_equal(ts1, ts0)
+
+
+@pytest.mark.parametrize('freq', ['D', 'M'])
+def test_compact(data_paths, freq):
+    """
+    The get_ts of a compact AlloUsage is the same as the default within the float32 rounding.
+    """
+    permits_path, usage_path = data_paths
+    ts0 = AlloUsage(permits_path, usage_path).get_ts(datasets, freq, ['permit_id', 'wap'])
+    ts1 = AlloUsage(permits_path, usage_path, compact=True).get_ts(datasets, freq, ['permit_id', 'wap'])
+
+    ts1.index = ts1.index.set_levels([level.astype(object) if isinstance(level, pd.CategoricalIndex) else level for level in ts1.index.levels])
+    ts1 = ts1.sort_index()
+
+    assert ts1.index.equals(ts0.index)
+    assert list(ts1.columns) == list(ts0.columns)
+    assert np.allclose(ts1.values.astype('float64'), ts0.values, rtol=np.finfo('float32').eps * 4, atol=0, equal_nan=True)
+
+
+def count_stages(a, stages):
+    """
+    Function to count the runs of the stages of an AlloUsage object.
+    """
+    counts = {stage: 0 for stage in stages}
+
+    def wrap(stage):
+        fun = getattr(a, stage)
+
+        @functools.wraps(fun)
+        def counted(*args):
+            counts[stage] += 1
+            return fun(*args)
+
+        setattr(a, stage, counted)
+
+    for stage in stages:
+        wrap(stage)
+
+    return counts
+
+
+def test_results_cache(data_paths):
+    """
+    The stages of the same parameters are only run once and clear_results runs them again.
+    """
+    permits_path, usage_path = data_paths
+    a = AlloUsage(permits_path, usage_path)
+    counts = count_stages(a, ['_allo_wap_spit', '_get_usage', '_split_usage_ts'])
+
+    ts0 = a.get_ts(datasets, 'M', ['permit_id', 'wap'])
+    assert all(n == 1 for n in counts.values())
+
+    ts1 = a.get_ts(datasets, 'M', ['permit_id', 'wap'])
+    allo1 = a.get_ts(['allo'], 'M', ['permit_id', 'wap'])
+    assert all(n == 1 for n in counts.values())
+    pd.testing.assert_frame_equal(ts1, ts0)
+    pd.testing.assert_frame_equal(allo1, ts0[allo1.columns])
+
+    ## The daily usage is shared by the freqs
+    a.get_ts(['usage'], 'D', ['permit_id', 'wap'])
+    assert counts['_get_usage'] == 1
+    assert counts['_split_usage_ts'] == 2
+
+    a.clear_results()
+    ts2 = a.get_ts(datasets, 'M', ['permit_id', 'wap'])
+    assert counts == {'_allo_wap_spit': 3, '_get_usage': 2, '_split_usage_ts': 3}
+    pd.testing.assert_frame_equal(ts2, ts0)
+
+
+def test_disk_cache(data_paths, tmp_path):
+    """
+    A new AlloUsage with the same cache_path loads the cached stages from the disk cache instead of running them and returns the same as without the cache.
+    """
+    permits_path, usage_path = data_paths
+    cache_path = str(tmp_path / 'cache')
+    ts0 = AlloUsage(permits_path, usage_path).get_ts(datasets, 'M', ['permit_id', 'wap'])
+
+    a1 = AlloUsage(permits_path, usage_path, cache_path=cache_path)
+    counts1 = count_stages(a1, ['_allo_wap_spit', '_get_usage', '_split_usage_ts'])
+    ts1 = a1.get_ts(datasets, 'M', ['permit_id', 'wap'])
+    assert all(n == 1 for n in counts1.values())
+
+    a2 = AlloUsage(permits_path, usage_path, cache_path=cache_path)
+    counts2 = count_stages(a2, ['_est_allo_ts', '_allo_wap_spit', '_get_usage', '_agg_usage', '_split_usage_ts'])
+    ts2 = a2.get_ts(datasets, 'M', ['permit_id', 'wap'])
+    assert all(n == 0 for n in counts2.values())
+
+    pd.testing.assert_frame_equal(ts1, ts0)
+    pd.testing.assert_frame_equal(ts2, ts0)
+
+    ## Other parameters aren't loaded from the entries of the first ones
+    a2.get_ts(datasets, 'M', ['permit_id', 'wap'], usage_allo_ratio=3)
+    assert counts2['_split_usage_ts'] == 1
+
+
+def test_allo_view(data_paths):
+    """
+    The full allocation is only held by total_allo_ts, and the selected views match it.
+    """
+    permits_path, usage_path = data_paths
+    a = AlloUsage(permits_path, usage_path)
+    allo = a.get_ts(['allo'], 'M', ['permit_id'])
+
+    view = a.get_allo_view('M')
+    assert len(view._cache) == 0
+
+    use_type = a.permits['use_type'].iloc[0]
+    permit_ids = a.permits.loc[a.permits['use_type'] == use_type, 'permit_id'].unique()
+    allo1 = view.select({'use_type': [use_type]}).to_frame().groupby(['permit_id', 'date'])['total_allo'].sum()
+    allo0 = a.total_allo_ts[a.total_allo_ts['permit_id'].isin(permit_ids)].groupby(['permit_id', 'date'])['total_allo'].sum()
+
+    pd.testing.assert_series_equal(allo1, allo0)
+    assert len(view._cache) == 1
+    assert allo['total_allo'].sum() > 0
+
+
+def test_usage_est_donors(data_paths):
+    """
+    The nearest donors are only counted within the use type, so a single donor estimates the same permit/waps as all of the donors within the buffer.
+    """
+    permits_path, usage_path = data_paths
+    a = AlloUsage(permits_path, usage_path)
+
+    ## Project the waps locally (the NZTM projection isn't what's tested here)
+    waps = a.waps.drop_duplicates('wap')
+    a._wap_xy = pd.DataFrame({'x': waps['lon'].values * 80000, 'y': waps['lat'].values * 111000}, index=pd.Index(waps['wap'].values, name='wap'))
+
+    est0 = a.get_ts(['usage_est'], 'M', ['permit_id', 'wap'], min_months=12, buffer_dis=10**7)['total_usage_est']
+    est1 = a.get_ts(['usage_est'], 'M', ['permit_id', 'wap'], min_months=12, buffer_dis=10**7, n_donors=1)['total_usage_est']
+
+    ## The donor doesn't necessarily have a ratio in every month, so only the estimated permit/waps are compared
+    pairs0 = est0.dropna().reset_index()[['permit_id', 'wap']].drop_duplicates().reset_index(drop=True)
+    pairs1 = est1.dropna().reset_index()[['permit_id', 'wap']].drop_duplicates().reset_index(drop=True)
+    pd.testing.assert_frame_equal(pairs0, pairs1)
+
+
+def test_sd_processes(data_paths, monkeypatch, capsys):
+    """
+    The GW stream depletion lags calculated in a process pool are the same as in a single process, without progress output.
+    """
+    permits_path, usage_path = data_paths
+    monkeypatch.setattr(core, 'sd_chunk_size', 2)
+
+    sd_rates = []
+    for processes in [1, 2]:
+        a = AlloUsage(permits_path, usage_path, sd_engine='sd', processes=processes)
+        waps = a.waps.drop_duplicates('wap')
+        a._wap_xy = pd.DataFrame({'x': waps['lon'].values * 80000, 'y': waps['lat'].values * 111000}, index=pd.Index(waps['wap'].values, name='wap'))
+        sd_rates.append(a.get_ts(['sd_rates'], 'M', ['permit_id', 'wap'], min_months=12, buffer_dis=10**7, est_gw_sd_lags=True))
+
+    pd.testing.assert_frame_equal(sd_rates[1], sd_rates[0])
+    assert 'SD lags calculated' not in capsys.readouterr().out
+
+
+def test_sd_engine(data_paths):
+    permits_path, usage_path = data_paths
+    with pytest.raises(ValueError):
+        AlloUsage(permits_path, usage_path, sd_engine='convolution')
+
+
+@pytest.mark.parametrize('groupby', [['permit_id', 'wap'], ['date']])
+def test_get_ts_shards(data_paths, groupby):
+    """
+    The sharded get_ts is the same as the get_ts of all of the permits.
+    """
+    permits_path, usage_path = data_paths
+    a = AlloUsage(permits_path, usage_path)
+
+    ts0 = a.get_ts(datasets, 'M', groupby)
+    ts1 = a.get_ts(datasets, 'M', groupby, max_memory=10**7)
+
+    pd.testing.assert_frame_equal(ts1, ts0, check_exact=False)
+    assert len(a.waps) == len(AlloUsage(permits_path, usage_path).waps)
+
+    with pytest.raises(ValueError):
+        a.get_ts(['usage_est'], 'M', groupby, max_memory=10**7)
+
+
+def test_iter_ts_shards(data_paths):
+    """
+    The shards of iter_ts_shards have separate permits, combine to the get_ts of all of the permits, and don't change the results of the object.
+    """
+    permits_path, usage_path = data_paths
+    a = AlloUsage(permits_path, usage_path)
+    ts0 = a.get_ts(datasets, 'M', ['permit_id', 'wap'])
+    results = dict(a._results)
+
+    shards = list(a.iter_ts_shards(datasets, 'M', ['permit_id', 'wap'], 10**7))
+    assert len(shards) > 1
+
+    permit_ids = [set(shard.index.get_level_values('permit_id')) for shard in shards]
+    assert sum(len(p) for p in permit_ids) == len(set.union(*permit_ids))
+
+    ts1 = pd.concat(shards).sort_index()
+    ts1.name = 'results'
+    pd.testing.assert_frame_equal(ts1, ts0, check_exact=False)
+    assert a._results.keys() == results.keys()
+    assert all(a._results[k] is v for k, v in results.items())
@@ -0,0 +1,239 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the data_io module with the synthetic booklets of conftest.
+"""
+import copy
+import threading
+import numpy as np
+import pandas as pd
+import pytest
+import booklet
+from allotools.data_io import UsageCube, build_usage_cube, cache_key, read_usage_state, write_usage_state, flatten_permits, build_permit_index, allo_filter, _prefetch, _date_slice, get_usage_data, iter_wap_usage, iter_usage_data
+from allotools.tests.conftest import write_permits
+
+####################################
+### Run tests
+
+
+@pytest.mark.parametrize('sort', [True, False])
+def test_date_slice(sort):
+    """
+    The window of _date_slice is the same as the boolean selection of the dates (including the dates on the edges and windows outside of the data).
+    """
+    rng = np.random.default_rng(1)
+    times = pd.date_range('2000-01-01', '2000-12-31', freq='D')
+    data = pd.DataFrame({'time': times, 'W1': rng.random(len(times))})
+    if not sort:
+        data = data.sample(frac=1, random_state=1)
+
+    windows = [(None, None), ('2000-03-01', None), (None, '2000-03-01'), ('2000-03-01', '2000-03-01'), ('2000-02-10', '2000-11-20'), ('1999-01-01', '2001-06-01'), ('2001-01-01', '2001-06-01'), ('2000-06-01', '2000-05-01')]
+
+    for from_date, to_date in windows:
+        from_date1 = None if from_date is None else pd.Timestamp(from_date)
+        to_date1 = None if to_date is None else pd.Timestamp(to_date)
+        bool1 = pd.Series(True, index=data.index)
+        if from_date1 is not None:
+            bool1 &= data['time'] >= from_date1
+        if to_date1 is not None:
+            bool1 &= data['time'] <= to_date1
+
+        pd.testing.assert_frame_equal(_date_slice(data, from_date1, to_date1), data[bool1])
+
+
+def test_usage_threads(data_paths):
+    """
+    The usage read with threads is the same (and in the same order) as the usage read without them.
+    """
+    permits_path, usage_path = data_paths
+    with booklet.open(usage_path) as f:
+        waps = sorted(f.keys())[::-1]
+
+    data0 = get_usage_data(usage_path, waps, '2001-01-01', '2004-06-30')
+    data1 = get_usage_data(usage_path, waps, '2001-01-01', '2004-06-30', threads=4)
+
+    assert len(data0) > 0
+    pd.testing.assert_frame_equal(data1, data0)
+
+    usage0 = list(iter_wap_usage(usage_path, waps))
+    usage1 = list(iter_wap_usage(usage_path, waps, threads=4))
+    assert len(usage1) == len(usage0) > 0
+
+    for (wap0, times0, values0), (wap1, times1, values1) in zip(usage0, usage1):
+        assert wap0 == wap1
+        assert np.array_equal(times0, times1)
+        assert np.array_equal(values0, values1, equal_nan=True)
+
+
+@pytest.mark.parametrize('batch_size,max_rows', [(5, None), (None, 2000), (3, 2000)])
+def test_iter_usage_data(data_paths, batch_size, max_rows):
+    """
+    The batches of iter_usage_data have whole waps within the batch limits and combine to the usage of get_usage_data.
+    """
+    permits_path, usage_path = data_paths
+    data0 = get_usage_data(usage_path, None, '2001-01-01', '2004-06-30')
+
+    batches = list(iter_usage_data(usage_path, None, '2001-01-01', '2004-06-30', batch_size=batch_size, max_rows=max_rows))
+    assert len(batches) > 1
+
+    waps = [set(b['wap'].unique()) for b in batches]
+    assert sum(len(w) for w in waps) == len(set.union(*waps))
+    for b in batches:
+        if batch_size is not None:
+            assert b['wap'].nunique() <= batch_size
+        if max_rows is not None:
+            assert (b['wap'] != b['wap'].iloc[-1]).sum() < max_rows
+
+    pd.testing.assert_frame_equal(pd.concat(batches), data0)
+
+
+def test_usage_cube_view_after_close(data_paths, tmp_path):
+    permits_path, usage_path = data_paths
+    cube_path = build_usage_cube(usage_path, str(tmp_path / 'cube'))
+
+    with booklet.open(usage_path) as f:
+        wap = list(f.keys())[0]
+        data = f[wap]
+
+    cube = UsageCube(cube_path)
+    dates, values = cube.get(wap)
+    cube.close()
+
+    assert np.isclose(np.nansum(values), data[wap].sum())
+    assert len(dates) == len(values)
+
+
+def test_cache_key_canonical():
+    a = np.arange(5000).astype(str).tolist()
+    b = a[:]
+    b[2000] = 'x'
+
+    assert cache_key({'wap': a}) != cache_key({'wap': b})
+    assert cache_key(np.arange(5000)) != cache_key(np.arange(5000)[::-1].copy())
+    assert cache_key({'a': 1, 'b': [1, 2]}) == cache_key({'b': [1, 2], 'a': 1})
+    assert cache_key({'a': 1}) != cache_key({'a': '1'})
+
+
+def test_usage_state(tmp_path):
+    state_path = str(tmp_path / 'state.blt')
+    from_date = pd.Timestamp('2000-01-01')
+    usage = pd.Series([1.0, 2.0], index=pd.DatetimeIndex(['2000-01-31', '2000-02-29'], name='date'), name='total_usage')
+    qa = pd.Series(dtype='int8', name='quality_code')
+
+    write_usage_state(state_path, 'usage1.blt', 'M', {'W1': {'watermark': pd.Timestamp('2000-02-29'), 'total_usage': usage, 'quality_code': qa}}, from_date)
+
+    ## The states of other usage booklets are not used
+    assert read_usage_state(state_path, 'usage2.blt', 'M', ['W1'], from_date, pd.Timestamp('2001-01-01')) == {}
+
+    ## A shorter period doesn't replace the stored one
+    write_usage_state(state_path, 'usage1.blt', 'M', {'W1': {'watermark': pd.Timestamp('2000-01-31'), 'total_usage': usage.iloc[:1], 'quality_code': qa}}, from_date)
+    states = read_usage_state(state_path, 'usage1.blt', 'M', ['W1'], from_date, pd.Timestamp('2001-01-01'))
+
+    assert states['W1']['watermark'] == pd.Timestamp('2000-02-29')
+    pd.testing.assert_series_equal(states['W1']['total_usage'], usage)
+
+
+def test_flatten_permits_order(data_paths):
+    permits_path, usage_path = data_paths
+    permit_ids = ['P00007', 'P00003', 'P00031', 'P00003', 'P00012']
+
+    waps, permits = flatten_permits(permits_path, permit_filter=permit_ids)
+
+    assert permits['permit_id'].tolist() == [p for p in pd.unique(pd.Series(permit_ids)) if p in set(permits['permit_id'])]
+    assert len(permits) > 1
+
+
+def test_permit_index_categories(data_paths, tmp_path):
+    """
+    The permits from the permit index keep their categorical columns and are otherwise the same as the permits from the booklet.
+    """
+    permits_path, usage_path = data_paths
+    index_path = build_permit_index(permits_path, str(tmp_path / 'permits.index.pkl'))
+    cat_cols = ['hydro_feature', 'permit_status', 'use_type']
+
+    for use_type_mapping in [{}, {'irrigation': 'farming', 'stockwater': 'farming'}]:
+        waps0, permits0 = allo_filter(permits_path, use_type_mapping=use_type_mapping)
+        waps1, permits1 = allo_filter(permits_path, use_type_mapping=use_type_mapping, index_path=index_path)
+
+        assert all(isinstance(permits1[col].dtype, pd.CategoricalDtype) for col in cat_cols)
+        assert set(permits1['use_type'].cat.categories) == set(permits0['use_type'])
+        pd.testing.assert_frame_equal(permits1.astype({col: object for col in cat_cols}), permits0)
+        pd.testing.assert_frame_equal(waps1.reset_index(drop=True), waps0.reset_index(drop=True))
+
+
+def test_flatten_permits_records(permits_dict, tmp_path):
+    """
+    The permits and waps of a permit_id with more than one record are matched over all of its records, so the filters during the scan of the booklet return the same as the filters on the unfiltered permit index.
+    """
+    permits = copy.deepcopy(permits_dict)
+    for permit_id, permit in list(permits.items())[::3]:
+        permit1 = copy.deepcopy(permit)
+        feature = permit['activity']['feature']
+        permit1['activity']['feature'] = 'surface water' if feature == 'groundwater' else 'groundwater'
+        for station in permit1['activity']['stations']:
+            station['station_id'] = station['station_id'] + '-2'
+        permits[permit_id + '-2'] = permit1
+    permits_path = write_permits(str(tmp_path / 'permits.blt'), permits)
+    index_path = build_permit_index(permits_path, str(tmp_path / 'permits.index.pkl'))
+    cat_cols = ['hydro_feature', 'permit_status', 'use_type']
+
+    waps = list(permits.values())[0]['activity']['stations']
+    filters = [{'permit_filter': {'hydro_feature': ['groundwater']}}, {'wap_filter': [s['station_id'] + '-2' for s in waps]}, {'wap_filter': {'wap': [s['station_id'] for s in waps]}, 'permit_filter': {'hydro_feature': ['surface water', 'groundwater']}}]
+
+    for f in filters:
+        waps0, permits0 = allo_filter(permits_path, **f)
+        waps1, permits1 = allo_filter(permits_path, index_path=index_path, **f)
+
+        assert len(permits0) > 0
+        pd.testing.assert_frame_equal(permits1.astype({col: object for col in cat_cols}), permits0)
+        pd.testing.assert_frame_equal(waps1.reset_index(drop=True), waps0.reset_index(drop=True))
+
+
+def test_flatten_permits_not_numeric(permits_dict, tmp_path, capsys):
+    """
+    The station properties that aren't numeric are set to NaN and counted.
+    """
+    permits = copy.deepcopy(permits_dict)
+    n_bad = 0
+    for permit in permits.values():
+        for station in permit['activity']['stations']:
+            if 'properties' in station:
+                station['properties']['pump_aq_trans'] = 'unknown'
+                n_bad += 1
+    permits_path = write_permits(str(tmp_path / 'permits.blt'), permits)
+
+    waps, permits1 = flatten_permits(permits_path)
+
+    assert n_bad > 0
+    assert waps['pump_aq_trans'].isnull().all()
+    assert waps['sep_distance'].notnull().sum() == n_bad
+    assert '{} pump_aq_trans values are not numeric'.format(n_bad) in capsys.readouterr().out
+
+
+def test_prefetch_close():
+    """
+    The producer thread is only started by the first next() and it's stopped when the consumer stops early.
+    """
+    closed = threading.Event()
+
+    def produce():
+        try:
+            n = 0
+            while True:
+                yield n
+                n += 1
+        finally:
+            closed.set()
+
+    n_threads = threading.active_count()
+
+    items = _prefetch(produce(), 2)
+    assert threading.active_count() == n_threads
+
+    assert next(items) == 0
+    assert next(items) == 1
+    items.close()
+
+    assert closed.wait(5)
+    assert threading.active_count() == n_threads
+
+    assert list(_prefetch(iter(range(5)), 2)) == list(range(5))
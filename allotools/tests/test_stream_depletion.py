@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the stream_depletion module against nz_stream_depletion.
+"""
+import numpy as np
+import pandas as pd
+from nz_stream_depletion import SD
+from allotools.stream_depletion import calc_sd_lags, calc_sd_ratios
+from allotools.core import _calc_sd_lags
+
+####################################
+### Parameters
+
+theis_params = [{'sep_distance': 500.0, 'pump_aq_trans': 1000.0, 'pump_aq_s': 0.05},
+                {'sep_distance': 1500.0, 'pump_aq_trans': 300.0, 'pump_aq_s': 0.01}]
+hunt_params = {'sep_distance': 300.0, 'pump_aq_trans': 800.0, 'pump_aq_s': 0.1, 'stream_k': 5.0, 'stream_thick': 2.0, 'stream_width': 10.0}
+
+####################################
+### Run tests
+
+
+def test_calc_sd_lags():
+    """
+    The batched convolution is the same as SD.calc_sd_extraction of each wap, including waps that share aquifer parameters and usage with missing days.
+    """
+    rng = np.random.default_rng(1)
+
+    tasks = []
+    for i in range(6):
+        dates = pd.date_range('2010-01-01', periods=int(rng.integers(200, 500)), freq='D')
+        use1 = pd.Series(rng.gamma(1.0, 100, len(dates)), index=dates)
+        use1 = use1[rng.random(len(dates)) < 0.8]
+        tasks.append(('P{}'.format(i), 'W{}'.format(i), theis_params[i % 2], 'theis_1941', use1))
+
+    dates = pd.date_range('2010-01-01', periods=60, freq='D')
+    tasks.append(('P6', 'W6', hunt_params, 'hunt_1999', pd.Series(rng.gamma(1.0, 100, len(dates)), index=dates)))
+    tasks.append(('P7', 'W7', theis_params[0], None, tasks[0][4]))
+
+    sd_list0 = _calc_sd_lags(tasks)
+    sd_list1 = calc_sd_lags(tasks, batch_size=2)
+
+    assert len(sd_list0) == len(sd_list1) == len(tasks)
+    for sd0, sd1 in zip(sd_list0, sd_list1):
+        pd.testing.assert_frame_equal(sd1[sd0.columns], sd0, check_exact=False, rtol=1e-9, atol=1e-9)
+
+
+def test_calc_sd_ratios():
+    """
+    The vectorised ratios are the same as SD.calc_sd_ratio of each wap, for a mix of methods, explicit methods, and waps without aquifer parameters.
+    """
+    rng = np.random.default_rng(2)
+    n = 40
+    waps = pd.DataFrame({'sep_distance': rng.uniform(50, 2000, n), 'pump_aq_trans': rng.uniform(100, 5000, n), 'pump_aq_s': rng.uniform(0.001, 0.2, n), 'n_days': rng.integers(30, 300, n).astype('float64'), 'stream_depletion_ratio': rng.random(n)}, index=pd.Index(['W{}'.format(i) for i in range(n)], name='wap'))
+    waps['method'] = None
+
+    ## Hunt waps, some with theis as the method
+    for col in ['stream_k', 'stream_thick', 'stream_width']:
+        waps[col] = np.nan
+    waps.loc[waps.index[:4], ['stream_k', 'stream_thick', 'stream_width']] = [5.0, 2.0, 10.0]
+    waps.loc[waps.index[:2], 'method'] = 'theis_1941'
+    waps.loc[waps.index[4], 'method'] = 'hunt_1999'
+
+    ## Waps without aquifer parameters
+    waps.loc[waps.index[-5:], 'pump_aq_s'] = np.nan
+
+    sd_ratio = calc_sd_ratios(waps)
+
+    sd = SD()
+    for wap, v in waps.iterrows():
+        if pd.isnull(v['pump_aq_s']):
+            expected = round(v['stream_depletion_ratio'], 3)
+        else:
+            params = {k: x for k, x in v.dropna().items() if k in sd.all_methods['hunt_1999']}
+            avail = sd.load_aquifer_data(**params)
+            if v['method'] in avail:
+                expected = round(sd.calc_sd_ratio(int(v['n_days']), v['method']), 3)
+            else:
+                expected = round(sd.calc_sd_ratio(int(v['n_days'])), 3)
+
+        assert np.isclose(sd_ratio[wap], expected), wap
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the utils module.
+"""
+from collections import OrderedDict
+import numpy as np
+import pandas as pd
+import pytest
+from allotools import utils
+from allotools.utils import interp_daily, grp_sum, connected_shards, PeriodCalendar, get_calendar, grp_ts_agg
+
+####################################
+### Run tests
+
+
+@pytest.mark.parametrize('method', ['pchip', 'linear', 'step'])
+def test_interp_daily(method):
+    """
+    The batched interpolation is the same as the pandas interpolation of each group (the step method is a forward fill).
+    """
+    rng = np.random.default_rng(3)
+
+    groups = []
+    days = []
+    for g in range(30):
+        n_knots = int(rng.integers(1, 12))
+        days.append(np.sort(rng.choice(np.arange(0, 400, 5), n_knots, replace=False)) + int(rng.integers(0, 1000)))
+        groups.append(np.full(n_knots, g))
+    groups = np.concatenate(groups)
+    days = np.concatenate(days)
+    values = rng.gamma(1.0, 100, (len(days), 2))
+    values[rng.random(len(days)) < 0.2, 1] = np.nan
+
+    out_groups, out_days, out = interp_daily(groups, days, values, method)
+
+    for g in np.unique(groups):
+        g_bool = groups == g
+        index = pd.RangeIndex(days[g_bool].min(), days[g_bool].max() + 1)
+        knots = pd.DataFrame(values[g_bool], index=days[g_bool]).reindex(index)
+        if method == 'step':
+            expected = knots.ffill()
+        else:
+            expected = knots.apply(lambda x: x.interpolate(method) if x.count() > 1 else x.ffill())
+
+        out_bool = out_groups == g
+        assert np.array_equal(out_days[out_bool], index.values)
+        assert np.allclose(out[out_bool], expected.values, equal_nan=True, rtol=0, atol=1e-7), g
+
+
+def test_grp_sum():
+    """
+    The 'any' policy is the same as the sum of the groups with the NaNs as infs (the previous get_ts sum), and 'all' is the same as the sum with min_count=1.
+    """
+    rng = np.random.default_rng(4)
+    n = 1000
+    df = pd.DataFrame({'grp': rng.integers(0, 50, n), 'a': rng.random(n), 'b': rng.random(n)})
+    df.loc[rng.random(n) < 0.05, 'a'] = np.nan
+    df.loc[df['grp'] == 0, 'b'] = np.nan
+
+    any1 = df.replace(np.nan, np.inf).groupby('grp').sum().replace(np.inf, np.nan)
+    all1 = df.groupby('grp').sum(min_count=1)
+
+    pd.testing.assert_frame_equal(grp_sum(df, 'grp'), any1)
+    pd.testing.assert_frame_equal(grp_sum(df, 'grp', 'all'), all1)
+    pd.testing.assert_frame_equal(grp_sum(df, 'grp', {'a': 'all'}), pd.concat([all1['a'], any1['b']], axis=1))
+
+    with pytest.raises(ValueError):
+        grp_sum(df, 'grp', 'none')
+
+
+def test_connected_shards():
+    ids1 = ['P1', 'P1', 'P2', 'P3', 'P4', 'P5']
+    ids2 = ['W1', 'W2', 'W2', 'W3', 'W4', 'W4']
+
+    shards = connected_shards(ids1, ids2, 2)
+
+    ## The pairs that share a permit or wap are in the same shard and the others are packed up to max_size
+    assert shards[0] == shards[1] == shards[2]
+    assert shards[4] == shards[5]
+    assert len(np.unique(shards)) == 3
+
+    assert np.array_equal(connected_shards(ids1, ids2, 100), np.zeros(6, dtype='int64'))
+    assert len(connected_shards([], [], 10)) == 0
+
+
+@pytest.mark.parametrize('freq', ['D', 'W', 'M', 'A-JUN'])
+def test_period_calendar(freq):
+    """
+    The periods that the calendar locates for the days are the same as the periods of a pandas Grouper, and the days outside of the calendar get -1.
+    """
+    times = pd.date_range('1999-02-13', '2003-09-02', freq='D')
+    cal = PeriodCalendar(freq, times[0], times[-1])
+
+    labels = pd.Series(0, index=times).groupby(pd.Grouper(freq=freq)).size().index
+    pos = cal.locate(times)
+    assert (pos >= 0).all()
+    assert cal.dates[pos].unique().equals(labels)
+    assert np.array_equal(cal.n_days, cal.last_days - cal.first_days + 1)
+
+    outside = pd.DatetimeIndex(['1990-01-01', '2010-01-01'])
+    assert (cal.locate(outside) == -1).all()
+    assert cal.covers(times) and not cal.covers(outside)
+
+
+def test_get_calendar_lru(monkeypatch):
+    """
+    get_calendar returns the cached calendars and removes the least recently used ones when the cache is full.
+    """
+    monkeypatch.setattr(utils, 'calendar_cache_size', 3)
+    monkeypatch.setattr(utils, '_calendars', OrderedDict())
+
+    windows = [('2000-01-01', '2001-01-01'), ('2000-01-01', '2002-01-01'), ('2000-01-01', '2003-01-01'), ('2000-01-01', '2004-01-01')]
+    cals = [get_calendar('M', *w) for w in windows[:3]]
+
+    assert get_calendar('M', *windows[0]) is cals[0]
+    cal3 = get_calendar('M', *windows[3])
+
+    assert len(utils._calendars) == 3
+    assert get_calendar('M', *windows[0]) is cals[0]
+    assert get_calendar('M', *windows[3]) is cal3
+    assert get_calendar('M', *windows[1]) is not cals[1]
+
+
+@pytest.mark.parametrize('freq', ['D', 'W', 'M', 'A-JUN'])
+def test_grp_ts_agg_calendar(freq):
+    """
+    The daily times binned with a calendar are grouped the same as with a pandas Grouper.
+    """
+    rng = np.random.default_rng(5)
+    times = pd.date_range('1999-02-13', '2003-09-02', freq='D')
+    df = pd.DataFrame({'wap': rng.choice(['W1', 'W2', 'W3'], len(times)), 'date': times, 'usage': rng.random(len(times))})
+
+    expected = df.set_index('date').groupby(['wap', pd.Grouper(freq=freq)]).sum()
+
+    cal = get_calendar(freq, '1990-01-01', '2005-01-01')
+    pd.testing.assert_frame_equal(grp_ts_agg(df, 'wap', 'date', freq, 'sum', calendar=cal), expected)
+    pd.testing.assert_frame_equal(grp_ts_agg(df, 'wap', 'date', freq, 'sum'), expected)
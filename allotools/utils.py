@@ -5,19 +5,493 @@ Created on Sat May  1 13:22:21 2021
 
 @author: mike
 """
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
 import pandas as pd
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
 
 ############################################
 ### Parameters
 
+calendar_cache_size = 32
+calendar_freqs = ['D', 'W', 'M', 'A-JUN', 'A']
+
+day_ns = pd.Timedelta(days=1).value
+
+_calendars = OrderedDict()
+_calendars_lock = threading.Lock()
+
+
+############################################
+### Classes
+
+
+class PeriodCalendar(object):
+    """
+    The periods of a pandas frequency that cover a date window. The periods are labelled by their end dates (like pandas resampling with 'D', 'W', 'M', and 'A-JUN') and the first and last days of each period are stored as days since the epoch. Use get_calendar to get a cached calendar.
+
+    Parameters
+    ----------
+    freq : str
+        Pandas frequency str (e.g. 'D', 'W', 'M', or 'A-JUN').
+    from_date : str or Timestamp
+        The start of the date window.
+    to_date : str or Timestamp
+        The end of the date window. The period that contains the to_date is the last period.
+    """
+    def __init__(self, freq, from_date, to_date):
+        """
+
+        """
+        offset = pd.tseries.frequencies.to_offset(freq)
+        from_date = pd.Timestamp(from_date)
+        to_date = pd.Timestamp(to_date)
+        end_date = (to_date - pd.DateOffset(hours=1) + offset).floor('D')
+
+        dates = pd.date_range(from_date, end_date, freq=freq)
+
+        self.freq = freq
+        self.from_date = from_date
+        self.to_date = to_date
+        self.dates = dates
+        self.first_days = ((dates - offset).asi8 // day_ns) + 1
+        self.last_days = dates.asi8 // day_ns
+        self.n_days = self.last_days - self.first_days + 1
+        self.months = dates.month.values
+        self.water_years = dates.year.values + (dates.month.values > 6)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def locate(self, times):
+        """
+        Function to find the positions of the periods that contain the times. Times outside of the calendar get a position of -1.
+
+        Parameters
+        ----------
+        times : DatetimeIndex, Series, or ndarray of datetime64
+
+        Returns
+        -------
+        ndarray of int
+        """
+        days = np.asarray(times, dtype='datetime64[ns]').view('int64') // day_ns
+        pos = np.searchsorted(self.last_days, days, side='left')
+        pos[pos == len(self.last_days)] = -1
+        pos[days < self.first_days[0]] = -1
+
+        return pos
+
+    def covers(self, times):
+        """
+        Function to determine whether all of the times are within the calendar.
+        """
+        if len(times) == 0:
+            return True
+        days = np.asarray(times, dtype='datetime64[ns]').view('int64') // day_ns
+
+        return (len(self.dates) > 0) and (days.min() >= self.first_days[0]) and (days.max() <= self.last_days[-1])
 
 
 ############################################
 ### Functions
 
 
-def grp_ts_agg(df, grp_col, ts_col, freq_code, agg_fun, discrete=False, **kwargs):
+def get_calendar(freq, from_date, to_date):
+    """
+    Function to get the PeriodCalendar of a frequency and date window from a cache shared by the whole package. The least recently used calendars are removed when there are more than calendar_cache_size of them.
+
+    Parameters
+    ----------
+    freq : str
+        Pandas frequency str.
+    from_date : str or Timestamp
+        The start of the date window.
+    to_date : str or Timestamp
+        The end of the date window.
+
+    Returns
+    -------
+    PeriodCalendar
+    """
+    key = (freq, pd.Timestamp(from_date), pd.Timestamp(to_date))
+
+    with _calendars_lock:
+        cal = _calendars.get(key)
+        if cal is not None:
+            _calendars.move_to_end(key)
+            return cal
+
+    cal = PeriodCalendar(freq, from_date, to_date)
+
+    with _calendars_lock:
+        _calendars[key] = cal
+        _calendars.move_to_end(key)
+        while len(_calendars) > calendar_cache_size:
+            _calendars.popitem(last=False)
+
+    return cal
+
+
+def graph_nodes(graph, targets):
+    """
+    Function to find the nodes of a dependency graph that are needed to create the targets. The nodes are returned in an order where every node comes after its inputs.
+
+    Parameters
+    ----------
+    graph : dict
+        The nodes as keys and the lists of their input nodes as values.
+    targets : list
+        The nodes that should be created.
+
+    Returns
+    -------
+    list
+    """
+    nodes = []
+    visiting = set()
+
+    def visit(node):
+        if node in nodes:
+            return
+        if node in visiting:
+            raise ValueError('The graph has a cycle at ' + str(node))
+        visiting.add(node)
+        for input1 in graph[node]:
+            visit(input1)
+        visiting.remove(node)
+        nodes.append(node)
+
+    for target in targets:
+        visit(target)
+
+    return nodes
+
+
+def run_graph(graph, targets, fun, threads=1):
+    """
+    Function to run the nodes of a dependency graph that are needed for the targets. A node is run once all of its inputs have finished, so independent branches of the graph run concurrently when threads > 1.
+
+    Parameters
+    ----------
+    graph : dict
+        The nodes as keys and the lists of their input nodes as values.
+    targets : list
+        The nodes that should be created.
+    fun : callable
+        The function that runs a node. It's called with the node as the only argument.
+    threads : int
+        The number of threads used to run the nodes. 1 will run the nodes sequentially in the order of graph_nodes.
+
+    Returns
+    -------
+    dict
+        of the nodes and the results of fun
+    """
+    nodes = graph_nodes(graph, targets)
+    results = {}
+
+    if (threads <= 1) or (len(nodes) <= 1):
+        for node in nodes:
+            results[node] = fun(node)
+
+        return results
+
+    remaining = nodes[:]
+    running = {}
+
+    with ThreadPoolExecutor(threads) as executor:
+        while remaining or running:
+            ## Submit the nodes with finished inputs
+            for node in remaining[:]:
+                if all(input1 in results for input1 in graph[node]):
+                    running[executor.submit(fun, node)] = node
+                    remaining.remove(node)
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    results[node] = future.result()
+                except BaseException:
+                    for future1 in running:
+                        future1.cancel()
+                    raise
+
+    return results
+
+
+def find_neighbours(xy, query_xy, radius, k=None):
+    """
+    Function to find the points within a radius of the query points with a KD-tree. Optionally only the k nearest points within the radius are returned.
+
+    Parameters
+    ----------
+    xy : ndarray
+        The x and y coordinates of the points (n x 2) in a projected coordinate system.
+    query_xy : ndarray
+        The x and y coordinates of the query points (m x 2) in the same coordinate system.
+    radius : int or float
+        The search radius (in the units of the coordinates). Points on the radius are included.
+    k : int or None
+        The maximum number of nearest points returned for each query point. None will return all of the points within the radius.
+
+    Returns
+    -------
+    tuple of ndarray
+        The positions of the query points, the positions of the points, and the distances between them (in no particular order).
+    """
+    xy = np.asarray(xy, dtype='float64').reshape(-1, 2)
+    query_xy = np.asarray(query_xy, dtype='float64').reshape(-1, 2)
+
+    if (len(xy) == 0) or (len(query_xy) == 0):
+        return np.empty(0, dtype='int64'), np.empty(0, dtype='int64'), np.empty(0)
+
+    tree = cKDTree(xy)
+
+    if k is None:
+        pairs = cKDTree(query_xy).sparse_distance_matrix(tree, radius, output_type='ndarray')
+        query_pos, pos, dis = pairs['i'], pairs['j'], pairs['v']
+    else:
+        k = min(int(k), len(xy))
+        dis, pos = tree.query(query_xy, k, distance_upper_bound=np.nextafter(radius, np.inf))
+        dis = dis.reshape(len(query_xy), -1)
+        pos = pos.reshape(len(query_xy), -1)
+        query_pos = np.repeat(np.arange(len(query_xy)), pos.shape[1]).reshape(pos.shape)
+        found = pos < len(xy)
+        query_pos, pos, dis = query_pos[found], pos[found], dis[found]
+
+    return query_pos, pos, dis
+
+
+def _pchip_slopes(x, y, first, last):
+    """
+    Function to calculate the derivatives of the monotone cubic (PCHIP) interpolation at the knots of many series in the same way as scipy.interpolate.PchipInterpolator. The knots of each series are consecutive and the first and last arrays mark the ends of the series.
+    """
+    n = len(x)
+    h = np.diff(x)
+    m = np.diff(y) / np.where(h == 0, 1, h)
+
+    ## The knots with a knot of the same series on both sides
+    d = np.zeros(n)
+    inner = ~first & ~last
+    k = np.flatnonzero(inner)
+    if len(k):
+        h0, h1, m0, m1 = h[k - 1], h[k], m[k - 1], m[k]
+        w1 = 2 * h1 + h0
+        w2 = h1 + 2 * h0
+        flat = (np.sign(m0) != np.sign(m1)) | (m0 == 0) | (m1 == 0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            whmean = (w1 / m0 + w2 / m1) / (w1 + w2)
+            d[k] = np.where(flat, 0, 1 / whmean)
+
+    ## The ends of the series
+    two = first & last
+    for end_bool, step in ((first, 1), (last, -1)):
+        k = np.flatnonzero(end_bool & ~two)
+        if not len(k):
+            continue
+        seg0 = k if step == 1 else k - 1
+        h0, m0 = h[seg0], m[seg0]
+
+        ## Series of two knots are linear
+        only2 = (last[k + 1] if step == 1 else first[k - 1])
+        seg1 = np.where(only2, seg0, seg0 + step)
+        h1, m1 = h[seg1], m[seg1]
+
+        d1 = ((2 * h0 + h1) * m0 - h0 * m1) / (h0 + h1)
+        d1[np.sign(d1) != np.sign(m0)] = 0
+        big = (np.sign(m0) != np.sign(m1)) & (np.abs(d1) > 3 * np.abs(m0))
+        d1[big] = 3 * m0[big]
+        d[k] = np.where(only2, m0, d1)
+
+    return d
+
+
+def interp_daily(groups, days, values, method='pchip'):
+    """
+    Function to interpolate the knots of many time series to daily values at once. The daily values of each series (group) are written to one preallocated array from the first to the last day of its knots. NaN knots are ignored for their column and the days before the first valid knot of a column are left as NaN.
+
+    Parameters
+    ----------
+    groups : ndarray of int
+        The group code of the series of each knot.
+    days : ndarray of int
+        The day of each knot (e.g. days since the epoch). The days must be unique within each group.
+    values : ndarray
+        The values of the knots (n_knots or n_knots x n_columns).
+    method : str
+        The interpolation method. Options are pchip (monotone cubic, the same as pandas/scipy pchip), linear, and step (the value of the previous knot).
+
+    Returns
+    -------
+    tuple of ndarray
+        The group codes, the days, and the daily values (n_days x n_columns).
+    """
+    if method not in ('pchip', 'linear', 'step'):
+        raise ValueError('method must be one of pchip, linear, or step')
+
+    groups = np.asarray(groups, dtype='int64')
+    days = np.asarray(days, dtype='int64')
+    values = np.asarray(values, dtype='float64')
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+
+    order = np.lexsort((days, groups))
+    groups, days, values = groups[order], days[order], values[order]
+
+    ## The daily grid of all of the groups
+    grp_start = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    grp_end = np.r_[grp_start[1:], len(groups)] - 1
+    n_days = days[grp_end] - days[grp_start] + 1
+    offsets = np.r_[0, np.cumsum(n_days)]
+
+    out_groups = np.repeat(groups[grp_start], n_days)
+    out_days = np.arange(offsets[-1]) - np.repeat(offsets[:-1] - days[grp_start], n_days)
+    out = np.full((offsets[-1], values.shape[1]), np.nan)
+
+    ## Continuous positions of the knots and days with the groups one day apart
+    shift = np.repeat(offsets[:-1] - days[grp_start], np.diff(np.r_[grp_start, len(groups)]))
+    knot_pos = days + shift
+    day_pos = np.arange(offsets[-1])
+
+    for c in range(values.shape[1]):
+        valid = ~np.isnan(values[:, c])
+        if not valid.any():
+            continue
+        x = knot_pos[valid]
+        y = values[valid, c]
+        g = groups[valid]
+
+        first = np.r_[True, g[1:] != g[:-1]]
+        last = np.r_[g[1:] != g[:-1], True]
+
+        ## The knot before each day in the same group
+        k = np.searchsorted(x, day_pos, side='right') - 1
+        same = (k >= 0) & (g[np.maximum(k, 0)] == out_groups)
+        k = k[same]
+        pos = day_pos[same]
+
+        if method == 'step':
+            out[same, c] = y[k]
+            continue
+
+        ## The segment of each day (the last segment of a group is extended)
+        seg = np.where(last[k] & ~first[k], k - 1, k)
+        single = last[seg]
+        seg1 = np.minimum(seg + 1, len(x) - 1)
+        h = np.where(single, 1, x[seg1] - x[seg])
+        dx = (pos - x[seg]).astype('float64')
+        dy = y[seg1] - y[seg]
+
+        if method == 'linear':
+            t = np.clip(dx / h, 0, 1)
+            res = y[seg] + t * dy
+        else:
+            d = _pchip_slopes(x.astype('float64'), y, first, last)
+            m = dy / h
+            c2 = (3 * m - 2 * d[seg] - d[seg1]) / h
+            c3 = (d[seg] + d[seg1] - 2 * m) / (h ** 2)
+            res = ((c3 * dx + c2) * dx + d[seg]) * dx + y[seg]
+
+        out[same, c] = np.where(single, y[seg], res)
+
+    return out_groups, out_days, out
+
+
+def grp_sum(df, groupby, nan_policy='any'):
+    """
+    Function to sum the columns of a DataFrame by groups with an explicit policy for the missing values. The sums are done on the DataFrame in place (no copy of the data is made) and the missing values are determined from the counts of the groups.
+
+    Parameters
+    ----------
+    df : DataFrame
+        The data with the groupby columns and/or index levels.
+    groupby : str or list of str
+        The column and/or index level names to group by.
+    nan_policy : str or dict
+        The policy for the missing values. 'any' will return NaN for a group if any of its values are NaN and 'all' will return NaN only if all of its values are NaN (like pandas sum with min_count=1). A dict of column names and policies will apply the policies to the individual columns and the other columns will use 'any'.
+
+    Returns
+    -------
+    DataFrame
+    """
+    if isinstance(nan_policy, dict):
+        policy = nan_policy
+        default = 'any'
+    else:
+        policy = {}
+        default = nan_policy
+
+    if not set(policy.values()).union([default]).issubset({'any', 'all'}):
+        raise ValueError("nan_policy must be 'any', 'all', or a dict of column names and either of those")
+
+    grp = df.groupby(groupby, observed=True)
+    sums = grp.sum(min_count=1)
+
+    any_cols = [c for c in sums.columns if policy.get(c, default) == 'any']
+    if any_cols:
+        counts = grp[any_cols].count()
+        sizes = grp.size()
+        sums[any_cols] = sums[any_cols].where(counts.eq(sizes, axis=0))
+
+    return sums
+
+
+def connected_shards(ids1, ids2, max_size, weights=None):
+    """
+    Function to partition the pairs of two ids (e.g. the permit_id and wap of the waps table) into shards where the pairs that share either id are always in the same shard. The connected components of the pairs are packed in order into shards of up to max_size pairs (or total weight). A component that is larger than max_size gets a shard of its own.
+
+    Parameters
+    ----------
+    ids1 : array-like
+        The first id of each pair.
+    ids2 : array-like
+        The second id of each pair.
+    max_size : int or float
+        The max number of pairs (or the max total weight of the pairs) per shard.
+    weights : array-like or None
+        The weight of each pair (e.g. its estimated memory). None will give each pair a weight of 1.
+
+    Returns
+    -------
+    ndarray of int
+        The shard number of each pair.
+    """
+    codes1, uniques1 = pd.factorize(np.asarray(ids1, dtype=object))
+    codes2, uniques2 = pd.factorize(np.asarray(ids2, dtype=object))
+    n1 = len(uniques1)
+    n = n1 + len(uniques2)
+
+    if len(codes1) == 0:
+        return np.empty(0, dtype='int64')
+
+    graph = coo_matrix((np.ones(len(codes1)), (codes1, codes2 + n1)), shape=(n, n))
+    _, labels = connected_components(graph, directed=False)
+    comps = labels[codes1]
+
+    ## Pack the components into the shards
+    comp_codes, comp_index = pd.factorize(comps)
+    comp_sizes = np.bincount(comp_codes, weights)
+    comp_shards = np.empty(len(comp_sizes), dtype='int64')
+
+    shard = 0
+    size = 0
+    for c, comp_size in enumerate(comp_sizes):
+        if (size > 0) and (size + comp_size > max_size):
+            shard += 1
+            size = 0
+        comp_shards[c] = shard
+        size += comp_size
+
+    return comp_shards[comp_codes]
+
+
+def grp_ts_agg(df, grp_col, ts_col, freq_code, agg_fun, discrete=False, calendar=None, **kwargs):
     """
     Simple function to aggregate time series with dataframes with a single column of stations and a column of times.
 
@@ -33,6 +507,8 @@ def grp_ts_agg(df, grp_col, ts_col, freq_code, agg_fun, discrete=False, **kwargs
         The pandas frequency code for the aggregation (e.g. 'M', 'A-JUN').
     discrete : bool
         Is the data discrete? Will use proper resampling using linear interpolation.
+    calendar : PeriodCalendar or None
+        The calendar used to bin daily times when grouping (e.g. from get_calendar for the date window of the data). None will get the calendar of the range of the times from the cache. Times that are not daily and other frequencies are binned with a pandas Grouper.
 
     Returns
     -------
@@ -62,7 +538,7 @@ def grp_ts_agg(df, grp_col, ts_col, freq_code, agg_fun, discrete=False, **kwargs
             if discrete:
                 val_cols = [c for c in df1.columns if c not in grp_col]
 
-                grp1 = df1.groupby(grp_col)
+                grp1 = df1.groupby(grp_col, observed=True)
 
                 grp_list = []
 
@@ -78,8 +554,17 @@ def grp_ts_agg(df, grp_col, ts_col, freq_code, agg_fun, discrete=False, **kwargs
                 df3 = df2.reset_index().set_index(grp_col + [ts_col]).sort_index()
 
             else:
-                grp_col.extend([pd.Grouper(level=ts_col, freq=freq_code, **kwargs)])
-                df3 = df1.groupby(grp_col).agg(agg_fun)
+                times = df1.index
+                if (freq_code in calendar_freqs) and (not kwargs) and (len(times) > 0) and ((times.asi8 % day_ns) == 0).all():
+                    ## Label the daily times with the periods of the calendar
+                    if (calendar is None) or (calendar.freq != freq_code) or (not calendar.covers(times)):
+                        calendar = get_calendar(freq_code, times.min(), times.max())
+                    labels = calendar.dates[calendar.locate(times)]
+                    labels.name = ts_col
+                    grp_col.extend([labels])
+                else:
+                    grp_col.extend([pd.Grouper(level=ts_col, freq=freq_code, **kwargs)])
+                df3 = df1.groupby(grp_col, observed=True).agg(agg_fun)
 
             return df3
 